@@ -32,13 +32,12 @@ def main(force: bool = False):
             x = ix + int(offset_x)
             water = "W" in sq
             elevation = int(sq.strip("W") if len(sq.strip("W")) > 0 else "-10")
-            loc = InternalLocation(x=x, y=y, elevation=elevation, water=water, robot=None, dead_robots=[])
+            loc = InternalLocation(x=x, y=y, elevation=elevation, water=water, robot=None)
             loc_list.append(loc)
 
     serialized = [loc.serialize() for loc in loc_list]
     for ser in serialized:
         del ser["robot"]
-        del ser["dead_robots"]
 
     fname = f"malthusia/engine/game/maps/{name}.json"
     if not force and os.path.exists(fname):
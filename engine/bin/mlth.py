@@ -14,11 +14,22 @@ import sys
 import marshal
 import dis
 from types import CodeType
-from typing import List, Optional
+from typing import List, NamedTuple, Optional
 import struct
+import time
+import tempfile
+import atexit
 
-from malthusia import CodeContainer, Game, GameConstants
+from malthusia import CodeContainer, Game, GameConstants, GameError, RobotType
+from malthusia.engine.container.code_cache import CodeCache
 from malthusia.engine.container.instrument import Instrument
+from malthusia.engine.container.metering import METERING_BACKENDS
+from malthusia.engine.game.map import Map
+from malthusia.engine.game.game import ActionFromPastError
+from malthusia.engine.game.snapshots import SnapshotManager
+from malthusia.engine.game.tournament import run_tournament
+from malthusia.engine.replay import CompressedReplayWriter, ReplayWriter
+from malthusia.engine.replay.container import convert_replay as convert_replay_file, index_filename
 
 app = typer.Typer()
 
@@ -64,16 +75,29 @@ def genactions(flattened_bots: List[str], action_file: str, robot_type: Optional
         actions.append(action)
 
     with open(action_file, "w" if not append else "a") as f:
-        f.write("\n".join([json.dumps(action) for action in actions]))
+        # every action is terminated by a newline; the engine ignores a trailing unterminated line
+        f.write("".join([json.dumps(action) + "\n" for action in actions]))
 
 
 @app.command()
 def run(bots: Optional[List[str]] = typer.Argument(None), action_file: Optional[str] = None, output_file: str = None,
-        map_file: str = None, raw_text: bool = False, seed: int = GameConstants.DEFAULT_SEED, debug: bool = True, stdin_turn: bool = False):
+        map_file: str = None, raw_text: bool = False, seed: int = GameConstants.DEFAULT_SEED, debug: bool = True, stdin_turn: bool = False,
+        keyframe_interval: Optional[int] = typer.Option(None, help="write a delta-encoded replay, with a full keyframe every this many rounds"),
+        checkpoint_dir: Optional[str] = typer.Option(None, help="save a checkpoint of the game in this directory every --checkpoint-interval rounds"),
+        checkpoint_interval: int = 100,
+        resume: bool = typer.Option(False, help="continue from the latest checkpoint in --checkpoint-dir instead of starting over"),
+        snapshot_interval: Optional[int] = typer.Option(None, help="fork a snapshot of the game every this many rounds, and roll back to it when an action arrives for a round that has already been played"),
+        max_snapshots: int = 3,
+        workers: int = typer.Option(0, help="play simultaneous turns, running the robots in this many worker processes (0: sequential turns)"),
+        telemetry_file: Optional[str] = typer.Option(None, help="append the timing and bytecode of every robot in every round to this JSONL file"),
+        metering: str = typer.Option("bytecode", help=f"how the bytecode of the bots is counted: {', '.join(METERING_BACKENDS)}"),
+        code_cache: Optional[str] = typer.Option(None, help="keep the compiled code of the bots in this directory, so that code seen before is not compiled again"),
+        compressed: bool = typer.Option(False, help="write the replay in the compressed, block-indexed format (see convert-replay) instead of streaming it uncompressed")):
     global game
     # The faulthandler makes certain errors (segfaults) have nicer stacktraces.
     faulthandler.enable()
 
+    bots = bots or []
     if len(bots) > 0 and action_file is not None:
         raise ValueError(
             "Cannot read both from bots and an action file, because the bots will overwrite the action file.")
@@ -84,47 +108,328 @@ def run(bots: Optional[List[str]] = typer.Argument(None), action_file: Optional[
         action_file = "actions.jsonl"
         prepare(bots=bots, action_file=action_file)
 
-    # the round delimiter is a string that can never appear inside a valid JSON file.
-    # each round will start and end with this string
-    ROUND_PADDING = '""""'
+    # the replay is written on a background thread (see ReplayWriter), or compressed a block at a time (see
+    # CompressedReplayWriter)
+    writer = None
 
-    def replay_saver(serialized_map):
-        # TODO: fail more nicely on ctrl-c (don't want to corrupt the file)
-        if output_file is not None:
-            with open(output_file, "a") as f:
-                f.write(ROUND_PADDING)
-                json.dump(serialized_map, f)
-                f.write(ROUND_PADDING)
+    def replay_saver(serialized_round):
+        if writer is not None:
+            writer.write(serialized_round)
+
+    def replay_size():
+        if writer is None:
+            return 0
+        writer.flush()
+        return writer.size
+
+    def telemetry_saver(telemetry):
+        with open(telemetry_file, "a") as f:
+            f.write(json.dumps(telemetry) + "\n")
 
     game_args = {}
+    if telemetry_file is not None:
+        game_args["telemetry_callback"] = telemetry_saver
     if map_file is not None:
         game_args["map_file"] = map_file
-
-    if output_file is not None:
-        # overwrite the replay file
-        try:
-            os.remove(output_file)
-        except OSError as e:  # this would be "except OSError, e:" before Python 2.6
-            if e.errno != errno.ENOENT:  # errno.ENOENT = no such file or directory
-                raise  # re-raise exception if a different error occurred
+    if code_cache is not None:
+        game_args["code_cache"] = CodeCache(code_cache)
+
+    resume_from = None
+    if resume:
+        if checkpoint_dir is None:
+            raise typer.BadParameter("--resume needs a --checkpoint-dir")
+        resume_from = latest_checkpoint(checkpoint_dir)
+        if resume_from is None:
+            typer.echo(f"no checkpoint found in {checkpoint_dir}; starting a new game")
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+    if workers > 0 and (checkpoint_dir is not None or snapshot_interval is not None):
+        raise typer.BadParameter("--workers cannot be combined with checkpoints or snapshots")
+    if compressed and (checkpoint_dir is not None or snapshot_interval is not None):
+        # rolling back truncates the replay at a round, which falls in the middle of a compressed block
+        raise typer.BadParameter("--compressed cannot be combined with checkpoints or snapshots")
+
+    if output_file is not None and resume_from is None:
+        # overwrite the replay file and its index
+        for filename in [output_file, index_filename(output_file)]:
+            try:
+                os.remove(filename)
+            except OSError as e:  # this would be "except OSError, e:" before Python 2.6
+                if e.errno != errno.ENOENT:  # errno.ENOENT = no such file or directory
+                    raise  # re-raise exception if a different error occurred
+    if output_file is not None and compressed:
+        writer = CompressedReplayWriter(output_file)
+        atexit.register(writer.close)
+    elif output_file is not None:
+        writer = ReplayWriter(output_file)
+
+        def close_replay():
+            writer.close()
+            stats = writer.stats()
+            if stats["stalls"] > 0:
+                typer.echo(f"the replay writer could not keep up: the game waited for it {stats['stalls']} times, "
+                           f"{stats['stall_seconds']:.2f}s in total", err=True)
+
+        atexit.register(close_replay)
 
     # This is how you initialize a game,
     game = Game(action_file, seed=seed, debug=debug, colored_logs=not raw_text,
-                round_callback=replay_saver,
-                **game_args)
+                round_callback=replay_saver, keyframe_interval=keyframe_interval, workers=workers,
+                metering=metering, **game_args)
+
+    if resume_from is not None:
+        metadata = game.restore(resume_from)
+        if output_file is not None:
+            # drop the rounds written after the checkpoint; they are played again
+            writer.truncate(metadata["replay_size"])
+        typer.echo(f"resumed from {resume_from} at round {game.round}")
+
+    def save_checkpoint():
+        path = os.path.join(checkpoint_dir, checkpoint_filename(game.round))
+        try:
+            game.checkpoint(path, metadata={"replay_size": replay_size()})
+        except GameError as e:
+            # a robot we cannot checkpoint should not stop the game
+            typer.echo(f"could not checkpoint round {game.round}: {e}", err=True)
 
     # Here we check if the script is run using the -i flag.
     # If it is not, then we simply play the entire game.
     if not sys.flags.interactive:
+        snapshots = SnapshotManager(max_snapshots=max_snapshots) if snapshot_interval is not None else None
+        # the round the input has told us to play up to; after a rollback we catch up to it without waiting for input
+        head = game.round
         while True:
-            if stdin_turn:
-                input()
-            game.turn()
+            if stdin_turn and game.round >= head:
+                read_stdin_line()
+            head = max(head, game.round + 1)
+            try:
+                game.turn()
+            except ActionFromPastError as e:
+                if snapshots is None:
+                    raise
+                # the snapshot we hand over to truncates the replay, so everything we played must be on disk first
+                replay_size()
+                if not snapshots.rollback(e.round, head):
+                    raise
+                # the resumed snapshot has taken over the game; leave without flushing or closing anything it uses
+                os._exit(0)
+            if checkpoint_dir is not None and game.round % checkpoint_interval == 0:
+                save_checkpoint()
+            if snapshots is not None and game.round % snapshot_interval == 0:
+                snapshot_replay_size = replay_size()
+                resumed_head = snapshots.take(game.round)
+                if resumed_head is not None:
+                    # we are the snapshot, resumed after an action from the past: play the rounds after it again
+                    head = resumed_head
+                    game.resume_from_snapshot()
+                    if writer is not None:
+                        writer.after_fork()
+                        writer.truncate(snapshot_replay_size)
+                    typer.echo(f"rolled back to round {game.round}, catching up to round {head}", err=True)
     else:
         # print out help message!
         print("Run game.turn() to step through the game.")
 
 
+def read_stdin_line():
+    """
+    Reads one line from stdin without buffering ahead, so that a forked snapshot that takes over later does not miss
+    lines that were buffered by the process it was forked from.
+    """
+    line = b""
+    while not line.endswith(b"\n"):
+        c = os.read(sys.stdin.fileno(), 1)
+        if len(c) == 0:
+            raise EOFError()
+        line += c
+    return line.decode("utf-8")
+
+
+def checkpoint_filename(round_num):
+    return f"round-{round_num:08d}.ckpt"
+
+
+def latest_checkpoint(checkpoint_dir):
+    """
+    :return: the path of the checkpoint of the latest round in checkpoint_dir, or None if there is none
+    """
+    if not os.path.isdir(checkpoint_dir):
+        return None
+    checkpoints = sorted(f for f in os.listdir(checkpoint_dir) if f.startswith("round-") and f.endswith(".ckpt"))
+    if len(checkpoints) == 0:
+        return None
+    return os.path.join(checkpoint_dir, checkpoints[-1])
+
+
+@app.command()
+def tournament(flattened_bots: List[str], map_file: Optional[List[str]] = None, seed: Optional[List[int]] = None,
+               rounds: int = 100, robots_per_bot: int = 1, processes: Optional[int] = None,
+               output_file: str = "results.json"):
+    """
+    play the flattened bots against each other on every map and seed, in a pool of processes, and write the statistics
+    of every game and of every bot to output_file
+    """
+    bots = {}
+    for bot in flattened_bots:
+        with open(bot, "r") as f:
+            bots[os.path.splitext(os.path.basename(bot))[0]] = f.read()
+
+    results = run_tournament(bots, maps=map_file, seeds=seed, rounds=rounds, robots_per_bot=robots_per_bot,
+                             max_workers=processes)
+
+    with open(output_file, "w") as f:
+        json.dump(results, f, indent=2)
+    for name, stats in results["summary"].items():
+        typer.echo(f"{name}: {stats['survivors']}/{stats['robots']} robots survived over {stats['games']} games, "
+                   f"{stats['bytecode_per_turn']:.0f} bytecode per turn")
+    typer.echo(f"wrote results to {output_file}")
+
+
+@app.command()
+def benchmark(bots: List[str], robots: int = 100, rounds: int = 20, workers: Optional[List[int]] = None,
+              map_file: str = None, seed: int = GameConstants.DEFAULT_SEED):
+    """
+    measure rounds/sec with sequential turns (0 workers) and with simultaneous turns in 1, 2, 4, ... worker processes
+    """
+    if not workers:
+        workers = [0] + [2 ** i for i in range(os.cpu_count().bit_length())]
+    with tempfile.TemporaryDirectory() as tmp:
+        flattened_bots = [flatten(bot, os.path.join(tmp, f"bot{i}.txt")) for i, bot in enumerate(bots)]
+        action_file = os.path.join(tmp, "actions.jsonl")
+        genactions([flattened_bots[i % len(flattened_bots)] for i in range(robots)], action_file)
+
+        typer.echo(f"{robots} robots, {rounds} rounds, {os.cpu_count()} cores")
+        for n in workers:
+            game_args = {"map_file": map_file} if map_file is not None else {}
+            game = Game(action_file, seed=seed, debug=False, workers=n, **game_args)
+            try:
+                # the first round spawns (and compiles) all robots, so leave it out
+                game.turn()
+                start = time.perf_counter()
+                for _ in range(rounds):
+                    game.turn()
+                elapsed = time.perf_counter() - start
+            finally:
+                game.close()
+            typer.echo(f"workers={n}: {rounds / elapsed:.2f} rounds/sec, {len(game.queue)} robots alive")
+
+
+@app.command()
+def benchmark_spawn(bot: str, spawns: int = 10_000):
+    """
+    measure spawns/sec: creating and animating robots, without compiling their code or placing them on the map
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(flatten(bot, os.path.join(tmp, "bot.txt"))) as f:
+            code = CodeContainer.from_dirfile(f.read())
+        action_file = os.path.join(tmp, "actions.jsonl")
+        open(action_file, "w").close()
+        game = Game(action_file, debug=False)
+        start = time.perf_counter()
+        for i in range(spawns):
+            game.create_robot(0, 0, "benchmark", code, RobotType.WANDERER, str(i))
+        elapsed = time.perf_counter() - start
+    typer.echo(f"{spawns} spawns: {spawns / elapsed:.0f} spawns/sec, {elapsed / spawns * 1e6:.1f} us/spawn")
+
+
+class CopyOnWriteLocation(NamedTuple):
+    x: int
+    y: int
+    elevation: int
+    water: bool
+    robot: Optional[object]
+    dead_robots: List[object]
+
+
+class CopyOnWriteMap:
+    """
+    The previous storage scheme of the map, as the baseline for benchmark_moves: nested dicts of immutable locations,
+    where every update builds a new location.
+    """
+
+    def __init__(self, size):
+        self.locations = {x: {y: CopyOnWriteLocation(x, y, 0, False, None, []) for y in range(size)} for x in range(size)}
+
+    def set_robot(self, x, y, robot):
+        loc = self.locations[x][y]._replace(robot=robot)
+        if loc.x not in self.locations:
+            self.locations[loc.x] = {}
+        self.locations[loc.x][loc.y] = loc
+
+
+@app.command()
+def benchmark_moves(moves: int = 100_000, size: int = 64, repeats: int = 5):
+    """
+    measure moves/sec on the map: a robot stepping back and forth inside the authored region, and out in the sea,
+    compared to the previous copy-on-write storage. the best of repeats runs counts
+    """
+    robot = object()
+    baseline = CopyOnWriteMap(size)
+    m = Map.from_list([{"x": x, "y": y, "elevation": 0, "water": False} for x in range(size) for y in range(size)])
+    baseline_elapsed = None
+    for name, m, x in [("copy-on-write", baseline, 0), ("authored region", m, 0), ("overflow", m, size)]:
+        elapsed = None
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for i in range(moves):
+                m.set_robot(x + (i + 1) % 2, 0, robot)
+                m.set_robot(x + i % 2, 0, None)
+            run_elapsed = time.perf_counter() - start
+            elapsed = run_elapsed if elapsed is None else min(elapsed, run_elapsed)
+            if m is not baseline:
+                m.drain_changes()
+        if baseline_elapsed is None:
+            baseline_elapsed = elapsed
+            typer.echo(f"{name} (baseline): {moves / elapsed:.0f} moves/sec")
+            continue
+        typer.echo(f"{name}: {moves / elapsed:.0f} moves/sec, {baseline_elapsed / elapsed:.2f}x speedup")
+
+
+@app.command()
+def benchmark_metering(bots: List[str], robots: int = 100, rounds: int = 20,
+                       metering: Optional[List[str]] = typer.Option(None, help="the backends to compare (default: all available)"),
+                       map_file: str = None, seed: int = GameConstants.DEFAULT_SEED):
+    """
+    measure rounds/sec and bytecode used with every metering backend, for every bot. the overhead of a backend is
+    relative to running the bots without any metering, so do not use bots that loop forever
+    """
+    if not metering:
+        metering = [name for name, backend in METERING_BACKENDS.items() if backend.available()]
+    if "none" in metering:
+        metering.remove("none")
+    with tempfile.TemporaryDirectory() as tmp:
+        typer.echo(f"{robots} robots, {rounds} rounds")
+        for i, bot in enumerate(bots):
+            flattened_bot = flatten(bot, os.path.join(tmp, f"bot{i}.txt"))
+            action_file = os.path.join(tmp, f"actions{i}.jsonl")
+            genactions([flattened_bot] * robots, action_file)
+            baseline = None
+            for name in ["none"] + metering:
+                bytecode_used = []
+                game_args = {"map_file": map_file} if map_file is not None else {}
+                game = Game(action_file, seed=seed, debug=False, metering=name,
+                            telemetry_callback=lambda telemetry: bytecode_used.extend(
+                                robot["bytecode_used"] for robot in telemetry["robots"]),
+                            **game_args)
+                try:
+                    # the first round spawns (and compiles) all robots, so leave it out
+                    game.turn()
+                    bytecode_used.clear()
+                    start = time.perf_counter()
+                    for _ in range(rounds):
+                        game.turn()
+                    elapsed = time.perf_counter() - start
+                finally:
+                    game.close()
+                if baseline is None:
+                    baseline = elapsed
+                    typer.echo(f"{bot} (no metering): {rounds / elapsed:.2f} rounds/sec")
+                    continue
+                typer.echo(f"{bot} ({name}): {rounds / elapsed:.2f} rounds/sec, {elapsed / baseline:.2f}x overhead, "
+                           f"{sum(bytecode_used) / max(1, len(bytecode_used)):.0f} bytecode per turn, "
+                           f"{len(game.queue)} robots alive")
+
+
 @app.command()
 def flatten(bot_folder: str, output_file: str = None):
     if output_file is None:
@@ -162,6 +467,30 @@ def flatten(bot_folder: str, output_file: str = None):
     return output_file
 
 
+@app.command()
+def convert_map(map_file: str, output_file: str = None):
+    """
+    convert a JSON map into the binary map format, which the engine can memory-map at startup
+    """
+    if output_file is None:
+        output_file = os.path.splitext(map_file)[0] + ".mlthmap"
+
+    Map.from_file(map_file).to_binary_file(output_file)
+    typer.echo(f"wrote binary map to {output_file}")
+
+
+@app.command()
+def convert_replay(replay_file: str, output_file: str = None, rounds_per_block: int = 10):
+    """
+    convert a replay into the compressed replay format, whose index lets readers start at any round
+    """
+    if output_file is None:
+        output_file = os.path.splitext(replay_file)[0] + ".mlthreplay"
+
+    rounds = convert_replay_file(replay_file, output_file, rounds_per_block=rounds_per_block)
+    typer.echo(f"wrote {rounds} rounds to {output_file}, indexed in {index_filename(output_file)}")
+
+
 # inspired by https://gist.github.com/stecman/3751ac494795164efa82a683130cabe5
 def _pack_uint32(val):
     """ Convert integer to 32-bit little-endian bytes """
@@ -228,13 +557,14 @@ def code_to_bytecode(code, mtime=0, source_size=0):
 @app.command()
 def instrument(filename: str, replace_builtins: bool = True, instrument: bool = True,
                instrument_binary_multiply: bool = True,
-               reraise_dangerous_exceptions: bool = True, write_dis: bool = True):
+               reraise_dangerous_exceptions: bool = True, basic_blocks: bool = False, write_dis: bool = True):
     with open(filename, "r") as f:
         source = f.read()
     compiled_source = compile(source, filename, "exec")
     instrumented = Instrument.instrument(compiled_source, replace_builtins=replace_builtins, instrument=instrument,
                                          instrument_binary_multiply=instrument_binary_multiply,
-                                         reraise_dangerous_exceptions=reraise_dangerous_exceptions)
+                                         reraise_dangerous_exceptions=reraise_dangerous_exceptions,
+                                         basic_blocks=basic_blocks)
     with open(filename + "c", 'wb') as fc:
         fc.write(code_to_bytecode(instrumented))
     typer.echo(f"wrote binary instrumented code to {filename}c")
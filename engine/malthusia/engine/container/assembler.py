@@ -0,0 +1,245 @@
+import dis
+import opcode
+from types import CodeType
+
+# the number of CACHE code units that follow every instruction, by opcode
+CACHE_ENTRIES = getattr(opcode, "_inline_cache_entries", None)
+EXTENDED_ARG = dis.opmap["EXTENDED_ARG"]
+
+
+class Handler:
+    """
+    An entry of the exception table: where to go when one of the instructions it covers raises.
+    """
+
+    def __init__(self, target, depth, lasti):
+        self.target = target
+        self.depth = depth
+        self.lasti = lasti
+
+
+class Instr:
+    """
+    Instr is an instruction of a Python 3.11+ code object, without its EXTENDED_ARGs and inline caches, which assemble
+    adds back. A jump refers to the Instr it jumps to, and the exception table is stored as the Handler of every Instr.
+
+    Code is injected before an original instruction by adding it to its `before` list. Original jumps and exception
+    handlers that go to the instruction land at the start of that list, so that the injected code is never skipped.
+    """
+
+    def __init__(self, opname, arg=None, target=None, exact=False, original=False):
+        self.opname = opname
+        self.opcode = dis.opmap[opname]
+        self.arg = arg
+        # for jumps: the Instr jumped to, and whether to jump to it exactly instead of to the code injected before it
+        self.target = target
+        self.exact = exact
+        self.original = original
+        self.orig_offset = None
+        self.positions = None
+        self.handler = None
+        # the instructions injected right before this one
+        self.before = []
+        # whether this instruction is charged for, and whether it can have code injected before it (see Instrument311)
+        self.metered = False
+        self.attached = False
+        # the offset in code units of the instruction, or of its first EXTENDED_ARG; set by assemble
+        self.offset = None
+
+    def __repr__(self):
+        return f"<Instr {self.opname} {self.arg}>"
+
+    def is_jumper(self):
+        return self.opcode in dis.hasjrel
+
+    def is_backward_jumper(self):
+        return "BACKWARD" in self.opname
+
+    def landing(self):
+        return self.before[0] if len(self.before) > 0 else self
+
+    def jump_target(self):
+        return self.target if self.exact else self.target.landing()
+
+
+def parse_varint(iterator):
+    b = next(iterator)
+    val = b & 63
+    while b & 64:
+        val <<= 6
+        b = next(iterator)
+        val |= b & 63
+    return val
+
+
+def exception_table(code: CodeType):
+    """
+    :return: the entries of the exception table of code, as (start, end, target, depth, lasti) with byte offsets
+    """
+    entries = []
+    iterator = iter(code.co_exceptiontable)
+    try:
+        while True:
+            start = parse_varint(iterator) * 2
+            end = start + parse_varint(iterator) * 2
+            target = parse_varint(iterator) * 2
+            depth_lasti = parse_varint(iterator)
+            entries.append((start, end, target, depth_lasti >> 1, bool(depth_lasti & 1)))
+    except StopIteration:
+        return entries
+
+
+def disassemble(code: CodeType):
+    """
+    :return: the instructions of code as a list of Instr
+    """
+    instrs = []
+    by_offset = {}
+    extended_args = []
+    for instruction in dis.get_instructions(code):
+        if instruction.opcode == EXTENDED_ARG:
+            extended_args.append(instruction.offset)
+            continue
+        instr = Instr(instruction.opname, instruction.arg, original=True)
+        instr.positions = instruction.positions
+        # jumps to an instruction with EXTENDED_ARGs go to the first of them
+        instr.orig_offset = extended_args[0] if len(extended_args) > 0 else instruction.offset
+        if instr.is_jumper():
+            instr.target = instruction.argval
+        for offset in extended_args + [instruction.offset]:
+            by_offset[offset] = instr
+        extended_args = []
+        instrs.append(instr)
+
+    for instr in instrs:
+        if instr.is_jumper():
+            instr.target = by_offset[instr.target]
+    for start, end, target, depth, lasti in exception_table(code):
+        handler = Handler(by_offset[target], depth, lasti)
+        for instr in instrs:
+            if start <= instr.orig_offset < end:
+                instr.handler = handler
+    return instrs
+
+
+def write_varint(table, value):
+    while value >= 64:
+        table.append(64 | (value & 63))
+        value >>= 6
+    table.append(value)
+
+
+def write_signed_varint(table, value):
+    write_varint(table, (-value << 1) | 1 if value < 0 else value << 1)
+
+
+def write_exception_varint(table, value, start):
+    # the exception table has the most significant bits first, and marks the start of an entry with bit 7
+    shift = 24
+    while shift > 0:
+        if value >= 1 << shift:
+            table.append(((value >> shift) & 63) | 64 | start)
+            start = 0
+        shift -= 6
+    table.append((value & 63) | start)
+
+
+def extended_args(arg):
+    n = 0
+    while arg >= 1 << (8 * (n + 1)):
+        n += 1
+    return n
+
+
+def location_table(first_line, instrs, sizes):
+    # see https://github.com/python/cpython/blob/3.11/Objects/locations.md; every entry uses the long form
+    table = bytearray()
+    line = first_line
+    i = 0
+    while i < len(instrs):
+        positions = instrs[i].positions
+        length = 0
+        while i < len(instrs) and instrs[i].positions == positions:
+            length += sizes[i]
+            i += 1
+        while length > 0:
+            units = min(length, 8)
+            length -= units
+            if positions is None or positions.lineno is None:
+                table.append(128 | (15 << 3) | (units - 1))
+                continue
+            table.append(128 | (14 << 3) | (units - 1))
+            write_signed_varint(table, positions.lineno - line)
+            line = positions.lineno
+            end_line = positions.end_lineno if positions.end_lineno is not None else positions.lineno
+            write_varint(table, end_line - positions.lineno)
+            write_varint(table, 0 if positions.col_offset is None else positions.col_offset + 1)
+            write_varint(table, 0 if positions.end_col_offset is None else positions.end_col_offset + 1)
+    return bytes(table)
+
+
+def assemble(code: CodeType, instrs, names, consts, stacksize) -> CodeType:
+    """
+    Builds a new code object out of code and instrs, with the code injected before every instruction.
+    """
+    flat = []
+    for instr in instrs:
+        flat.extend(instr.before)
+        flat.append(instr)
+
+    # a jump can need EXTENDED_ARGs, which move the instructions after it, which can make other jumps longer, so repeat
+    # until nothing changes. the number of EXTENDED_ARGs of an instruction never goes down, so this terminates
+    args = [0 if instr.is_jumper() or instr.arg is None else instr.arg for instr in flat]
+    exts = [extended_args(arg) for arg in args]
+    while True:
+        sizes = [ext + 1 + CACHE_ENTRIES[instr.opcode] for instr, ext in zip(flat, exts)]
+        offset = 0
+        for instr, size in zip(flat, sizes):
+            instr.offset = offset
+            offset += size
+        fixed = True
+        for i, instr in enumerate(flat):
+            if not instr.is_jumper():
+                continue
+            end = instr.offset + sizes[i]
+            target = instr.jump_target().offset
+            args[i] = end - target if instr.is_backward_jumper() else target - end
+            assert args[i] >= 0, f"{instr.opname} cannot jump to {instr.jump_target()}"
+            if extended_args(args[i]) > exts[i]:
+                exts[i] = extended_args(args[i])
+                fixed = False
+        if fixed:
+            break
+    assert all(ext <= 3 for ext in exts), "an argument does not fit in 32 bits"
+
+    new_code = bytearray()
+    for instr, arg, ext in zip(flat, args, exts):
+        for shift in range(ext, 0, -1):
+            new_code.extend((EXTENDED_ARG, (arg >> (8 * shift)) & 255))
+        new_code.extend((instr.opcode, arg & 255))
+        new_code.extend(bytes(2 * CACHE_ENTRIES[instr.opcode]))
+    assert len(new_code) == 2 * sum(sizes)
+
+    exception_entries = bytearray()
+    i = 0
+    while i < len(flat):
+        handler = flat[i].handler
+        start = i
+        while i < len(flat) and flat[i].handler is handler:
+            i += 1
+        if handler is None:
+            continue
+        end = flat[i - 1].offset + sizes[i - 1]
+        write_exception_varint(exception_entries, flat[start].offset, 128)
+        write_exception_varint(exception_entries, end - flat[start].offset, 0)
+        write_exception_varint(exception_entries, handler.target.landing().offset, 0)
+        write_exception_varint(exception_entries, (handler.depth << 1) | int(handler.lasti), 0)
+
+    return code.replace(
+        co_code=bytes(new_code),
+        co_consts=consts,
+        co_names=names,
+        co_stacksize=stacksize,
+        co_linetable=location_table(code.co_firstlineno, flat, sizes),
+        co_exceptiontable=bytes(exception_entries),
+    )
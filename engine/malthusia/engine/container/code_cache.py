@@ -0,0 +1,152 @@
+import functools
+import glob
+import hashlib
+import importlib.util
+import json
+import logging
+import marshal
+import os
+import sys
+import tempfile
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# the modules whose code decides what the compiled and instrumented code of a bot looks like
+ENGINE_SOURCES = ["container/*.py", "restrictedpython/*.py"]
+
+
+@functools.lru_cache(maxsize=None)
+def engine_fingerprint() -> str:
+    """
+    :return: a hash of everything that compiled code depends on besides the source: the Python version and the code of
+             the compiler and instrumenter. Changing any of them invalidates the whole cache.
+    """
+    fingerprint = hashlib.sha256()
+    fingerprint.update(importlib.util.MAGIC_NUMBER)
+    fingerprint.update(sys.version.encode("utf-8"))
+    engine = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for pattern in ENGINE_SOURCES:
+        for path in sorted(glob.glob(os.path.join(engine, pattern))):
+            if path.endswith("_test.py"):
+                continue
+            with open(path, "rb") as f:
+                fingerprint.update(os.path.relpath(path, engine).encode("utf-8"))
+                fingerprint.update(f.read())
+    return fingerprint.hexdigest()
+
+
+class CodeCache:
+    """
+    CodeCache keeps compiled and instrumented bot code on disk, so that code that has been seen before, in this game or
+    an earlier one, does not have to be compiled again (see CodeContainer.from_directory_dict).
+
+    An entry is keyed by a hash of the source files, the metering backend and the engine_fingerprint, and holds the
+    marshaled code objects. Entries are written to a temporary file that is then renamed into place, so a reader (in
+    this process or another one sharing the directory) never sees half an entry. When the entries take up more than
+    max_bytes, the least recently used ones are deleted; a hit touches its entry, so the mtime is the time of last use.
+    """
+
+    SUFFIX = ".code"
+
+    def __init__(self, directory: str, max_bytes=256 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        # an estimate of the size of the directory, which is only listed when this goes over max_bytes
+        self.size = sum(size for _, size, _ in self.entries())
+
+        # metrics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, files: Dict[str, str], metering: str) -> str:
+        """
+        :param files: file path -> source, as passed to CodeContainer.from_directory_dict
+        """
+        key = hashlib.sha256(engine_fingerprint().encode("utf-8"))
+        key.update(json.dumps([metering, list(files.items())]).encode("utf-8"))
+        return key.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def get(self, files: Dict[str, str], metering: str) -> Optional[Tuple[Dict, Dict]]:
+        """
+        :return: (code, metered_offsets) as they were put, or None if they are not in the cache
+        """
+        path = self.path(self.key(files, metering))
+        try:
+            with open(path, "rb") as f:
+                code, metered_offsets = marshal.loads(f.read())
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (EOFError, ValueError, TypeError) as e:
+            logger.warning(f"Removing corrupt code cache entry {path}: {e}")
+            self.remove(path)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return code, metered_offsets
+
+    def put(self, files: Dict[str, str], metering: str, code: Dict, metered_offsets: Dict):
+        data = marshal.dumps((code, metered_offsets))
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, self.path(self.key(files, metering)))
+        except BaseException:
+            self.remove(temp_path)
+            raise
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        """
+        :return: (path, size, mtime) of every entry in the cache
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # evicted by another process in the meantime
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def evict(self):
+        """
+        Deletes the least recently used entries until the cache is no larger than max_bytes.
+        """
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        self.size = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self.size <= self.max_bytes:
+                break
+            self.remove(path)
+            self.size -= size
+            self.evictions += 1
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def metrics(self) -> Dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "bytes": self.size,
+        }
@@ -0,0 +1,67 @@
+import os
+
+from .code_cache import CodeCache
+from .code_container import CodeContainer
+
+FILES = {"bot/bot.py": "def turn(x):\n    return x * x + 1\n"}
+
+
+def run_turn(code):
+    instrumented = {"__instrument__": lambda: None, "__multinstrument__": lambda n: None,
+                    "__instrument_binary_multiply__": lambda a, b: None,
+                    "_OutOfBytecode": KeyError, "_GameError": KeyError, "_RuntimeError": KeyError}
+    exec(code.code["bot"], instrumented)
+    return instrumented["turn"](6)
+
+
+def test_hit_returns_the_same_code(tmp_path):
+    cache = CodeCache(str(tmp_path))
+    compiled = CodeContainer.from_directory_dict(FILES, cache=cache)
+    cached = CodeContainer.from_directory_dict(FILES, cache=cache)
+    assert cache.metrics()["misses"] == 1 and cache.metrics()["hits"] == 1
+    assert cached.code == compiled.code
+    assert cached.metered_offsets == compiled.metered_offsets
+    assert cached.source == compiled.source
+    assert run_turn(cached) == 37
+
+    # a new cache on the same directory, e.g. in the next game, sees the entry too
+    assert CodeCache(str(tmp_path)).get(FILES, "bytecode") is not None
+
+
+def test_key_depends_on_source_and_metering(tmp_path):
+    cache = CodeCache(str(tmp_path))
+    CodeContainer.from_directory_dict(FILES, cache=cache)
+    assert cache.get(FILES, "basic_blocks") is None
+    assert cache.get({"bot/bot.py": FILES["bot/bot.py"] + "\n"}, "bytecode") is None
+    assert cache.get(FILES, "bytecode") is not None
+
+
+def test_corrupt_entry_is_a_miss(tmp_path):
+    cache = CodeCache(str(tmp_path))
+    CodeContainer.from_directory_dict(FILES, cache=cache)
+    path = cache.path(cache.key(FILES, "bytecode"))
+    with open(path, "r+b") as f:
+        f.truncate(10)
+    assert cache.get(FILES, "bytecode") is None
+    assert not os.path.exists(path)
+    CodeContainer.from_directory_dict(FILES, cache=cache)
+    assert cache.get(FILES, "bytecode") is not None
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = CodeCache(str(tmp_path))
+    sources = [{"bot/bot.py": f"x = {i}\n"} for i in range(3)]
+    for i, files in enumerate(sources):
+        CodeContainer.from_directory_dict(files, cache=cache)
+        os.utime(cache.path(cache.key(files, "bytecode")), (i, i))
+    # using the oldest entry makes the second one the least recently used
+    assert cache.get(sources[0], "bytecode") is not None
+    size = os.path.getsize(cache.path(cache.key(sources[0], "bytecode")))
+
+    cache.max_bytes = 3 * size
+    CodeContainer.from_directory_dict({"bot/bot.py": "x = 3\n"}, cache=cache)
+    assert cache.metrics()["evictions"] == 1
+    assert cache.get(sources[1], "bytecode") is None
+    assert cache.get(sources[0], "bytecode") is not None
+    assert cache.get(sources[2], "bytecode") is not None
+    assert cache.metrics()["bytes"] <= cache.max_bytes
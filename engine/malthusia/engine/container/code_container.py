@@ -1,6 +1,7 @@
 import re
 import os
 from .instrument import Instrument
+from .metering import metering_backend
 
 import marshal, pickle
 from ..restrictedpython import compile_restricted
@@ -12,8 +13,13 @@ class CodeContainer:
     object representing a robot's code, to be run by a RobotRunner.
     """
 
-    def __init__(self, code):
+    def __init__(self, code, source=None, metering="bytecode", metered_offsets=None):
         self.code = code
+        # the dirfile the code was compiled from, if known; lets the code be recompiled when a game is restored
+        self.source = source
+        # the metering backend the code was instrumented for, and the offsets it charges for (see Instrument.instrument)
+        self.metering = metering
+        self.metered_offsets = metered_offsets if metered_offsets is not None else {}
 
     @classmethod
     def directory_dict_to_dirfile(cls, dirdict):
@@ -44,24 +50,38 @@ class CodeContainer:
         return dirdict
 
     @classmethod
-    def from_directory_dict(cls, dic):
-        code = {}
+    def from_directory_dict(cls, dic, metering="bytecode", cache=None):
+        """
+        :param metering: the metering backend that will run the code, see METERING_BACKENDS
+        :param cache: if set, a CodeCache to get the compiled code from, or to put it in
+        """
+        backend = metering_backend(metering)
+        source = cls.directory_dict_to_dirfile({os.path.basename(filepath): dic[filepath] for filepath in dic})
 
+        cached = cache.get(dic, metering) if cache is not None else None
+        if cached is not None:
+            code, metered_offsets = cached
+            return cls(code, source=source, metering=metering, metered_offsets=metered_offsets)
+
+        code = {}
+        metered_offsets = {}
         for filepath in dic:
             module_name = os.path.basename(filepath).split('.py')[0]
             compiled = compile_restricted(cls.preprocess(dic[filepath]), filepath, 'exec')
-            code[module_name] = Instrument.instrument(compiled)
+            code[module_name] = Instrument.instrument(compiled, metered_offsets=metered_offsets, **backend.instrument_kwargs)
 
-        return cls(code)
+        if cache is not None:
+            cache.put(dic, metering, code, metered_offsets)
+        return cls(code, source=source, metering=metering, metered_offsets=metered_offsets)
 
     @classmethod
-    def from_dirfile(cls, dirfile):
+    def from_dirfile(cls, dirfile, metering="bytecode", cache=None):
         directory_dict = cls.dirfile_to_directory_dict(dirfile)
 
-        return cls.from_directory_dict(directory_dict)
+        return cls.from_directory_dict(directory_dict, metering=metering, cache=cache)
 
     @classmethod
-    def from_directory(cls, dirname):
+    def from_directory(cls, dirname, metering="bytecode"):
         files = [os.path.abspath(os.path.join(dirname, f)) for f in os.listdir(dirname) if
                  f[-3:] == '.py' and os.path.isfile(os.path.join(dirname, f))]
 
@@ -70,7 +90,7 @@ class CodeContainer:
             with open(location) as f:
                 code[location] = f.read()
 
-        return cls.from_directory_dict(code)
+        return cls.from_directory_dict(code, metering=metering)
 
     def to_bytes(self):
         packet = {}
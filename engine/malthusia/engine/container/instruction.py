@@ -13,6 +13,10 @@ class Instruction(SimpleNamespace):
         vals["has_orig_offset"] = original
         assert((original and vals["offset"] is not None) or (not original and vals["offset"] is None))
         vals["orig_jump_target_offset"] = None
+        # the number of instructions injected right before this one, which jumps to it should land on
+        vals["injected"] = 0
+        # whether this instruction is charged for, see Instrument.instrument
+        vals["metered"] = False
         super().__init__(**vals)
 
     def calculate_orig_jump_target_offset(self):
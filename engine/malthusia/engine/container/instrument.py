@@ -25,9 +25,15 @@ def actual_kwargs():
 class Instrument:
     """
     Instrument injects and modifies the bytecode of a code object, to:
-    (1) Call __instrument__ before each user instruction (which increments the bytecode counter)
+    (1) Call __instrument__ before each user instruction (which increments the bytecode counter), or, with
+        basic_blocks, __multinstrument__(n) at the start of each basic block of n user instructions
     (2) Modify the code in other ways, e.g. by reraising dangerous exceptions
     """
+
+    # instructions after which the next instruction is never reached by falling through
+    TERMINATORS = {"RETURN_VALUE", "RAISE_VARARGS", "RERAISE", "NOT_A_LEGAL_OPERATION"}
+    # calls are where most exceptions come from (e.g. GameErrors), so a basic block also ends after every call
+    CALLS = {"CALL_FUNCTION", "CALL_FUNCTION_KW", "CALL_FUNCTION_EX", "CALL_METHOD"}
     DANGEROUS_EXCEPTIONS = ["RecursionError", "MemoryError", "KeyboardInterrupt", "OSError", "SystemError", "SystemExit", "OutOfBytecode", "RobotDied"]
 
     @staticmethod
@@ -290,21 +296,99 @@ class Instrument:
 
         return instructions, names, consts, stacksize
 
-    # note: this does basically the same thing as sys.settrace. perhaps switch to sys.settrace?
     @staticmethod
-    @actual_kwargs()
-    def instrument(bytecode: CodeType, replace_builtins=False, instrument=True, instrument_binary_multiply=True, reraise_dangerous_exceptions=True) -> CodeType:
-        """
-        The primary method for instrumenting code, which involves injecting a bytecode counter between every instruction to be executed, among other things.
+    def instrument_basic_blocks(instructions, names, consts, stacksize):
 
-        :param bytecode: a code object, the bytecode submitted by the player
-        :return: a new code object that has been injected with our bytecode counter
-        """
-        if sys.version_info < (3,8):
-            raise RuntimeError(f"Python version {sys.version_info} is not supported. Please upgrade to 3.9 (or 3.8).")
-        if sys.version_info < (3,9):
-            logger.warn(f"Support for Python version {sys.version_info} is experimental only. Please upgrade to 3.9 or proceed at your own risk.")
+        added_names = ["__multinstrument__"]
+
+        name_indices = {}
+        for i, name in enumerate(names):
+            for added_name in added_names:
+                if name == added_name:
+                    name_indices[name] = i
+        for added_name in added_names:
+            if added_name not in name_indices:
+                name_indices[added_name] = len(names)
+                names = names + (added_name, )
 
+        # a basic block starts at every jump target (including the ones of our own injections), and after every jump and
+        # every call
+        jump_targets = {instruction.orig_jump_target_offset for instruction in instructions if instruction.is_jumper()}
+        leaders = []
+        last = None
+        for instruction in instructions:
+            if instruction.original and not (last is not None and last.is_extended_arg() and last.original):
+                if last is None or instruction.orig_offset in jump_targets or last.is_jumper() or last.opname in Instrument.TERMINATORS or last.opname in Instrument.CALLS:
+                    leaders.append(instruction)
+            last = instruction
+
+        # count the instructions of every block the same way as the per instruction instrumentation does: every
+        # original instruction, except for the ones following an EXTENDED_ARG
+        leader_set = set(id(leader) for leader in leaders)
+        counts = {}
+        current = None
+        last = None
+        for instruction in instructions:
+            if id(instruction) in leader_set:
+                current = id(instruction)
+                counts[current] = 0
+            if instruction.original and current is not None and not (last is not None and last.is_extended_arg()):
+                counts[current] += 1
+            last = instruction
+
+        const_indices = {}
+        for count in set(counts.values()):
+            if count in consts and type(consts[consts.index(count)]) == int:
+                const_indices[count] = consts.index(count)
+            else:
+                const_indices[count] = len(consts)
+                consts = consts + (count, )
+
+        new_instructions = []
+        for instruction in instructions:
+            if id(instruction) in leader_set:
+                count = counts[id(instruction)]
+                injection = [
+                    dis.Instruction(opcode=dis.opmap["LOAD_GLOBAL"], opname='LOAD_GLOBAL', arg=name_indices["__multinstrument__"], argval='__multinstrument__', argrepr='__multinstrument__', offset=None, starts_line=None, is_jump_target=False),
+                    dis.Instruction(opcode=dis.opmap["LOAD_CONST"], opname='LOAD_CONST', arg=const_indices[count], argval=count, argrepr=repr(count), offset=None, starts_line=None, is_jump_target=False),
+                    dis.Instruction(opcode=dis.opmap["CALL_FUNCTION"], opname='CALL_FUNCTION', arg=1, argval=1, argrepr="", offset=None, starts_line=None, is_jump_target=False),
+                    dis.Instruction(opcode=dis.opmap["POP_TOP"], opname='POP_TOP', arg=None, argval=None, argrepr=None, offset=None, starts_line=None, is_jump_target=False),
+                ]
+                injection = [Instruction(inst, original=False) for inst in injection]
+
+                new_injection = []
+                for inject in injection:
+                    if not isinstance(inject.arg, int) or inject.arg < 2**8 or inject.is_jumper():
+                        new_injection.append(inject)
+                        continue
+                    else:
+                        arg = inject.arg
+                        inserted_extended_args = 0
+                        arg >>= 8
+                        while arg > 0:
+                            if inserted_extended_args >= 3:
+                                # we can only insert 3! so abort!
+                                raise SyntaxError("Too many extended_args wanting to be inserted; possibly too many co_names (more than 2^32).")
+                            new_injection.append(Instruction.ExtendedArgs())
+                            inserted_extended_args += 1
+                            arg >>= 8
+                        new_injection.append(inject)
+
+                injection = new_injection
+
+                new_instructions.extend(injection)
+                # jumps to this instruction land on the injection, so that the block is always charged
+                instruction.injected = len(injection)
+
+            new_instructions.append(instruction)
+
+        instructions = new_instructions
+        stacksize += 2
+
+        return instructions, names, consts, stacksize
+
+    @staticmethod
+    def check_sizes(bytecode: CodeType):
         for const in bytecode.co_consts:
             if isinstance(const, collections.abc.Sized):
                 if len(const) > 1000:
@@ -315,6 +399,32 @@ class Instrument:
                 if len(name) > 1000:
                     raise SyntaxError(f"Name with more than 1000 characters. Names, literals and constants can consist of at most 1000 characters. Cause: {name}")
 
+    # note: this does basically the same thing as sys.settrace; see TraceMetering in metering.py for that version
+    @staticmethod
+    @actual_kwargs()
+    def instrument(bytecode: CodeType, replace_builtins=False, instrument=True, instrument_binary_multiply=True, reraise_dangerous_exceptions=True, basic_blocks=False, metered_offsets=None) -> CodeType:
+        """
+        The primary method for instrumenting code, which involves injecting a bytecode counter between every instruction to be executed, among other things.
+
+        :param bytecode: a code object, the bytecode submitted by the player
+        :param basic_blocks: instead of calling __instrument__() before every instruction, call __multinstrument__(n) once at the start of every basic block, with n its number of instructions.
+            Every jump lands at the start of a basic block, so loops are still charged on every iteration, and a block that runs to its end is charged exactly as much as without basic_blocks.
+            The difference is that the whole block is charged up front: when an instruction raises, the rest of its block has already been paid for. Blocks end after every call, so that exceptions raised by calls are charged exactly.
+        :param metered_offsets: if set, a dict that is filled with the offsets of the instructions that should be charged for, for the new code object and all code objects nested in it.
+            An instruction that is preceded by EXTENDED_ARGs has the offset of the first EXTENDED_ARG. This is used by the metering backends that count instructions as they are executed (see metering), with instrument=False.
+        :return: a new code object that has been injected with our bytecode counter
+        """
+        if sys.version_info < (3,8) or (3,10) <= sys.version_info < (3,11) or sys.version_info >= (3,13):
+            raise RuntimeError(f"Python version {sys.version_info} is not supported. Please use 3.9, 3.11 or 3.12 (or 3.8).")
+        if sys.version_info < (3,9):
+            logger.warn(f"Support for Python version {sys.version_info} is experimental only. Please upgrade to 3.9 or proceed at your own risk.")
+        if sys.version_info >= (3,11):
+            # the bytecode has changed too much to share the code below, see instrument311
+            from .instrument311 import Instrument311
+            return Instrument311.instrument(bytecode, **Instrument.instrument.actual_kwargs)
+
+        Instrument.check_sizes(bytecode)
+
         # IMPL NOTE: only original instructions can be jump targets!!!!!
 
         # Ensure all code constants (e.g. list comprehensions) are also instrumented.
@@ -362,6 +472,11 @@ class Instrument:
             logger.debug("INSTRS AFTER RERAISE:")
             logger.debug("\n".join([f"{x.opname}\t\t{x.arg} ({x.argrepr})" for x in instructions]))
 
+        if basic_blocks and instrument:
+            instructions, new_names, new_consts, new_stacksize = Instrument.instrument_basic_blocks(instructions, new_names, new_consts, new_stacksize)
+            # the counting has been injected already
+            instrument = False
+
         # Make sure our code can locate the __instrument__ call
         function_name_index = len(new_names)  # we will be inserting our __instrument__ call at the end of co_names
         new_names = new_names + ('__instrument__', )
@@ -407,6 +522,8 @@ class Instrument:
 
             for inject in injection:
                 new_instructions.append(inject)
+            cur.injected += len(injection)
+            cur.metered = True
 
             new_instructions.append(cur)
 
@@ -438,7 +555,7 @@ class Instrument:
                         break
                 # we want to make sure to instrument the jumped-to instruction too, so that we cannot get infinite self loops
                 if instruction.original:
-                    cur_offset -= len(injection)*2
+                    cur_offset -= instruction.injected*2
                 orig_to_curr_offset[instruction.orig_offset] = cur_offset
 
             # now transform each jumper's argument to point to the cur offset instead of the orig offset
@@ -495,7 +612,7 @@ class Instrument:
                     break
             # we want to make sure to instrument the jumped-to instruction too, so that we cannot get infinite self loops
             if instruction.original:
-                cur_offset -= len(injection)*2
+                cur_offset -= instruction.injected*2
             orig_to_curr_offset[instruction.orig_offset] = cur_offset
 
         logger.debug(f"near-final instructions: {instructions}")
@@ -582,6 +699,15 @@ class Instrument:
         # return Instrument.build_code(bytecode, new_code, new_names, new_consts, new_lnotab)
         final_code = Instrument.build_code(bytecode, new_stacksize, new_code, new_names, new_consts, new_lnotab)
 
+        if metered_offsets is not None:
+            offsets = set()
+            for i, instruction in enumerate(instructions):
+                if instruction.metered:
+                    while i > 0 and instructions[i - 1].is_extended_arg():
+                        i -= 1
+                    offsets.add(2*i)
+            metered_offsets[final_code] = frozenset(offsets)
+
         logger.debug("INITIAL CODE:")
         logger.debug("\n" + str(dis.Bytecode(bytecode).dis()))
         logger.debug("END initial code")
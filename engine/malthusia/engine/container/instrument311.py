@@ -0,0 +1,253 @@
+import dis
+import logging
+import sys
+from types import CodeType
+
+from .assembler import Instr, assemble, disassemble
+from .instrument import Instrument
+
+logger = logging.getLogger(__name__)
+
+
+def compiled_arg(source, opname):
+    # the oparg the compiler uses for an operation, e.g. COMPARE_OP == (which differs between 3.11 and 3.12)
+    return next(i.arg for i in dis.get_instructions(compile(source, "", "exec")) if i.opname == opname)
+
+
+class Instrument311(Instrument):
+    """
+    The same instrumentation as Instrument, for the bytecode of Python 3.11 and 3.12 (see assembler), where:
+    - calls need a NULL below the function (which LOAD_GLOBAL pushes if the lowest bit of its argument is set), and on
+      3.11 a PRECALL before the CALL
+    - exception handlers are in the exception table instead of SETUP_FINALLY, and start with PUSH_EXC_INFO
+    - some instructions must directly follow the one before them, so nothing can be injected in between, and they are
+      not charged for: the CALL after a PRECALL, the PRECALL or CALL after KW_NAMES, RESUME (e.g. after a yield),
+      PUSH_EXC_INFO, END_FOR (which FOR_ITER skips) and everything up to the first RESUME
+    """
+
+    TERMINATORS = Instrument.TERMINATORS | {"RETURN_CONST"}
+    CALLS = {"CALL", "CALL_FUNCTION_EX"}
+    COMPARE_EQUAL = compiled_arg("a == b", "COMPARE_OP")
+    MULTIPLY_OPS = {compiled_arg("a * b", "BINARY_OP"), compiled_arg("a *= b", "BINARY_OP")}
+
+    @staticmethod
+    def call(nargs):
+        if sys.version_info < (3, 12):
+            return [Instr("PRECALL", nargs), Instr("CALL", nargs)]
+        return [Instr("CALL", nargs)]
+
+    @staticmethod
+    def load_global(index, null=False):
+        return Instr("LOAD_GLOBAL", (index << 1) | int(null))
+
+    @staticmethod
+    def pop_jump_if_false(target):
+        opname = "POP_JUMP_FORWARD_IF_FALSE" if sys.version_info < (3, 12) else "POP_JUMP_IF_FALSE"
+        return Instr(opname, target=target, exact=True)
+
+    @staticmethod
+    def add_names(names, added_names):
+        name_indices = {}
+        for added_name in added_names:
+            if added_name not in names:
+                names = names + (added_name, )
+            name_indices[added_name] = names.index(added_name)
+        return name_indices, names
+
+    @staticmethod
+    def inject(instr, injection):
+        # the injected code inherits the line and exception handler of the instruction, and jumps to the instruction
+        # land on it
+        for inject in injection:
+            inject.positions = instr.positions
+            inject.handler = instr.handler
+        instr.before = injection + instr.before
+
+    @staticmethod
+    def mark_attached(instrs):
+        resumed = False
+        last = None
+        for instr in instrs:
+            if not resumed:
+                instr.attached = True
+                resumed = instr.opname == "RESUME"
+            elif instr.opname in ("RESUME", "PUSH_EXC_INFO", "END_FOR"):
+                instr.attached = True
+            elif (last.opname, instr.opname) in (("PRECALL", "CALL"), ("KW_NAMES", "PRECALL"), ("KW_NAMES", "CALL")):
+                instr.attached = True
+            last = instr
+
+    @staticmethod
+    def reraise_dangerous_exceptions(instrs, names, consts, stacksize):
+        name_indices, names = Instrument311.add_names(names, ["_" + x for x in Instrument.DANGEROUS_EXCEPTIONS])
+
+        # every handler starts with PUSH_EXC_INFO; right after it, the exception is on top of the stack and is reraised
+        # if it is dangerous. the handler of that code is the one of the handler itself, which pops the exception info
+        # again before passing the exception on
+        for push, instr in zip(instrs, instrs[1:]):
+            if push.opname != "PUSH_EXC_INFO":
+                continue
+            injection = [Instrument311.load_global(name_indices["_" + x]) for x in Instrument.DANGEROUS_EXCEPTIONS]
+            injection.extend([
+                Instr("BUILD_TUPLE", len(Instrument.DANGEROUS_EXCEPTIONS)),
+                Instr("CHECK_EXC_MATCH"),
+                Instrument311.pop_jump_if_false(instr),
+                Instr("RERAISE", 0),
+            ])
+            Instrument311.inject(instr, injection)
+
+        return instrs, names, consts, stacksize + 1 + len(Instrument.DANGEROUS_EXCEPTIONS)
+
+    @staticmethod
+    def method_name(instr, names):
+        if instr.opname == "LOAD_METHOD":
+            return names[instr.arg]
+        if instr.opname == "LOAD_ATTR" and instr.arg & 1:
+            return names[instr.arg >> 1]
+        return None
+
+    @staticmethod
+    def replace_builtin_methods(instrs, names, consts, stacksize):
+        added_names = ["__safe_type__", "__module__"]
+        for instr in instrs:
+            method_name = Instrument311.method_name(instr, names)
+            if method_name is not None:
+                added_names.append("__instrumented_" + method_name)
+        name_indices, names = Instrument311.add_names(names, added_names)
+        if "builtins" not in consts:
+            consts = consts + ("builtins", )
+        builtins_index = consts.index("builtins")
+        module_arg = name_indices["__module__"] << (0 if sys.version_info < (3, 12) else 1)
+
+        # obj.method loads the method and obj for the call; when obj is a builtin, load __instrumented_method and obj
+        # instead, and skip the method load
+        for instr, after in zip(instrs, instrs[1:]):
+            method_name = Instrument311.method_name(instr, names)
+            if method_name is None:
+                continue
+            Instrument311.inject(instr, [
+                Instrument311.load_global(name_indices["__safe_type__"], null=True),
+                Instr("COPY", 3),
+                *Instrument311.call(1),
+                Instr("LOAD_ATTR", module_arg),
+                Instr("LOAD_CONST", builtins_index),
+                Instr("COMPARE_OP", Instrument311.COMPARE_EQUAL),
+                Instrument311.pop_jump_if_false(instr),
+                Instrument311.load_global(name_indices["__instrumented_" + method_name]),
+                Instr("SWAP", 2),
+                Instr("JUMP_FORWARD", target=after),
+            ])
+
+        return instrs, names, consts, stacksize + 3
+
+    @staticmethod
+    def instrument_binary_multiply(instrs, names, consts, stacksize):
+        name_indices, names = Instrument311.add_names(names, ["__instrument_binary_multiply__"])
+
+        for instr in instrs:
+            if instr.opname == "BINARY_OP" and instr.arg in Instrument311.MULTIPLY_OPS:
+                Instrument311.inject(instr, [
+                    Instrument311.load_global(name_indices["__instrument_binary_multiply__"], null=True),
+                    Instr("COPY", 4),
+                    Instr("COPY", 4),
+                    *Instrument311.call(2),
+                    Instr("POP_TOP"),
+                ])
+
+        return instrs, names, consts, stacksize + 4
+
+    @staticmethod
+    def instrument_basic_blocks(instrs, names, consts, stacksize):
+        name_indices, names = Instrument311.add_names(names, ["__multinstrument__"])
+
+        targets = set()
+        for instr in instrs:
+            for jumper in instr.before + [instr]:
+                if jumper.is_jumper():
+                    targets.add(id(jumper.target))
+            if instr.handler is not None:
+                targets.add(id(instr.handler.target))
+
+        # split the code into blocks, the same way as Instrument.instrument_basic_blocks
+        blocks = []
+        last = None
+        for instr in instrs:
+            if last is None or id(instr) in targets or last.is_jumper() or last.opname in Instrument311.TERMINATORS or last.opname in Instrument311.CALLS:
+                blocks.append([])
+            blocks[-1].append(instr)
+            last = instr
+
+        for block in blocks:
+            metered = [instr for instr in block if not instr.attached]
+            if len(metered) == 0:
+                continue
+            count = len(metered)
+            if count not in consts or type(consts[consts.index(count)]) != int:
+                consts = consts + (count, )
+            # the first instructions of a block can be attached (e.g. the PUSH_EXC_INFO of a handler), in which case the
+            # charge comes right after them
+            Instrument311.inject(metered[0], [
+                Instrument311.load_global(name_indices["__multinstrument__"], null=True),
+                Instr("LOAD_CONST", consts.index(count)),
+                *Instrument311.call(1),
+                Instr("POP_TOP"),
+            ])
+
+        return instrs, names, consts, stacksize + 3
+
+    @staticmethod
+    def instrument(bytecode: CodeType, replace_builtins=False, instrument=True, instrument_binary_multiply=True, reraise_dangerous_exceptions=True, basic_blocks=False, metered_offsets=None) -> CodeType:
+        """
+        Instrument.instrument for Python 3.11 and 3.12, with the same parameters.
+        """
+        Instrument.check_sizes(bytecode)
+
+        new_consts = []
+        for constant in bytecode.co_consts:
+            if type(constant) == CodeType:
+                constant = Instrument311.instrument(constant, replace_builtins, instrument, instrument_binary_multiply, reraise_dangerous_exceptions, basic_blocks, metered_offsets)
+            new_consts.append(constant)
+        new_consts = tuple(new_consts)
+
+        instrs = disassemble(bytecode)
+        Instrument311.mark_attached(instrs)
+        for instr in instrs:
+            instr.metered = not instr.attached
+
+        new_names = tuple(bytecode.co_names)
+        new_stacksize = bytecode.co_stacksize
+
+        if replace_builtins:
+            instrs, new_names, new_consts, new_stacksize = Instrument311.replace_builtin_methods(instrs, new_names, new_consts, new_stacksize)
+
+        if instrument_binary_multiply:
+            instrs, new_names, new_consts, new_stacksize = Instrument311.instrument_binary_multiply(instrs, new_names, new_consts, new_stacksize)
+
+        if reraise_dangerous_exceptions:
+            instrs, new_names, new_consts, new_stacksize = Instrument311.reraise_dangerous_exceptions(instrs, new_names, new_consts, new_stacksize)
+
+        if basic_blocks and instrument:
+            instrs, new_names, new_consts, new_stacksize = Instrument311.instrument_basic_blocks(instrs, new_names, new_consts, new_stacksize)
+            instrument = False
+
+        if instrument:
+            name_indices, new_names = Instrument311.add_names(new_names, ["__instrument__"])
+            for instr in instrs:
+                if instr.metered:
+                    Instrument311.inject(instr, [
+                        Instrument311.load_global(name_indices["__instrument__"], null=True),
+                        *Instrument311.call(0),
+                        Instr("POP_TOP"),
+                    ])
+            new_stacksize += 2
+
+        final_code = assemble(bytecode, instrs, new_names, new_consts, new_stacksize)
+
+        if metered_offsets is not None:
+            metered_offsets[final_code] = frozenset(2 * instr.offset for instr in instrs if instr.metered)
+
+        logger.debug("FINAL CODE:")
+        logger.debug("\n" + str(dis.Bytecode(final_code).dis()))
+        logger.debug("END final code")
+
+        return final_code
@@ -0,0 +1,219 @@
+import sys
+import weakref
+
+
+class Metering:
+    """
+    A metering backend counts the instructions executed by bot code, and charges them to a RobotRunner (see
+    RobotRunner.instrument_call). start() and stop() are called around every run of the robot.
+
+    Every backend charges for the same instructions: the ones in the bot's original code, not the ones injected by
+    Instrument, with an EXTENDED_ARG and the instruction it extends counting as one. So the bytecode used by a turn does
+    not depend on the backend, and neither does the result of a game.
+    """
+
+    # how Instrument.instrument should prepare code for this backend
+    instrument_kwargs = {}
+
+    def __init__(self, runner):
+        self.runner = runner
+
+    @classmethod
+    def available(cls):
+        return True
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class BytecodeMetering(Metering):
+    """
+    Calls __instrument__() before every instruction, injected into the code itself.
+    """
+    instrument_kwargs = {"instrument": True}
+
+
+class BasicBlockMetering(Metering):
+    """
+    Calls __multinstrument__(n) at the start of every basic block, injected into the code itself. A block is charged
+    up front, so an exception in the middle of one costs a bit more than with the other backends.
+    """
+    instrument_kwargs = {"basic_blocks": True}
+
+
+class NoMetering(Metering):
+    """
+    Counts nothing: bots can loop forever. Only for measuring the overhead of the other backends.
+    """
+    instrument_kwargs = {"instrument": False}
+
+
+def is_bot_frame(frame):
+    # every module of the bot runs with a __name__ that starts with DANGEROUS_ (see RobotRunner)
+    name = frame.f_globals.get("__name__")
+    return isinstance(name, str) and name.startswith("DANGEROUS_")
+
+
+class TraceMetering(Metering):
+    """
+    Counts opcode events with sys.settrace and f_trace_opcodes, in bot frames only.
+
+    When the trace function raises OutOfBytecode, Python turns tracing off. From then on, a profile function turns it
+    back on at the next call or return, so that no bot code runs unmetered afterwards, e.g. in a __del__ method.
+
+    Python 3.12 implements sys.settrace with sys.monitoring, and only emits opcode events for frames that turned on
+    f_trace_opcodes before they started (if at all), so there MonitoringMetering takes its place.
+    """
+    instrument_kwargs = {"instrument": False}
+
+    def __init__(self, runner):
+        super().__init__(runner)
+        # id(code) -> (code, metered offsets), to avoid hashing code objects on every call
+        self.offsets = {}
+        self.previous = None
+
+    @classmethod
+    def available(cls):
+        return not hasattr(sys, "monitoring")
+
+    def start(self):
+        self.previous = (sys.gettrace(), sys.getprofile())
+        sys.settrace(self.trace_call)
+
+    def stop(self):
+        trace, profile = self.previous
+        # the profile function goes first, or it would turn tracing back on
+        sys.setprofile(profile)
+        sys.settrace(trace)
+
+    def trace_call(self, frame, event, arg):
+        if not is_bot_frame(frame):
+            return None
+        return self.trace_frame(frame)
+
+    def trace_frame(self, frame):
+        code = frame.f_code
+        if id(code) not in self.offsets:
+            # functions restored from a checkpoint have copies of the code objects, hence the lookup by value
+            self.offsets[id(code)] = (code, self.runner.code.metered_offsets.get(code))
+        offsets = self.offsets[id(code)][1]
+        instrument_call = self.runner.instrument_call
+        profile = self.profile
+
+        def trace_opcode(frame, event, arg):
+            if event == "opcode" and (offsets is None or frame.f_lasti in offsets):
+                try:
+                    instrument_call()
+                except BaseException:
+                    sys.setprofile(profile)
+                    raise
+            return trace_opcode
+
+        frame.f_trace_lines = False
+        frame.f_trace_opcodes = True
+        frame.f_trace = trace_opcode
+        return trace_opcode
+
+    def profile(self, frame, event, arg):
+        if sys.gettrace() is not None:
+            return
+        sys.settrace(self.trace_call)
+        while frame is not None:
+            if is_bot_frame(frame):
+                self.trace_frame(frame)
+            frame = frame.f_back
+
+
+class MonitoringMetering(Metering):
+    """
+    Counts INSTRUCTION events with sys.monitoring (Python 3.12+). The events are only enabled for the code objects of
+    bots, so the engine runs at full speed. Robots with the same code share its code objects (see Game.code_for), so
+    the instructions are charged to the robot that is running, not to the one that enabled the events.
+    """
+    instrument_kwargs = {"instrument": False}
+
+    TOOL_ID = 2  # sys.monitoring.PROFILER_ID
+    # id(code) -> (weak reference to code, metered offsets), for every code object with events enabled
+    watched = {}
+    # the metering of the robot that is running right now
+    active = None
+
+    def __init__(self, runner):
+        super().__init__(runner)
+        MonitoringMetering.register_tool()
+        for code in runner.code.code.values():
+            self.watch(code)
+
+    @classmethod
+    def available(cls):
+        return hasattr(sys, "monitoring")
+
+    @classmethod
+    def register_tool(cls):
+        monitoring = sys.monitoring
+        if monitoring.get_tool(cls.TOOL_ID) == "malthusia":
+            return
+        monitoring.use_tool_id(cls.TOOL_ID, "malthusia")
+        monitoring.register_callback(cls.TOOL_ID, monitoring.events.INSTRUCTION, cls.instruction)
+        monitoring.register_callback(cls.TOOL_ID, monitoring.events.PY_START, cls.py_start)
+
+    def watch(self, code):
+        if id(code) in MonitoringMetering.watched:
+            return
+        ref = weakref.ref(code, lambda _, key=id(code): MonitoringMetering.watched.pop(key, None))
+        MonitoringMetering.watched[id(code)] = (ref, self.runner.code.metered_offsets.get(code))
+        sys.monitoring.set_local_events(self.TOOL_ID, code, sys.monitoring.events.INSTRUCTION)
+        for const in code.co_consts:
+            if isinstance(const, type(code)):
+                self.watch(const)
+
+    def start(self):
+        MonitoringMetering.active = self
+        # catches the code objects that are not watched yet, e.g. of functions restored from a checkpoint
+        sys.monitoring.set_events(self.TOOL_ID, sys.monitoring.events.PY_START)
+
+    def stop(self):
+        sys.monitoring.set_events(self.TOOL_ID, 0)
+        MonitoringMetering.active = None
+
+    @staticmethod
+    def instruction(code, offset):
+        active = MonitoringMetering.active
+        # bot code finalized between runs (e.g. a generator the bot dropped) is not charged to anyone
+        if active is None or not active.runner.running:
+            return
+        _, offsets = MonitoringMetering.watched[id(code)]
+        if offsets is None or offset in offsets:
+            active.runner.instrument_call()
+
+    @staticmethod
+    def py_start(code, offset):
+        active = MonitoringMetering.active
+        if active is not None and id(code) not in MonitoringMetering.watched and code in active.runner.code.metered_offsets:
+            active.watch(code)
+        return sys.monitoring.DISABLE
+
+
+METERING_BACKENDS = {
+    "bytecode": BytecodeMetering,
+    "basic_blocks": BasicBlockMetering,
+    "trace": TraceMetering,
+    "monitoring": MonitoringMetering,
+    "none": NoMetering,
+}
+
+
+def metering_backend(name):
+    """
+    :return: the Metering class called name in METERING_BACKENDS
+    :raises: ValueError if there is no such backend, or it is not available on this Python version
+    """
+    if name not in METERING_BACKENDS:
+        raise ValueError(f"Unknown metering backend {name}; choose one of {', '.join(METERING_BACKENDS)}.")
+    backend = METERING_BACKENDS[name]
+    if not backend.available():
+        raise ValueError(f"The {name} metering backend is not available on Python {sys.version.split()[0]}.")
+    return backend
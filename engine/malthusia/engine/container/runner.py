@@ -1,10 +1,13 @@
 import sys
+import contextlib
 import traceback
 import logging
 import collections.abc
 import re
 import os
 import random
+import functools
+import time
 
 from ..restrictedpython import safe_builtins, Guards
 from time import sleep
@@ -12,6 +15,8 @@ from .instrument import Instrument
 from .builtins import *
 from . import memory
 from .code_container import CodeContainer
+from .metering import metering_backend
+from . import state
 
 logger = logging.getLogger(__name__)
 
@@ -24,10 +29,30 @@ class RobotRunnerError(Exception):
 class RobotDied(Exception):
     pass
 
+
+@contextlib.contextmanager
+def quiet_finalizers():
+    """
+    Bot code that runs in a finalizer, e.g. of a generator the bot dropped, is stopped with OutOfBytecode if the bot is
+    out of bytecode or its turn is over. Python prints such exceptions as "Exception ignored in ...", but they are not
+    errors of the engine, so within this context they are not printed.
+    """
+    previous = sys.unraisablehook
+
+    def hook(unraisable):
+        if not isinstance(unraisable.exc_value, OutOfBytecode):
+            previous(unraisable)
+
+    sys.unraisablehook = hook
+    try:
+        yield
+    finally:
+        sys.unraisablehook = previous
+
 class RobotRunnerConfig:
 
     def __init__(self, starting_bytecode, bytecode_per_turn, max_bytecode, chess_clock_mechanism,
-                 memory_limit):
+                 memory_limit, metering="bytecode"):
         """
         Create a RobotRunner configuration.
         :param starting_bytecode: the amount of bytecode the robot starts with
@@ -35,12 +60,14 @@ class RobotRunnerConfig:
         :param max_bytecode: the max bytecode allowed for a single turn. caps the accumulation in chess mode. be cautious about setting this too high, as memory is currently only checked inter-turns and not intra-turns
         :param chess_clock_mechanism: if true, adds the last turn's unused bytecode to the next turn. otherwise does not.
         :param memory_limit: the max number of bytes allowed for a bot to persist in between turns
+        :param metering: how the bytecode is counted, one of METERING_BACKENDS. the code must have been compiled for it (see CodeContainer). every backend charges the same bytecode for the same turn, with two exceptions. with basic_blocks, an exception raised in the middle of a block costs up to the rest of the block extra. and the backends use different amounts of stack themselves, so a bot that recurses until RecursionError gets a different number of frames and exception handlers: on Python 3.11+ such a turn can cost up to about twice as much with one backend as with another (measured: 3455 bytecode with trace, 5439 with bytecode and 6433 with basic_blocks for a recursive try/except bot on 3.11; within 10 of each other on 3.9)
         """
         self.starting_bytecode = starting_bytecode
         self.bytecode_per_turn = bytecode_per_turn
         self.max_bytecode = max_bytecode
         self.chess_clock_mechanism = chess_clock_mechanism
         self.memory_limit = memory_limit
+        self.metering = metering
 
 class RobotRunner:
     """
@@ -126,7 +153,8 @@ class RobotRunner:
         self.globals['__builtins__']['__multinstrument__'] = self.multinstrument_call
         self.globals['__builtins__']['__import__'] = self.import_call
         self.globals['__builtins__']['_getitem_'] = self.getitem_call
-        self.globals['__builtins__']['_write_'] = lambda obj: self.write_call(obj, set(game_methods.values()))
+        game_method_values = set(game_methods.values())
+        self.globals['__builtins__']['_write_'] = lambda obj: self.write_call(obj, game_method_values)
         self.globals['__builtins__']['_getiter_'] = lambda i: i
         self.globals['__builtins__']['_inplacevar_'] = self.inplacevar_call
         self.globals['__builtins__']['_unpack_sequence_'] = Guards.guarded_unpack_sequence
@@ -151,9 +179,7 @@ class RobotRunner:
         for builtin in self.DISALLOWED_BUILTINS:
             del self.globals["__builtins__"][builtin]
 
-        logger.debug("BUILTINS")
         for builtin in self.globals['__builtins__']:
-            logger.debug(self.globals['__builtins__'][builtin])
             if builtin in self.NOT_INSTRUMENTED_BUILTINS:
                 continue
             elif builtin in self.BUILTIN_FUNCTIONS:
@@ -190,11 +216,20 @@ class RobotRunner:
         self.code = code
         self.imports = {}
 
+        if code.metering != config.metering:
+            raise RobotRunnerError(f"The code was compiled for {code.metering} metering, but the runner uses {config.metering} metering.")
+        self.metering = metering_backend(config.metering)(self)
+
         self.bytecode = self.config.starting_bytecode
         self.last_memory_usage = 0
+        # the bytecode used by the last run(), and the time it spent checking memory
+        self.last_bytecode_used = 0
+        self.last_memory_check_seconds = 0.0
 
         self.initialized = False
         self.killed = False
+        # only true during run(): bot code that runs at any other time (in a finalizer) is stopped without being charged
+        self.running = False
 
         self.debug = debug
 
@@ -315,6 +350,8 @@ class RobotRunner:
         return accessed[attribute]
 
     def instrument_call(self):
+        if not self.running:
+            self.stop_outside_run()
         self.bytecode -= 1
         self.check_bytecode()
 
@@ -342,6 +379,8 @@ class RobotRunner:
     def multinstrument_call(self, n):
         if n < 0:
             raise ValueError('n must be greater than or equal to 0')
+        if not self.running:
+            self.stop_outside_run()
         self.bytecode -= n
         self.check_bytecode()
 
@@ -349,6 +388,9 @@ class RobotRunner:
         if self.bytecode <= 0:
             raise OutOfBytecode(f'Ran out of bytecode. Remaining bytecode: {self.bytecode}')
 
+    def stop_outside_run(self):
+        raise OutOfBytecode('Robot code cannot run outside of its turn.')
+
     def import_call(self, name, globals=None, locals=None, fromlist=(), level=0, caller='robot'):
         if not isinstance(name, str) or not (isinstance(fromlist, tuple) or fromlist is None):
             raise ImportError('Invalid import.')
@@ -376,7 +418,8 @@ class RobotRunner:
             raise ImportError('Module "' + name + '" does not exist.')
 
         my_builtins = dict(self.globals['__builtins__'])
-        my_builtins['__import__'] = lambda n, g, l, f, le: self.import_call(n, g, l, f, le, caller=name)
+        # a partial rather than a lambda, so that the imported module can be checkpointed
+        my_builtins['__import__'] = functools.partial(self.import_call, caller=name)
         run_globals = {'__builtins__': my_builtins, '__name__': "DANGEROUS_" + name}
 
         # Loop check: keep dictionary of who imports who.  If loop, error.
@@ -436,13 +479,16 @@ class RobotRunner:
         error_str = traceback.format_exc(limit=1000)
         this_file = os.path.abspath(__file__)
         # remove apply_call, because it just clutters up everything while providing little of value
-        remove_apply = r'^\s*File "' + this_file.replace("/","\/") + r'", line \d+, in apply_call\s*\n\s*return func\(\*args, \*\*kwargs\)\s*\n'
+        # (python 3.11+ underlines the call with carets)
+        remove_apply = r'^\s*File "' + re.escape(this_file) + r'", line \d+, in apply_call\s*\n\s*return func\(\*args, \*\*kwargs\)\s*\n(\s*[~^]+\s*\n)?'
         modified_error_str = re.sub(remove_apply, "", error_str, flags=re.MULTILINE)
         self.error_method(modified_error_str)
 
 
     def check_memory(self):
+        start = time.perf_counter()
         mem_usage = memory.bytes_usage({k: v for k, v in self.globals.items() if k != "__builtins__"})
+        self.last_memory_check_seconds += time.perf_counter() - start
         if mem_usage > self.config.memory_limit:
             raise RobotRunnerError(f"Out of memory! Robot uses {mem_usage} bytes in round-persistent memory (e.g. globals), which is more than the allowed {self.config.memory_limit} bytes.")
         self.last_memory_usage = mem_usage
@@ -461,15 +507,51 @@ class RobotRunner:
         else:
             self.bytecode = self.config.bytecode_per_turn
         self.bytecode = min(self.config.max_bytecode, self.bytecode)
+        available = self.bytecode
+        self.last_memory_check_seconds = 0.0
 
-        if not self.initialized:
-            self.init_robot()
+        self.metering.start()
+        self.running = True
+        try:
+            with quiet_finalizers():
+                if not self.initialized:
+                    self.init_robot()
+
+                self.do_turn()
+        finally:
+            self.running = False
+            self.metering.stop()
+            self.last_bytecode_used = available - max(self.bytecode, 0)
 
-        self.do_turn()
+    def get_state(self):
+        """
+        :return: everything needed to continue running the robot in a new RobotRunner (created with the same code)
+        :raises: state.CheckpointError if the globals of the robot cannot be saved
+        """
+        if self.killed:
+            raise RuntimeError("Cannot get the state of a killed RobotRunner")
+        return {
+            "bytecode": self.bytecode,
+            "last_memory_usage": self.last_memory_usage,
+            "initialized": self.initialized,
+            "imports": {caller: set(names) for caller, names in self.imports.items()},
+            "globals": state.dump_globals(self),
+        }
+
+    def set_state(self, runner_state):
+        """
+        Restores a state returned by get_state. Must be called before the first run().
+        """
+        self.bytecode = runner_state["bytecode"]
+        self.last_memory_usage = runner_state["last_memory_usage"]
+        self.initialized = runner_state["initialized"]
+        self.imports = {caller: set(names) for caller, names in runner_state["imports"].items()}
+        state.load_globals(self, runner_state["globals"])
 
     def kill(self):
         logger.debug(f"Killing RobotRunner {self}")
         self.killed = True
-        # release some memory
-        del self.globals
+        # release some memory; this finalizes the objects of the bot
+        with quiet_finalizers():
+            del self.globals
         del self.code
@@ -0,0 +1,159 @@
+import importlib
+import io
+import marshal
+import pickle
+import types
+
+# marks an empty closure cell
+_EMPTY_CELL = ("__empty_cell__",)
+
+
+class CheckpointError(Exception):
+    """Raised when the state of a robot cannot be saved or restored"""
+    pass
+
+
+def is_bot_object(obj):
+    # everything defined by bot code lives in a module whose name starts with DANGEROUS_ (see RobotRunner)
+    return isinstance(getattr(obj, "__module__", None), str) and obj.__module__.startswith("DANGEROUS_")
+
+
+def make_function(code, globals, name, closure_size):
+    closure = tuple(types.CellType() for _ in range(closure_size)) if closure_size > 0 else None
+    return types.FunctionType(marshal.loads(code), globals, name, None, closure)
+
+
+def set_function_state(function, state):
+    function.__defaults__ = state["defaults"]
+    function.__kwdefaults__ = state["kwdefaults"]
+    function.__qualname__ = state["qualname"]
+    function.__module__ = state["module"]
+    function.__dict__.update(state["dict"])
+    for cell, contents in zip(function.__closure__ or (), state["closure"]):
+        if contents is not _EMPTY_CELL and contents != _EMPTY_CELL:
+            cell.cell_contents = contents
+
+
+def make_class(metaclass, name, bases, namespace):
+    return metaclass(name, bases, namespace)
+
+
+def set_class_state(cls, attributes):
+    for key, value in attributes.items():
+        setattr(cls, key, value)
+
+
+def make_module(name):
+    return types.ModuleType(name)
+
+
+def set_module_state(module, attributes):
+    module.__dict__.update(attributes)
+
+
+class RunnerPickler(pickle.Pickler):
+    """
+    Pickles the globals of a RobotRunner.
+
+    Functions, classes and modules defined by the bot cannot be pickled by reference, so they are pickled by value
+    (functions through their marshaled code). Everything the engine provides (the builtins, the game methods, the
+    globals dict itself) is stored as a reference, and resolved against the new runner when unpickling.
+    """
+
+    def __init__(self, file, runner):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.runner = runner
+        builtins = runner.globals["__builtins__"]
+        # id -> (object, persistent id); the object is kept so that we can check identity
+        self.references = {
+            id(runner): (runner, ("runner",)),
+            id(runner.globals): (runner.globals, ("globals",)),
+            id(builtins): (builtins, ("builtins",)),
+        }
+        for name, value in builtins.items():
+            if isinstance(value, (type(None), bool, int, float, str)):
+                continue
+            self.references.setdefault(id(value), (value, ("builtin", name)))
+
+    def persistent_id(self, obj):
+        reference = self.references.get(id(obj))
+        if reference is not None and reference[0] is obj:
+            return reference[1]
+        return None
+
+    def reducer_override(self, obj):
+        if isinstance(obj, types.FunctionType) and is_bot_object(obj):
+            closure = []
+            for cell in obj.__closure__ or ():
+                try:
+                    closure.append(cell.cell_contents)
+                except ValueError:
+                    closure.append(_EMPTY_CELL)
+            state = {
+                "defaults": obj.__defaults__,
+                "kwdefaults": obj.__kwdefaults__,
+                "qualname": obj.__qualname__,
+                "module": obj.__module__,
+                "dict": obj.__dict__,
+                "closure": tuple(closure),
+            }
+            args = (marshal.dumps(obj.__code__), obj.__globals__, obj.__name__, len(closure))
+            return make_function, args, state, None, None, set_function_state
+        if isinstance(obj, type) and is_bot_object(obj):
+            namespace = {"__module__": obj.__module__, "__qualname__": obj.__qualname__}
+            if "__slots__" in obj.__dict__:
+                namespace["__slots__"] = obj.__dict__["__slots__"]
+            slots = namespace.get("__slots__", ())
+            slots = (slots,) if isinstance(slots, str) else tuple(slots)
+            attributes = {k: v for k, v in obj.__dict__.items()
+                          if k not in ("__dict__", "__weakref__", "__module__", "__qualname__", "__slots__")
+                          and k not in slots}
+            return make_class, (type(obj), obj.__name__, obj.__bases__, namespace), attributes, None, None, set_class_state
+        if isinstance(obj, types.ModuleType):
+            if obj.__name__ == "math":
+                return importlib.import_module, ("math",)
+            if is_bot_object(obj) or obj.__name__.startswith("DANGEROUS_"):
+                return make_module, (obj.__name__,), dict(obj.__dict__), None, None, set_module_state
+        return NotImplemented
+
+
+class RunnerUnpickler(pickle.Unpickler):
+
+    def __init__(self, file, runner):
+        super().__init__(file)
+        self.runner = runner
+
+    def persistent_load(self, pid):
+        kind = pid[0]
+        if kind == "runner":
+            return self.runner
+        if kind == "globals":
+            return self.runner.globals
+        if kind == "builtins":
+            return self.runner.globals["__builtins__"]
+        if kind == "builtin":
+            return self.runner.globals["__builtins__"][pid[1]]
+        raise pickle.UnpicklingError(f"Unknown persistent id {pid}")
+
+
+def dump_globals(runner) -> bytes:
+    """
+    :return: the bot-defined globals of the runner (everything except __builtins__), pickled
+    """
+    f = io.BytesIO()
+    try:
+        RunnerPickler(f, runner).dump({k: v for k, v in runner.globals.items() if k != "__builtins__"})
+    except (pickle.PicklingError, TypeError, AttributeError, ValueError) as e:
+        raise CheckpointError(f"Cannot save the state of the robot: {e}") from e
+    return f.getvalue()
+
+
+def load_globals(runner, data: bytes):
+    """
+    Restores globals pickled by dump_globals into the runner.
+    """
+    try:
+        user_globals = RunnerUnpickler(io.BytesIO(data), runner).load()
+    except (pickle.UnpicklingError, TypeError, AttributeError, ValueError, KeyError) as e:
+        raise CheckpointError(f"Cannot restore the state of the robot: {e}") from e
+    runner.globals.update(user_globals)
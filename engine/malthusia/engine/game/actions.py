@@ -0,0 +1,112 @@
+import heapq
+import json
+import time
+from typing import Dict, List
+
+
+class ActionLog:
+    """
+    ActionLog ingests the append-only action file (one JSON action per line, each terminated by a newline).
+
+    The file is kept open, and every poll only reads the bytes appended since the previous one. A trailing line that
+    has not been terminated yet is kept back until the rest of it has been written, so a half-written action is never
+    parsed. Ingested actions wait in a heap ordered by round (ties broken by the order in the file) until their round.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+        # the file offset right after the last complete line we have ingested
+        self.offset = 0
+        self.partial = b""
+        # heap of (round, sequence number, action)
+        self.pending = []
+        self.sequence = 0
+
+        # ingestion statistics
+        self.polls = 0
+        self.actions_ingested = 0
+        self.last_ingest_seconds = 0.0
+        self.total_ingest_seconds = 0.0
+
+    def poll(self) -> List[Dict]:
+        """
+        Reads and parses all complete lines appended to the file since the last poll.
+        :return: the new actions, in file order
+        """
+        start = time.perf_counter()
+
+        if self.file is None:
+            self.file = open(self.filename, "rb")
+            self.file.seek(self.offset)
+
+        data = self.file.read()
+        actions = []
+        if len(data) > 0:
+            data = self.partial + data
+            end = data.rfind(b"\n")
+            if end == -1:
+                self.partial = data
+            else:
+                complete, self.partial = data[:end], data[end + 1:]
+                self.offset += end + 1
+                actions = self.parse([line for line in complete.split(b"\n") if line.strip()])
+
+        self.polls += 1
+        self.actions_ingested += len(actions)
+        self.last_ingest_seconds = time.perf_counter() - start
+        self.total_ingest_seconds += self.last_ingest_seconds
+
+        return actions
+
+    @staticmethod
+    def parse(lines: List[bytes]) -> List[Dict]:
+        if len(lines) == 0:
+            return []
+        try:
+            # parsing everything as one big array is a lot faster than calling json.loads once per line
+            return json.loads(b"[" + b",".join(lines) + b"]")
+        except json.JSONDecodeError:
+            # find the offending line, so that the error is meaningful
+            return [json.loads(line) for line in lines]
+
+    def push(self, action: Dict):
+        heapq.heappush(self.pending, (action["round"], self.sequence, action))
+        self.sequence += 1
+
+    def pop_due(self, round: int) -> List[Dict]:
+        """
+        Removes and returns all pending actions for this round or earlier, in round order.
+        """
+        due = []
+        while len(self.pending) > 0 and self.pending[0][0] <= round:
+            due.append(heapq.heappop(self.pending)[2])
+        return due
+
+    def get_state(self):
+        """
+        The state for a checkpoint: the file offset and the actions that have been ingested but not yet processed.
+        A trailing partial line is not included; it is read again from the file after restoring.
+        """
+        return {"offset": self.offset, "pending": list(self.pending), "sequence": self.sequence}
+
+    def set_state(self, state):
+        self.close()
+        self.offset = state["offset"]
+        self.partial = b""
+        self.pending = list(state["pending"])
+        heapq.heapify(self.pending)
+        self.sequence = state["sequence"]
+
+    def reopen(self):
+        """
+        Reads the file again from the offset after the last complete line, with a file object of our own.
+        Needed after a fork, since the forked processes share the position of the open file.
+        """
+        self.close()
+        self.partial = b""
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
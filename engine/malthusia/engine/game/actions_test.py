@@ -0,0 +1,38 @@
+import json
+
+from .actions import ActionLog
+
+
+def test_partial_lines_are_held_back(tmp_path):
+    filename = tmp_path / "actions.jsonl"
+    first = json.dumps({"type": "new_robot", "round": 2})
+    second = json.dumps({"type": "new_robot", "round": 1, "uid": "x" * 100})
+    filename.write_text("")
+    log = ActionLog(filename)
+    assert log.poll() == []
+
+    with open(filename, "a") as f:
+        f.write(first + "\n" + second[:40])
+    assert log.poll() == [json.loads(first)]
+    assert log.offset == len(first) + 1
+
+    with open(filename, "a") as f:
+        f.write(second[40:])
+    assert log.poll() == []
+
+    with open(filename, "a") as f:
+        f.write("\n\n")
+    assert log.poll() == [json.loads(second)]
+    assert log.poll() == []
+    assert log.actions_ingested == 2
+    assert log.total_ingest_seconds >= log.last_ingest_seconds
+
+
+def test_pending_actions_are_ordered_by_round(tmp_path):
+    log = ActionLog(tmp_path / "actions.jsonl")
+    for i, round in enumerate([3, 1, 2, 1, 5]):
+        log.push({"round": round, "i": i})
+    assert [a["i"] for a in log.pop_due(1)] == [1, 3]
+    assert log.pop_due(1) == []
+    assert [a["i"] for a in log.pop_due(4)] == [2, 0]
+    assert [a["i"] for a in log.pop_due(5)] == [4]
@@ -35,4 +35,7 @@ class GameConstants:
     # a robot can see all locations within a euclidean distance of their vision radius (<=)
     VISION_RADIUS = {
         RobotType.WANDERER: 5
-    }
\ No newline at end of file
+    }
+
+    # the bytecode charged for sense_locations(), regardless of how many locations are visible
+    SENSE_LOCATIONS_BYTECODE = 100
@@ -1,59 +1,141 @@
 import random
 import logging
 import base64
-import json
+import os
+import pickle
+import time
+import functools
+import hashlib
+import weakref
+from typing import Dict, Optional, Tuple
 
 from .robot import Robot, RobotError
 from .robottype import RobotType
 from .constants import GameConstants
-from ..container.runner import RobotRunner
+from ..container.runner import RobotRunner, RobotDied
 from .commonrobot import CommonRobot
-from .wanderer import Wanderer
+from .wanderer import Wanderer, DROWNED
 from .map import Map
+from .graveyard import Graveyard
+from .actions import ActionLog
+from .parallel import TurnPool
 from ..container.code_container import CodeContainer
+from ..container.state import CheckpointError
+from ..container.metering import metering_backend
 from .direction import Direction
 from .location import LocationInfo
+from ..replay.delta import DeltaEncoder
 
 logger = logging.getLogger(__name__)
 
+# bump whenever the layout of checkpoints changes
+CHECKPOINT_VERSION = 3
+
 
 def new_uid():
     return base64.b64encode(random.randbytes(64)).decode("utf-8")
 
 
+# the classes whose public methods make up the game methods of each robot type
+ROBOT_CLASSES = {
+    RobotType.WANDERER: (CommonRobot, Wanderer),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def game_method_names(cls) -> Tuple[str, ...]:
+    """
+    :return: the names of the public methods of cls, which are exposed to robots as game methods
+    """
+    return tuple(name for name in dir(cls) if not name.startswith("_") and callable(getattr(cls, name)))
+
+
+class GameMethod:
+    """
+    A game method bound to a robot, as called by the robot's code.
+    The attributes are private so that robot code, which cannot access names starting with "_", cannot reach them.
+    """
+    __slots__ = ("_robot", "_method", "_count_calls")
+
+    def __init__(self, robot, method, count_calls):
+        self._robot = robot
+        self._method = method
+        self._count_calls = count_calls
+
+    def __call__(self, *args):
+        if self._count_calls:
+            self._robot.api_calls += 1
+        RobotRunner.validate_arguments(*args, error_type=RobotRunner)
+        return self._method(*args)
+
+
+def bind_game_methods(target, robot, count_calls) -> Dict[str, GameMethod]:
+    """
+    :param target: an instance of one of ROBOT_CLASSES, e.g. Wanderer(game, robot)
+    :param count_calls: whether to count the calls in robot.api_calls, for telemetry
+    :return: method name -> bound game method, for every public method of target
+    """
+    return {name: GameMethod(robot, getattr(target, name), count_calls) for name in game_method_names(type(target))}
+
+
 class Game:
 
     def __init__(self, action_file, map_file=GameConstants.STARTING_MAPFILE, seed=GameConstants.DEFAULT_SEED,
-                 debug=False, colored_logs=True, round_callback=None):
+                 debug=False, colored_logs=True, round_callback=None, keyframe_interval=None, workers=0,
+                 telemetry_callback=None, metering="bytecode", code_cache=None):
         random.seed(seed)
 
         self.action_file = action_file
-        self.action_file_offset = 0
-        self.deferred_actions = {}
+        self.actions = ActionLog(action_file)
 
         self.debug = debug
         self.colored_logs = colored_logs
 
         self.queue = []  # invariant: all alive robots are here; there may be newly killed robots here too
-        self.dead_robots = []  # invariant: all robots here are dead; all dead robots are here
+        self.graveyard = Graveyard()  # invariant: every dead robot is buried here, and nothing else
+        # the graves of the robots that died during the current round
+        self.round_deaths = []
 
         self.map = Map.from_file(map_file)
+        # the (x, y) of every location that changed during the last round
+        self.round_changes = self.map.drain_changes()
 
         self.round = 0
 
         self.round_callback = round_callback
+        # if set, called after every round with the timing and bytecode of every robot, see turn()
+        self.telemetry_callback = telemetry_callback
+        # if set, rounds are delta-encoded with a full keyframe every keyframe_interval rounds
+        self.replay_encoder = DeltaEncoder(keyframe_interval) if keyframe_interval is not None else None
+        # how the bytecode of the robots is counted, see METERING_BACKENDS
+        metering_backend(metering)
+        self.metering = metering
+        # if set, a CodeCache that spares compiling the code of new robots that has been seen before
+        self.code_cache = code_cache
+        # the code of the live robots by the hash of its source, so that robots with the same code share it, see code_for
+        self.codes = weakref.WeakValueDictionary()
+
+        # simultaneous turns: if workers > 0, robots run in that many worker processes, see TurnPool
+        self.workers = workers
+        self.pool = None
+        # the index of this worker process, in a worker process
+        self.worker_index = None
+        # robots are assigned to workers round-robin, in spawn order
+        self.next_worker = 0
+        # while a worker runs its robots: the recorded moves and deaths, and the queue position of the running robot
+        self.intents = None
+        self.running_position = None
 
         if self.debug:
             self.log_info(f'Seed: {seed}')
 
     def check_actions(self):
-        with open(self.action_file, "r") as f:
-            f.seek(self.action_file_offset)
-            for l in f.readlines():
-                action = json.loads(l)
-                self.process_action(action)
-            self.action_file_offset = f.tell()
-        self.process_actions()
+        """
+        :return: the actions that were due this round
+        """
+        for action in self.actions.poll():
+            self.process_action(action)
+        return self.process_actions()
 
     def process_action(self, action):
         if "type" not in action:
@@ -61,35 +143,84 @@ class Game:
         if "round" not in action or type(action["round"]) is not int:
             raise GameError(f"Action object does not have a valid round attribute: {action}")
         if action["round"] < self.round:
-            # if this happens we are screwed
-            raise GameError(
+            # if this happens we are screwed, unless we can go back to before that round (see SnapshotManager)
+            raise ActionFromPastError(action["round"],
                 f"We received action from the past. This is not good. We need to rerun everything. Action: {action}")
-        if action["round"] not in self.deferred_actions:
-            self.deferred_actions[action["round"]] = []
-        self.deferred_actions[action["round"]].append(action)
+        self.actions.push(action)
 
     def process_actions(self):
-        if self.round not in self.deferred_actions:
-            return
-        for action in self.deferred_actions[self.round]:
+        actions = self.actions.pop_due(self.round)
+        self.apply_actions(actions)
+        return actions
+
+    def apply_actions(self, actions):
+        for action in actions:
             if action["type"] == "new_robot":
                 # TODO: add some kind of error handling here
-                code = CodeContainer.from_dirfile(action["code"])
+                # with simultaneous turns, only the process that will run the robot needs its code
+                code = self.code_for(action["code"]) if self.runs_next_robot() else None
                 robot_type = RobotType(action["robot_type"])
                 self.new_robot(action["creator"], code, robot_type, action["uid"])
             else:
                 raise GameError(f"Action object type attribute is unintelligible: {action}")
-        del self.deferred_actions[self.round]
+
+    def code_for(self, dirfile) -> CodeContainer:
+        """
+        :return: the code compiled from dirfile. Robots with the same code share one CodeContainer, which is compiled
+                 when the first of them is created and freed when the last of them is gone.
+        """
+        key = hashlib.sha256(dirfile.encode("utf-8")).hexdigest()
+        code = self.codes.get(key)
+        if code is None:
+            code = CodeContainer.from_dirfile(dirfile, metering=self.metering, cache=self.code_cache)
+            self.codes[key] = code
+        return code
 
     def turn(self):
+        """
+        Plays a round. If there is a telemetry_callback, it is called with
+        {"round": ..., "seconds": ..., "robots": [{"position", "id", "creator", "seconds", "bytecode_used",
+                                                   "api_calls", "memory_check_seconds"}, ...]}
+        where robots has an entry for every robot that ran, in queue order.
+        """
+        if self.workers > 0 and self.pool is None:
+            self.start_pool()
+
+        start = time.perf_counter()
         self.round += 1
+        self.round_deaths = []
 
-        self.check_actions()
+        actions = self.check_actions()
 
         if self.debug:
             self.log_info(f'Turn {self.round}')
             self.log_info(f'Queue: {self.queue}')
 
+        if self.pool is None:
+            telemetry = self.run_robots()
+        else:
+            self.new_round_seed()
+            intents, telemetry = self.pool.run_round(actions)
+            self.apply_intents(intents)
+            self.pool.apply(intents)
+
+        self.end_round()
+
+        if self.round_callback is not None:
+            self.round_callback(self.serialize_round())
+
+        if self.telemetry_callback is not None:
+            self.telemetry_callback({
+                "round": self.round,
+                "seconds": time.perf_counter() - start,
+                "robots": telemetry,
+            })
+
+    def run_robots(self):
+        """
+        :return: the telemetry of every robot that ran, or None if telemetry is disabled
+        """
+        telemetry = [] if self.telemetry_callback is not None else None
         # invariants: we never remove from the queue while iterating here;
         #             we may add to the end (robot spawn other robot), which is why we are not using iterators
         i = 0
@@ -97,9 +228,29 @@ class Game:
             robot = self.queue[i]
             # this robot may have been killed
             if robot.alive:
-                robot.turn()
+                if telemetry is None:
+                    robot.turn()
+                else:
+                    start = time.perf_counter()
+                    robot.api_calls = 0
+                    robot.turn()
+                    telemetry.append(self.robot_telemetry(i, robot, time.perf_counter() - start))
             i += 1
+        return telemetry
 
+    @staticmethod
+    def robot_telemetry(position, robot, seconds):
+        return {
+            "position": position,
+            "id": robot.id,
+            "creator": robot.creator,
+            "seconds": seconds,
+            "bytecode_used": robot.last_bytecode_used,
+            "api_calls": robot.api_calls,
+            "memory_check_seconds": robot.last_memory_check_seconds,
+        }
+
+    def end_round(self):
         # invariant: we never change the queue while iterating here
         newqueue = []
         for robot in self.queue:
@@ -107,14 +258,128 @@ class Game:
                 newqueue.append(robot)
         self.queue = newqueue
 
-        if self.round_callback is not None:
-            self.round_callback(self.serialize_round())
+        self.round_changes = self.map.drain_changes()
+
+    def start_pool(self):
+        self.pool = TurnPool(self, self.workers)
+        # from now on, the robots only run (and log) in their workers
+        for robot in self.queue:
+            robot.debug = robot.debug and self.runs_robot(robot)
+
+    def become_worker(self, index):
+        """
+        Called in a freshly forked worker process of the TurnPool.
+        """
+        self.worker_index = index
+        self.pool = None
+        self.round_callback = None
+        self.replay_encoder = None
+        for robot in self.queue:
+            robot.debug = self.debug and self.runs_robot(robot)
+
+    def runs_robot(self, robot):
+        """
+        :return: whether the code of the robot runs in this process
+        """
+        if self.pool is None and self.worker_index is None:
+            return True
+        return robot.worker == self.worker_index
+
+    def runs_next_robot(self):
+        """
+        :return: whether the code of the next robot that is created will run in this process (see create_robot)
+        """
+        if self.workers == 0 or (self.pool is None and self.worker_index is None):
+            return True
+        return self.next_worker % self.workers == self.worker_index
+
+    def new_round_seed(self):
+        # every replica draws it at the same point, so that their random states stay the same
+        return random.getrandbits(64)
+
+    def run_worker_round(self, actions):
+        """
+        Plays the first half of a simultaneous round in a worker: applies the due actions and runs the robots this
+        worker owns against the map as it is at the start of the round.
+        :return: the intents of the robots (see TurnPool), and their telemetry (None if telemetry is disabled)
+        """
+        self.round += 1
+        self.apply_actions(actions)
+        round_seed = self.new_round_seed()
+
+        self.intents = []
+        telemetry = [] if self.telemetry_callback is not None else None
+        for i, robot in enumerate(self.queue):
+            if not robot.alive or not self.runs_robot(robot):
+                continue
+            self.running_position = i
+            # the randomness a robot sees must not depend on which other robots share its worker
+            random_state = random.getstate()
+            random.seed(f"{round_seed}:{i}")
+            start = time.perf_counter()
+            robot.api_calls = 0
+            error = robot.run_turn()
+            if telemetry is not None:
+                telemetry.append(self.robot_telemetry(i, robot, time.perf_counter() - start))
+            random.setstate(random_state)
+            if error is not None:
+                self.intents.append(("kill", i, str(error), not isinstance(error, RobotDied)))
+        intents = self.intents
+        self.intents = None
+        self.running_position = None
+        return intents, telemetry
+
+    def record_move(self, robot, new_x, new_y):
+        self.intents.append(("move", self.running_position, new_x, new_y))
+
+    def apply_intents(self, intents):
+        """
+        Applies the moves and deaths of a simultaneous round, in queue order.
+        """
+        for intent in intents:
+            kind, robot = intent[0], self.queue[intent[1]]
+            if not robot.alive:
+                continue
+            if kind == "move":
+                new_x, new_y = intent[2], intent[3]
+                if self.map.robot_at(new_x, new_y) is not None:
+                    # a robot earlier in the queue got there first, or did not leave; the move does not happen
+                    continue
+                self.move_robot(robot, new_x, new_y)
+                if self.map.water_at(new_x, new_y):
+                    robot.kill(reason=DROWNED)
+            elif kind == "kill":
+                message, fatal = intent[2], intent[3]
+                if fatal:
+                    robot.fatal_error(message)
+                    robot.kill()
+                else:
+                    robot.kill(reason=message)
+
+    def move_robot(self, robot, new_x, new_y):
+        x, y = robot.x, robot.y
+        robot.x = new_x
+        robot.y = new_y
+        self.map.set_robot(new_x, new_y, robot)
+        self.map.set_robot(x, y, None)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        self.actions.close()
 
     def serialize_round(self):
-        return {
-            "round": self.round,
-            "map": self.map.serialize(),
-        }
+        if self.replay_encoder is not None:
+            serialized = self.replay_encoder.encode(self.round, self.map, self.round_changes)
+        else:
+            serialized = {
+                "round": self.round,
+                "map": self.map.serialize(),
+            }
+        # every dead robot is in the replay exactly once, in the round it died
+        serialized["deaths"] = [grave.serialize() for grave in self.round_deaths]
+        return serialized
 
     def log_info(self, msg):
         if self.colored_logs:
@@ -123,26 +388,39 @@ class Game:
             print(f'[Game info] {msg}')
 
     def new_robot_xy(self):
-        # generate a random location in [-100,100]x[-100,100], making sure the location is free
-        sz = 100
-        max_tries = sz * sz * 5
-        i = 0
-        while i < max_tries:
-            x, y = random.randint(-sz, sz), random.randint(-sz, sz)
-            if self.map.spawnable(x, y):
-                return x, y
-            i += 1
-        raise GameError(f"Cannot spawn robot; no spawnable location found after {max_tries} tries.")
+        # pick a uniformly random free location
+        xy = self.map.random_spawnable_location(random)
+        if xy is None:
+            raise GameError("Cannot spawn robot; there is no spawnable location left.")
+        return xy
 
     def new_robot(self, creator: str, code: CodeContainer, robot_type: RobotType, uid: str):
         x, y = self.new_robot_xy()
 
-        def kill_robot_callback(robot):
-            assert not robot.alive
-            self.map.remove_robot(robot)
-            self.dead_robots.append(robot)
+        robot = self.create_robot(x, y, creator, code, robot_type, uid)
+
+        self.queue.append(robot)
+        self.map.add_robot(robot, x, y)
 
-        robot = Robot(x, y, uid, creator, robot_type, kill_robot_callback)
+    def kill_robot_callback(self, robot):
+        assert not robot.alive
+        self.map.remove_robot(robot)
+        # the robot itself is released once the queue drops it at the end of the round
+        self.round_deaths.append(self.graveyard.add(robot, self.round))
+
+    def create_robot(self, x, y, creator: str, code: Optional[CodeContainer], robot_type: RobotType, uid: str):
+        """
+        Creates and animates a robot, without adding it to the queue or the map.
+        :param code: may be None if the robot does not run in this process, see runs_next_robot
+        """
+        robot = Robot(x, y, uid, creator, robot_type, self.kill_robot_callback)
+        if self.workers > 0:
+            robot.worker = self.next_worker % self.workers
+            self.next_worker += 1
+        if not self.runs_robot(robot):
+            # another process runs the robot, so there is no need to compile its code or bind its methods here
+            robot.animate_replica()
+            return robot
 
         methods = {
             'GameError': GameError,
@@ -152,41 +430,114 @@ class Game:
             'Direction': Direction,
             'LocationInfo': LocationInfo,
         }
-
-        logger.debug(methods)
-
-        def wrapper_method(modelrobot, method, *args):
-            logger.debug(method)
-            RobotRunner.validate_arguments(*args, error_type=RobotRunner)
-            return getattr(modelrobot, method)(*args)
-
-        def wrap_methods(modelrobot):
-            wrapped_methods = {}
-            for method in [m for m in dir(modelrobot) if callable(getattr(modelrobot, m)) and not m.startswith("_")]:
-                logger.debug(method)
-                logger.debug(type(method))
-                wrapped_methods[method] = (
-                    lambda modelrobot, method: lambda *args: wrapper_method(modelrobot, method, *args))(modelrobot,
-                                                                                                        method)
-            logger.debug(wrapped_methods)
-            return wrapped_methods
-
-        methods.update(wrap_methods(CommonRobot(self, robot)))
-        logger.debug(methods)
-
-        if robot_type == RobotType.WANDERER:
-            methods.update(wrap_methods(Wanderer(self, robot)))
-        else:
+        if robot_type not in ROBOT_CLASSES:
             raise NotImplementedError
-
-        logger.debug(methods)
+        count_calls = self.telemetry_callback is not None
+        for cls in ROBOT_CLASSES[robot_type]:
+            methods.update(bind_game_methods(cls(self, robot), robot, count_calls))
 
         robot.animate(code, methods, debug=self.debug)
 
-        self.queue.append(robot)
-        self.map.add_robot(robot, x, y)
+        return robot
+
+    def checkpoint(self, path, metadata=None):
+        """
+        Saves the full state of the game in between two rounds, so that it can be continued later with restore().
+        The file is replaced atomically, so a crash while checkpointing never leaves a corrupt checkpoint behind.
+        :param metadata: anything picklable, returned again by restore()
+        :raises: GameError if the state of some robot cannot be saved
+        """
+        if self.pool is not None:
+            raise GameError("Cannot checkpoint a game with simultaneous turns: the robots live in the worker processes.")
+        robots = []
+        for robot in self.queue:
+            if not robot.alive:
+                continue
+            if robot.runner.code.source is None:
+                raise GameError(f"Cannot checkpoint robot {robot.id}: the source of its code is unknown.")
+            try:
+                runner_state = robot.runner.get_state()
+            except CheckpointError as e:
+                raise GameError(f"Cannot checkpoint robot {robot.id}: {e}") from e
+            robots.append({
+                "robot": robot.serialize(),
+                "has_moved": robot.has_moved,
+                "code": robot.runner.code.source,
+                "runner": runner_state,
+            })
+
+        state = {
+            "version": CHECKPOINT_VERSION,
+            "round": self.round,
+            "random": random.getstate(),
+            "robots": robots,
+            "graveyard": self.graveyard.get_state(),
+            "map": self.map.get_state(),
+            "actions": self.actions.get_state(),
+            "metadata": metadata,
+        }
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def resume_from_snapshot(self):
+        """
+        Called in a forked snapshot of the game when it is resumed, before it plays another round.
+        """
+        self.actions.reopen()
+        if self.replay_encoder is not None:
+            # readers have seen the rounds the discarded process played after the snapshot, so start with a keyframe
+            self.replay_encoder = DeltaEncoder(self.replay_encoder.keyframe_interval)
+
+    def restore(self, path):
+        """
+        Replaces the state of this game with a checkpoint saved by checkpoint(). The game continues exactly as the
+        checkpointed game would have: the next turn() plays the round after the checkpointed one.
+        The action file, callbacks and replay settings of this game are kept.
+        :return: the metadata passed to checkpoint()
+        """
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        if state.get("version") != CHECKPOINT_VERSION:
+            raise GameError(f"Checkpoint {path} has version {state.get('version')}, expected {CHECKPOINT_VERSION}.")
+
+        queue = []
+        for robot_state in state["robots"]:
+            r = robot_state["robot"]
+            code = self.code_for(robot_state["code"])
+            robot = self.create_robot(r["x"], r["y"], r["creator"], code, RobotType(r["type"]), r["id"])
+            robot.has_moved = robot_state["has_moved"]
+            try:
+                robot.runner.set_state(robot_state["runner"])
+            except CheckpointError as e:
+                raise GameError(f"Cannot restore robot {robot.id}: {e}") from e
+            queue.append(robot)
+
+        self.queue = queue
+        self.graveyard = Graveyard.from_state(state["graveyard"])
+        self.round_deaths = []
+        self.map = Map.from_state(state["map"], queue)
+        self.round_changes = self.map.drain_changes()
+        self.actions.set_state(state["actions"])
+        self.round = state["round"]
+        if self.replay_encoder is not None:
+            # the first round after restoring has to be a keyframe, since readers may not have seen the earlier ones
+            self.replay_encoder = DeltaEncoder(self.replay_encoder.keyframe_interval)
+        random.setstate(state["random"])
+
+        return state["metadata"]
 
 
 class GameError(Exception):
     """Raised for errors that arise within the Game"""
     pass
+
+
+class ActionFromPastError(GameError):
+    """Raised when an action arrives for a round that has already been played"""
+
+    def __init__(self, round, message):
+        super().__init__(message)
+        self.round = round
@@ -0,0 +1,293 @@
+import gc
+import json
+import sys
+
+import pytest
+
+from .constants import GameConstants
+from .game import Game, GameError
+from ..container.code_container import CodeContainer
+from ..container.metering import METERING_BACKENDS
+
+STATEFUL_BOT = {
+    "bot.py": """
+import random
+
+dirs = [Direction.NORTH, Direction.EAST, Direction.SOUTH, Direction.WEST]
+
+
+class Walker:
+    def __init__(self, start):
+        self.steps = start
+
+    def next(self):
+        self.steps = self.steps + 1
+        return self.steps
+
+
+def make_counter():
+    count = []
+
+    def counter():
+        count.append(1)
+        return len(count)
+    return counter
+
+
+walker = Walker(3)
+counter = make_counter()
+history = []
+
+
+def turn():
+    import helper
+    n = walker.next() + counter() + helper.offset(len(history))
+    history.append(n)
+    move(dirs[(n + random.randint(0, 3)) % 4])
+""",
+    "helper.py": """
+def offset(n, k=2):
+    return n * k
+""",
+}
+
+
+def write_actions(path, n):
+    dirfile = CodeContainer.directory_dict_to_dirfile(STATEFUL_BOT)
+    with open(path, "w") as f:
+        for i in range(n):
+            action = {"type": "new_robot", "round": 1 + i % 4, "robot_type": 0, "creator": "p", "uid": f"u{i}",
+                      "code": dirfile}
+            f.write(json.dumps(action) + "\n")
+
+
+def play(game, rounds):
+    records = []
+    game.round_callback = lambda r: records.append(json.dumps(r, sort_keys=True))
+    for _ in range(rounds):
+        game.turn()
+    return records
+
+
+def test_checkpoint_restore(tmp_path):
+    action_file = tmp_path / "actions.jsonl"
+    write_actions(action_file, 12)
+
+    original = Game(action_file, seed=7, keyframe_interval=5)
+    play(original, 3)
+    original.checkpoint(tmp_path / "round3.ckpt", metadata={"replay_size": 123})
+    expected = play(original, 8)
+
+    restored = Game(action_file, seed=1, keyframe_interval=5)
+    assert restored.restore(tmp_path / "round3.ckpt") == {"replay_size": 123}
+    assert restored.round == 3
+    actual = play(restored, 8)
+
+    # the first round after restoring is a keyframe, so only compare the reconstructed maps
+    assert json.loads(actual[0])["keyframe"]
+    assert json.loads(actual[0])["map"] == original_map_after(action_file, 4)
+    assert actual[1:] == expected[1:]
+
+
+def original_map_after(action_file, rounds):
+    game = Game(action_file, seed=7)
+    records = play(game, rounds)
+    return json.loads(records[-1])["map"]
+
+
+def test_checkpoint_unpicklable_state(tmp_path):
+    action_file = tmp_path / "actions.jsonl"
+    dirfile = CodeContainer.directory_dict_to_dirfile({"bot.py": """
+def numbers():
+    yield 1
+
+gen = numbers()
+
+def turn():
+    pass
+"""})
+    with open(action_file, "w") as f:
+        f.write(json.dumps({"type": "new_robot", "round": 1, "robot_type": 0, "creator": "p", "uid": "g",
+                            "code": dirfile}) + "\n")
+    game = Game(action_file)
+    game.turn()
+    with pytest.raises(GameError):
+        game.checkpoint(tmp_path / "game.ckpt")
+    assert not (tmp_path / "game.ckpt").exists()
+
+
+def idle_game(tmp_path, robots, **kwargs):
+    action_file = tmp_path / "actions.jsonl"
+    dirfile = CodeContainer.directory_dict_to_dirfile({"bot.py": "def turn():\n    pass\n"})
+    with open(action_file, "w") as f:
+        for i in range(robots):
+            f.write(json.dumps({"type": "new_robot", "round": 1, "robot_type": 0, "creator": "p", "uid": f"r{i}",
+                                "code": dirfile}) + "\n")
+    return Game(action_file, **kwargs)
+
+
+def test_apply_intents_in_queue_order(tmp_path):
+    game = idle_game(tmp_path, 2)
+    game.turn()
+    first, second = game.queue
+    x, y = game.map.free_land[0]
+    water = next((x, y) for x, y in [(first.x + dx, first.y) for dx in range(100)] if game.map.water_at(x, y))
+
+    game.apply_intents([("move", 0, x, y), ("move", 1, x, y)])
+    assert (first.x, first.y) == (x, y)
+    assert game.map.robot_at(x, y) is first
+    assert second.alive and game.map.robot_at(second.x, second.y) is second
+
+    game.apply_intents([("move", 1, *water), ("kill", 0, "out of memory", True)])
+    assert not first.alive and not second.alive
+    assert game.map.robot_at(x, y) is None
+
+
+def test_simultaneous_turns_do_not_depend_on_workers(tmp_path):
+    write_actions(tmp_path / "actions.jsonl", 6)
+    results = []
+    for workers in [1, 2]:
+        game = Game(tmp_path / "actions.jsonl", seed=3, workers=workers)
+        try:
+            results.append(play(game, 6))
+            # the robots only run, and are only compiled, in the workers
+            assert all(robot.replica and robot.runner is None for robot in game.queue)
+        finally:
+            game.close()
+    assert results[0] == results[1]
+
+
+def test_telemetry(tmp_path):
+    write_actions(tmp_path / "actions.jsonl", 3)
+    records = []
+    game = Game(tmp_path / "actions.jsonl", telemetry_callback=records.append)
+    play(game, 2)
+    assert [r["round"] for r in records] == [1, 2]
+    robots = records[0]["robots"]
+    assert [r["position"] for r in robots] == [0]
+    assert robots[0]["id"] == "u0"
+    # move() is the only game method the bot calls
+    assert robots[0]["api_calls"] == 1
+    assert robots[0]["bytecode_used"] > 0
+    assert robots[0]["seconds"] >= robots[0]["memory_check_seconds"] > 0
+    assert len(records[1]["robots"]) == 2
+
+
+def test_deaths_are_in_the_replay_once(tmp_path):
+    action_file = tmp_path / "actions.jsonl"
+    dirfile = CodeContainer.directory_dict_to_dirfile({"bot.py": "x = 1\n"})
+    with open(action_file, "w") as f:
+        f.write(json.dumps({"type": "new_robot", "round": 2, "robot_type": 0, "creator": "p", "uid": "nope",
+                            "code": dirfile}) + "\n")
+    records = []
+    game = Game(action_file, round_callback=records.append, keyframe_interval=2)
+    for _ in range(4):
+        game.turn()
+
+    # no turn() function, so the robot dies in its first turn
+    [grave] = game.graveyard
+    assert (grave.id, grave.round) == ("nope", 2)
+    assert [r["deaths"] for r in records] == [[], [grave.serialize()], [], []]
+    assert game.graveyard.at(grave.x, grave.y) == [grave]
+    assert game.queue == []
+
+
+def test_sense_locations(tmp_path):
+    action_file = tmp_path / "actions.jsonl"
+    code = "def turn():\n    global seen\n    seen = [tuple(loc) for loc in sense_locations()]\n"
+    dirfile = CodeContainer.directory_dict_to_dirfile({"bot.py": code})
+    with open(action_file, "w") as f:
+        f.write(json.dumps({"type": "new_robot", "round": 1, "robot_type": 0, "creator": "p", "uid": "s",
+                            "code": dirfile}) + "\n")
+    records = []
+    game = Game(action_file, telemetry_callback=records.append)
+    game.turn()
+
+    [robot] = game.queue
+    seen = robot.runner.globals["seen"]
+    assert len(seen) == 81
+    assert seen[0] == tuple(game.map.location_info(robot.x, robot.y))
+    assert records[0]["robots"][0]["bytecode_used"] >= GameConstants.SENSE_LOCATIONS_BYTECODE
+
+
+def test_game_methods_are_bound_per_robot(tmp_path):
+    game = idle_game(tmp_path, 2)
+    game.turn()
+    first, second = [robot.runner.game_methods for robot in game.queue]
+    assert {"move", "sense_locations", "get_bytecode", "GameError"} <= set(first)
+    assert not any(name.startswith("_") for name in first)
+    assert first.keys() == second.keys()
+    assert first["get_location"]() == (game.queue[0].x, game.queue[0].y)
+    assert second["get_location"]() == (game.queue[1].x, game.queue[1].y)
+
+
+def test_robots_with_the_same_code_share_it(tmp_path):
+    game = idle_game(tmp_path, 3)
+    game.turn()
+    assert len({id(robot.runner.code) for robot in game.queue}) == 1
+    assert len(game.codes) == 1
+
+    for robot in game.queue:
+        robot.kill()
+    game.turn()
+    gc.collect()
+    # the code is freed with the last robot that runs it
+    assert len(game.codes) == 0
+
+
+# tries to keep running after it is out of bytecode
+LOOPING_BOT = {
+    "bot.py": """
+def turn():
+    while True:
+        try:
+            while True:
+                pass
+        except Exception:
+            pass
+        finally:
+            while True:
+                pass
+""",
+}
+
+
+# drops a generator in the middle of it when it runs out of bytecode, which finalizes it
+GENERATOR_BOT = {
+    "bot.py": """
+def g():
+    while True:
+        yield 1
+
+
+def turn():
+    for x in g():
+        pass
+""",
+}
+
+
+@pytest.mark.parametrize("metering", [name for name, backend in METERING_BACKENDS.items()
+                                      if backend.available() and name not in {"bytecode", "none"}])
+def test_metering_backends_charge_the_same_bytecode(tmp_path, metering, monkeypatch, capfd):
+    unraisable = []
+    monkeypatch.setattr(sys, "unraisablehook", unraisable.append)
+    write_actions(tmp_path / "actions.jsonl", 3)
+    with open(tmp_path / "actions.jsonl", "a") as f:
+        for uid, bot in [("loop", LOOPING_BOT), ("generator", GENERATOR_BOT)]:
+            dirfile = CodeContainer.directory_dict_to_dirfile(bot)
+            f.write(json.dumps({"type": "new_robot", "round": 1, "robot_type": 0, "creator": "p", "uid": uid,
+                                "code": dirfile}) + "\n")
+    results = []
+    for name in ["bytecode", metering]:
+        records = []
+        game = Game(tmp_path / "actions.jsonl", metering=name, telemetry_callback=records.append)
+        replay = play(game, 4)
+        bytecode_used = [{r["id"]: r["bytecode_used"] for r in record["robots"]} for record in records]
+        results.append((replay, bytecode_used))
+    assert results[0] == results[1]
+    # the loop cannot run forever without paying for it
+    assert results[1][1][-1]["loop"] >= GameConstants.BYTECODE_PER_TURN
+    # the generator is stopped when it is finalized after running out of bytecode, and that is not an error
+    assert unraisable == []
+    assert capfd.readouterr().err == ""
@@ -0,0 +1,89 @@
+from array import array
+from typing import Dict, List, NamedTuple, Tuple
+
+from .robottype import RobotType
+
+
+class Grave(NamedTuple):
+    """
+    What is left of a dead robot.
+    """
+    id: str
+    type: RobotType
+    creator: str
+    round: int
+    x: int
+    y: int
+
+    def serialize(self):
+        return {
+            "id": self.id,
+            "type": self.type.value,
+            "creator": self.creator,
+            "round": self.round,
+            "x": self.x,
+            "y": self.y,
+        }
+
+
+class Graveyard:
+    """
+    Every robot that has died, in order of death.
+
+    Dead robots are stored column-wise (ids and creators in lists, everything else in int arrays), so a grave costs a
+    few dozen bytes instead of a Robot with its runner. Graves are indexed by location.
+    """
+
+    def __init__(self):
+        self.ids: List[str] = []
+        self.creators: List[str] = []
+        self.types = array("b")
+        self.rounds = array("i")
+        self.xs = array("i")
+        self.ys = array("i")
+        # (x, y) -> indices of the graves there, in order of death
+        self.by_location: Dict[Tuple[int, int], List[int]] = {}
+        # creators repeat a lot; store each distinct string once
+        self.interned_creators: Dict[str, str] = {}
+
+    def add(self, robot, round) -> Grave:
+        """
+        Buries a robot that died during round, at its current location.
+        """
+        i = len(self.ids)
+        self.ids.append(robot.id)
+        self.creators.append(self.interned_creators.setdefault(robot.creator, robot.creator))
+        self.types.append(robot.type.value)
+        self.rounds.append(round)
+        self.xs.append(robot.x)
+        self.ys.append(robot.y)
+        self.by_location.setdefault((robot.x, robot.y), []).append(i)
+        return self[i]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i) -> Grave:
+        return Grave(id=self.ids[i], type=RobotType(self.types[i]), creator=self.creators[i], round=self.rounds[i],
+                     x=self.xs[i], y=self.ys[i])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def at(self, x, y) -> List[Grave]:
+        """
+        :return: the graves of all robots that died at (x, y), in order of death
+        """
+        return [self[i] for i in self.by_location.get((x, y), [])]
+
+    def get_state(self):
+        return [(self.ids[i], self.types[i], self.creators[i], self.rounds[i], self.xs[i], self.ys[i])
+                for i in range(len(self))]
+
+    @classmethod
+    def from_state(cls, state):
+        graveyard = cls()
+        for id, type, creator, round, x, y in state:
+            graveyard.add(Grave(id, RobotType(type), creator, round, x, y), round)
+        return graveyard
@@ -0,0 +1,27 @@
+from .graveyard import Graveyard, Grave
+from .robottype import RobotType
+
+
+class FakeRobot:
+    def __init__(self, id, x, y, creator="p"):
+        self.id = id
+        self.type = RobotType.WANDERER
+        self.creator = creator
+        self.x = x
+        self.y = y
+
+
+def test_graveyard():
+    graveyard = Graveyard()
+    assert graveyard.add(FakeRobot("a", 1, 2), 5) == Grave("a", RobotType.WANDERER, "p", 5, 1, 2)
+    graveyard.add(FakeRobot("b", 3, 3), 6)
+    graveyard.add(FakeRobot("c", 1, 2, creator="q"), 9)
+
+    assert len(graveyard) == 3
+    assert [g.id for g in graveyard.at(1, 2)] == ["a", "c"]
+    assert graveyard.at(0, 0) == []
+    assert graveyard[2].serialize() == {"id": "c", "type": 0, "creator": "q", "round": 9, "x": 1, "y": 2}
+
+    restored = Graveyard.from_state(graveyard.get_state())
+    assert list(restored) == list(graveyard)
+    assert restored.at(1, 2) == graveyard.at(1, 2)
@@ -1,4 +1,4 @@
-from typing import NamedTuple, List, Optional
+from typing import NamedTuple, Optional
 from .robot import Robot
 
 
@@ -13,38 +13,43 @@ class LocationInfo(NamedTuple):
     occupied: bool
 
 
-class InternalLocation(NamedTuple):
+class InternalLocation:
     """
     A location has an (x,y) coordinate as well as metadata such as elevation or if there is a robot there.
-    It is immutable
+    It is mutable: the map writes to its fields in place, so moving a robot in or out of it is a single field write.
     """
-    x: int
-    y: int
-    elevation: int
-    water: bool
-    robot: Optional[Robot]
-    dead_robots: List[Robot]
+    __slots__ = ("x", "y", "elevation", "water", "robot")
+
+    def __init__(self, x: int, y: int, elevation: int, water: bool, robot: Optional[Robot]):
+        self.x = x
+        self.y = y
+        self.elevation = elevation
+        self.water = water
+        self.robot = robot
 
     @classmethod
     def from_dict(cls, d):
-        return InternalLocation(robot=None, dead_robots=[], **d)
-
-    def copy_and_change_unsafe(self, **kwargs):
-        """
-        unsafe: please discard self after this; will share mutable objects
-        """
-        return InternalLocation(x=self.x if "x" not in kwargs else kwargs["x"],
-                                y=self.y if "y" not in kwargs else kwargs["y"],
-                                elevation=self.elevation if "elevation" not in kwargs else kwargs["elevation"],
-                                water=self.water if "water" not in kwargs else kwargs["water"],
-                                robot=self.robot if "robot" not in kwargs else kwargs["robot"],
-                                dead_robots=self.dead_robots if "dead_robots" not in kwargs else kwargs["dead_robots"])
+        return InternalLocation(robot=None, **d)
 
     def serialize(self):
-        d = self._asdict()
-        d["robot"] = d["robot"].serialize() if d["robot"] is not None else None
-        d["dead_robots"] = [r.serialize() for r in d["dead_robots"]]
-        return d
+        return {
+            "x": self.x,
+            "y": self.y,
+            "elevation": self.elevation,
+            "water": self.water,
+            "robot": self.robot.serialize() if self.robot is not None else None,
+        }
 
     def to_location_info(self):
         return LocationInfo(x=self.x, y=self.y, elevation=self.elevation, water=self.water, occupied=self.robot is not None)
+
+    def __eq__(self, other):
+        if not isinstance(other, InternalLocation):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in self.__slots__)
+
+    # locations are mutable, so they are deliberately unhashable
+    __hash__ = None
+
+    def __repr__(self):
+        return f"InternalLocation(x={self.x}, y={self.y}, elevation={self.elevation}, water={self.water}, robot={self.robot!r})"
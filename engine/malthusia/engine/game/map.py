@@ -1,47 +1,268 @@
-from typing import List, Dict
-from .location import InternalLocation
+from array import array
+from typing import List, Dict, Optional, Set, Tuple
+from .location import InternalLocation, LocationInfo
 from .constants import GameConstants
 import json
+import mmap
+import struct
+import sys
+
+BINARY_MAGIC = b"MLTHMAP2"
+# version 1 files have no stored flags; every location in their region counts as stored
+BINARY_MAGIC_V1 = b"MLTHMAP1"
+# magic, min_x, min_y, width, height
+BINARY_HEADER = struct.Struct("<8siiII")
 
 
 def default_location(x, y):
-    return InternalLocation(x=x, y=y, elevation=GameConstants.DEFAULT_ELEVATION, water=True, robot=None, dead_robots=[])
+    return InternalLocation(x=x, y=y, elevation=GameConstants.DEFAULT_ELEVATION, water=True, robot=None)
+
+
+def disc_offsets(radius) -> List[Tuple[int, int]]:
+    """
+    :return: every (dx, dy) within a euclidean distance of radius (<=), nearest first
+    """
+    r = int(radius)
+    offsets = [(dx, dy) for dx in range(-r, r + 1) for dy in range(-r, r + 1) if dx * dx + dy * dy <= radius * radius]
+    offsets.sort(key=lambda offset: (offset[0] * offset[0] + offset[1] * offset[1], offset))
+    return offsets
 
 
 class Map:
     """
     An infinite map of locations.
+
+    The authored region, i.e. the bounding box of the locations the map is created with, is stored in flat arrays
+    indexed by (y - min_y) * width + (x - min_x): elevation, water and the robot occupying each location, and whether
+    the location is stored, i.e. was created with the map or has been written to since (only those are serialized,
+    the rest of the bounding box is default water). Everything outside of it is default water. The few outside
+    locations that are ever written to (robots walking into the sea) are kept in a sparse overflow dict; all other
+    outside locations share the same default terrain and are never stored.
     """
 
     def __init__(self, locations: List[InternalLocation]):
-        # locations is indexed [x][y]
-        self.locations: Dict[Dict[InternalLocation]] = {}
+        locations = list(locations)
+        if len(locations) > 0:
+            min_x = min(loc.x for loc in locations)
+            min_y = min(loc.y for loc in locations)
+            width = max(loc.x for loc in locations) - min_x + 1
+            height = max(loc.y for loc in locations) - min_y + 1
+        else:
+            min_x, min_y, width, height = 0, 0, 0, 0
+        size = width * height
+        self.init_region(min_x, min_y, width, height,
+                         elevation=array("i", [GameConstants.DEFAULT_ELEVATION]) * size,
+                         water=bytearray([True]) * size, stored=bytearray(size))
         self.add_locations(locations)
+        self.build_free_land()
+
+    def init_region(self, min_x, min_y, width, height, elevation, water, stored):
+        """
+        Sets up empty storage for the authored region.
+        :param elevation: writable int sequence of length width * height, e.g. an array or a memoryview of a map file
+        :param water: writable byte sequence of length width * height
+        :param stored: writable byte sequence of length width * height
+        """
+        self.min_x = min_x
+        self.min_y = min_y
+        self.width = width
+        self.height = height
+        self.elevation = elevation
+        self.water = water
+        self.stored = stored
+        self.robots = [None] * (width * height)
+        # (x, y) -> location, for locations outside the region that have been written to
+        self.overflow: Dict[Tuple[int, int], InternalLocation] = {}
+        # the change journal: every (x, y) that has been touched since the last drain_changes()
+        self.changes: Set[Tuple[int, int]] = set()
+        # the free land index: every spawnable (x, y), with the position of each one in the list,
+        # so that we can both remove and pick a random one in O(1)
+        self.free_land: List[Tuple[int, int]] = []
+        self.free_land_index: Dict[Tuple[int, int], int] = {}
+
+    def index(self, x, y):
+        """
+        :return: the index of (x, y) in the region arrays, or -1 if it is outside the authored region
+        """
+        dx = x - self.min_x
+        dy = y - self.min_y
+        if 0 <= dx < self.width and 0 <= dy < self.height:
+            return dy * self.width + dx
+        return -1
+
+    def drain_changes(self) -> Set[Tuple[int, int]]:
+        """
+        Returns the coordinates of all locations that have changed since the last call, and starts a new journal.
+        """
+        changes = self.changes
+        self.changes = set()
+        return changes
 
     def update_location(self, x, y, **fields):
-        old_loc = self.get_location(x, y)
-        loc = old_loc.copy_and_change_unsafe(**fields)
-        if loc.x not in self.locations:
-            self.locations[loc.x] = {}
-        self.locations[loc.x][loc.y] = loc
+        i = self.index(x, y)
+        if i >= 0:
+            if "elevation" in fields:
+                self.elevation[i] = fields["elevation"]
+            if "water" in fields:
+                self.water[i] = fields["water"]
+            if "robot" in fields:
+                self.robots[i] = fields["robot"]
+            self.stored[i] = True
+        else:
+            loc = self.overflow.get((x, y))
+            if loc is None:
+                loc = self.overflow[(x, y)] = default_location(x, y)
+            for field, value in fields.items():
+                setattr(loc, field, value)
+        self.changes.add((x, y))
+        if "robot" in fields or "water" in fields:
+            self.update_free_land(x, y)
 
     def add_locations(self, locations):
         """
         precondition: none of the locations already exist
         """
         for loc in locations:
-            if loc.x not in self.locations:
-                self.locations[loc.x] = {}
-            assert loc.y not in self.locations[loc.x]
-            self.locations[loc.x][loc.y] = loc
+            self.update_location(loc.x, loc.y, elevation=loc.elevation, water=loc.water, robot=loc.robot)
 
     def get_location(self, x, y) -> InternalLocation:
-        if x not in self.locations or y not in self.locations[x]:
+        """
+        Locations inside the authored region are materialized from the arrays, so writing to the returned location
+        has no effect; always go through update_location.
+        """
+        i = self.index(x, y)
+        if i >= 0:
+            return InternalLocation(x=x, y=y, elevation=self.elevation[i], water=bool(self.water[i]),
+                                    robot=self.robots[i])
+        loc = self.overflow.get((x, y))
+        if loc is None:
             return default_location(x, y)
-        return self.locations[x][y]
+        return loc
+
+    def location_info(self, x, y) -> LocationInfo:
+        i = self.index(x, y)
+        if i >= 0:
+            return LocationInfo(x=x, y=y, elevation=self.elevation[i], water=bool(self.water[i]),
+                                occupied=self.robots[i] is not None)
+        loc = self.overflow.get((x, y))
+        if loc is None:
+            return LocationInfo(x=x, y=y, elevation=GameConstants.DEFAULT_ELEVATION, water=True, occupied=False)
+        return loc.to_location_info()
+
+    def location_infos(self, x, y, offsets) -> List[LocationInfo]:
+        """
+        The batched version of location_info.
+        :param offsets: (dx, dy) pairs relative to (x, y), see disc_offsets
+        :return: the location info of every offset, in the same order
+        """
+        min_x, min_y, width, height = self.min_x, self.min_y, self.width, self.height
+        elevation, water, robots = self.elevation, self.water, self.robots
+        infos = []
+        for dx, dy in offsets:
+            lx, ly = x + dx, y + dy
+            rx, ry = lx - min_x, ly - min_y
+            if 0 <= rx < width and 0 <= ry < height:
+                i = ry * width + rx
+                infos.append(LocationInfo(lx, ly, elevation[i], bool(water[i]), robots[i] is not None))
+            else:
+                infos.append(self.location_info(lx, ly))
+        return infos
+
+    def elevation_at(self, x, y) -> int:
+        i = self.index(x, y)
+        if i >= 0:
+            return self.elevation[i]
+        loc = self.overflow.get((x, y))
+        return loc.elevation if loc is not None else GameConstants.DEFAULT_ELEVATION
+
+    def water_at(self, x, y) -> bool:
+        i = self.index(x, y)
+        if i >= 0:
+            return bool(self.water[i])
+        loc = self.overflow.get((x, y))
+        return loc.water if loc is not None else True
+
+    def robot_at(self, x, y):
+        i = self.index(x, y)
+        if i >= 0:
+            return self.robots[i]
+        loc = self.overflow.get((x, y))
+        return loc.robot if loc is not None else None
+
+    def set_robot(self, x, y, robot):
+        i = self.index(x, y)
+        if i >= 0:
+            self.robots[i] = robot
+            self.stored[i] = True
+        else:
+            loc = self.overflow.get((x, y))
+            if loc is None:
+                loc = self.overflow[(x, y)] = default_location(x, y)
+            loc.robot = robot
+        self.changes.add((x, y))
+        self.update_free_land(x, y)
+
+    def build_free_land(self):
+        """
+        Rebuilds the free land index from scratch, in a canonical order (the region row by row, then the overflow),
+        so that random spawning does not depend on how the map was loaded.
+        """
+        self.free_land = []
+        self.free_land_index = {}
+        water = bytes(self.water)
+        i = water.find(0)
+        while i != -1:
+            if self.robots[i] is None:
+                xy = (self.min_x + i % self.width, self.min_y + i // self.width)
+                self.free_land_index[xy] = len(self.free_land)
+                self.free_land.append(xy)
+            i = water.find(0, i + 1)
+        for x, y in self.overflow:
+            self.update_free_land(x, y)
+
+    def update_free_land(self, x, y):
+        key = (x, y)
+        if self.spawnable(x, y):
+            if key not in self.free_land_index:
+                self.free_land_index[key] = len(self.free_land)
+                self.free_land.append(key)
+        else:
+            i = self.free_land_index.pop(key, None)
+            if i is not None:
+                # swap the last element into the hole
+                last = self.free_land.pop()
+                if i < len(self.free_land):
+                    self.free_land[i] = last
+                    self.free_land_index[last] = i
+
+    def random_spawnable_location(self, rng) -> Optional[Tuple[int, int]]:
+        """
+        :param rng: the random number generator to use, e.g. the (seeded) random module
+        :return: a uniformly random spawnable (x, y), or None if there is no free land left
+        """
+        if len(self.free_land) == 0:
+            return None
+        return self.free_land[rng.randrange(len(self.free_land))]
 
     def serialize(self):
-        return [loc.serialize() for locdict in self.locations.values() for loc in locdict.values()]
+        serialized = []
+        stored = bytes(self.stored)
+        i = stored.find(1)
+        while i != -1:
+            robot = self.robots[i]
+            serialized.append({
+                "x": self.min_x + i % self.width,
+                "y": self.min_y + i // self.width,
+                "elevation": self.elevation[i],
+                "water": bool(self.water[i]),
+                "robot": robot.serialize() if robot is not None else None,
+            })
+            i = stored.find(1, i + 1)
+        serialized.extend(loc.serialize() for loc in self.overflow.values())
+        return serialized
+
+    def serialize_locations(self, coordinates):
+        return [self.get_location(x, y).serialize() for x, y in coordinates]
 
     @classmethod
     def from_list(cls, l: List[Dict]):
@@ -49,16 +270,117 @@ class Map:
         return cls(locations)
 
     @classmethod
-    def from_file(cls, filename):
+    def from_json_file(cls, filename):
         with open(filename, "r") as f:
             l = json.load(f)
         return cls.from_list(l)
 
+    @classmethod
+    def from_binary_file(cls, filename):
+        """
+        Memory-maps a binary map file (see to_binary_file). The terrain is not copied; pages are only read from disk
+        when they are first accessed, and writes go to private copy-on-write pages, never back to the file.
+        """
+        with open(filename, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        if len(mapped) < BINARY_HEADER.size:
+            raise ValueError(f"{filename} is not a binary map file: too short")
+        magic, min_x, min_y, width, height = BINARY_HEADER.unpack_from(mapped)
+        if magic not in (BINARY_MAGIC, BINARY_MAGIC_V1):
+            raise ValueError(f"{filename} is not a binary map file: bad magic {magic}")
+        size = width * height
+        expected = BINARY_HEADER.size + (6 if magic == BINARY_MAGIC else 5) * size
+        if len(mapped) != expected:
+            raise ValueError(f"{filename} is corrupt: expected {expected} bytes, found {len(mapped)}")
+
+        view = memoryview(mapped)
+        elevation = view[BINARY_HEADER.size:BINARY_HEADER.size + 4 * size].cast("i")
+        if sys.byteorder != "little":
+            elevation = array("i", elevation)
+            elevation.byteswap()
+        water = view[BINARY_HEADER.size + 4 * size:BINARY_HEADER.size + 5 * size]
+        if magic == BINARY_MAGIC:
+            stored = view[BINARY_HEADER.size + 5 * size:]
+        else:
+            stored = bytearray([True]) * size
+
+        m = cls.__new__(cls)
+        m.init_region(min_x, min_y, width, height, elevation=elevation, water=water, stored=stored)
+        m.build_free_land()
+        return m
+
+    @classmethod
+    def from_file(cls, filename):
+        """
+        Loads either a JSON map (a list of locations) or a binary map file.
+        """
+        with open(filename, "rb") as f:
+            magic = f.read(len(BINARY_MAGIC))
+        if magic in (BINARY_MAGIC, BINARY_MAGIC_V1):
+            return cls.from_binary_file(filename)
+        return cls.from_json_file(filename)
+
+    def to_binary_file(self, filename):
+        """
+        Writes the terrain of the authored region in the binary map format:
+        a header (magic, min_x, min_y, width, height), followed by the elevation of every location as little-endian
+        int32s, the water flag of every location as one byte each, and the stored flag of every location as one byte
+        each, all indexed by (y - min_y) * width + (x - min_x).
+        Robots and locations outside the authored region are not stored.
+        """
+        elevation = array("i", self.elevation)
+        if sys.byteorder != "little":
+            elevation.byteswap()
+        with open(filename, "wb") as f:
+            f.write(BINARY_HEADER.pack(BINARY_MAGIC, self.min_x, self.min_y, self.width, self.height))
+            f.write(elevation.tobytes())
+            f.write(bytes(self.water))
+            f.write(bytes(self.stored))
+
+    def get_state(self):
+        """
+        The state of the map for a checkpoint: the terrain, the overflow locations, and the order of the free land index
+        (random spawning depends on it). Robots are not included, they are placed again by from_state.
+        """
+        return {
+            "region": (self.min_x, self.min_y, self.width, self.height),
+            "elevation": array("i", self.elevation).tobytes(),
+            "water": bytes(self.water),
+            "stored": bytes(self.stored),
+            "overflow": [(loc.x, loc.y, loc.elevation, loc.water) for loc in self.overflow.values()],
+            "free_land": list(self.free_land),
+        }
+
+    @classmethod
+    def from_state(cls, state, alive_robots):
+        """
+        Recreates a map saved with get_state.
+        :param alive_robots: the robots to place on the map, each at its own (x, y)
+        """
+        min_x, min_y, width, height = state["region"]
+        elevation = array("i")
+        elevation.frombytes(state["elevation"])
+        m = cls.__new__(cls)
+        m.init_region(min_x, min_y, width, height, elevation=elevation, water=bytearray(state["water"]),
+                      stored=bytearray(state["stored"]))
+        for x, y, elevation, water in state["overflow"]:
+            m.overflow[(x, y)] = InternalLocation(x=x, y=y, elevation=elevation, water=water, robot=None)
+        for robot in alive_robots:
+            i = m.index(robot.x, robot.y)
+            if i >= 0:
+                m.robots[i] = robot
+            else:
+                loc = m.overflow.get((robot.x, robot.y))
+                if loc is None:
+                    loc = m.overflow[(robot.x, robot.y)] = default_location(robot.x, robot.y)
+                loc.robot = robot
+        m.free_land = list(state["free_land"])
+        m.free_land_index = {xy: i for i, xy in enumerate(m.free_land)}
+        return m
+
     def remove_robot(self, robot):
         assert not robot.alive
-        new_dead_robots = self.get_location(robot.x, robot.y).dead_robots
-        new_dead_robots.append(robot)
-        self.update_location(robot.x, robot.y, robot=None, dead_robots=new_dead_robots)
+        self.set_robot(robot.x, robot.y, None)
 
     def add_robot(self, robot, x, y):
         """
@@ -66,7 +388,7 @@ class Map:
         """
         assert self.spawnable(x, y)
 
-        self.update_location(x, y, robot=robot)
+        self.set_robot(x, y, robot)
 
     def spawnable(self, x, y):
         """
@@ -74,6 +396,9 @@ class Map:
         :param y:
         :return: true iff a robot can spawn on this location
         """
-        loc = self.get_location(x, y)
-        # spawnable iff no robot is there, and it is not water
-        return loc.robot is None and not loc.water
+        i = self.index(x, y)
+        if i >= 0:
+            # spawnable iff no robot is there, and it is not water
+            return self.robots[i] is None and not self.water[i]
+        loc = self.overflow.get((x, y))
+        return loc is not None and loc.robot is None and not loc.water
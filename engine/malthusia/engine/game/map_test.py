@@ -0,0 +1,99 @@
+import random
+
+from .map import BINARY_MAGIC_V1, Map, disc_offsets
+from .constants import GameConstants
+
+
+def square_map(size):
+    return Map.from_list([{"x": x, "y": y, "elevation": 0, "water": False} for x in range(size) for y in range(size)])
+
+
+def test_overflow_cells_are_mutated_in_place():
+    m = square_map(2)
+    m.drain_changes()
+    robot = object()
+    m.set_robot(5, 5, robot)
+    loc = m.get_location(5, 5)
+    assert loc.robot is robot and loc.water
+    m.set_robot(5, 5, None)
+    assert m.get_location(5, 5) is loc
+    assert loc.robot is None
+    m.update_location(5, 5, elevation=3)
+    assert loc.elevation == 3
+    assert m.drain_changes() == {(5, 5)}
+
+
+def test_free_land_index():
+    rng = random.Random(0)
+    m = Map.from_list([{"x": x, "y": y, "elevation": 0, "water": (x + y) % 3 == 0} for x in range(6) for y in range(6)])
+    for _ in range(500):
+        x, y = rng.randrange(-1, 7), rng.randrange(-1, 7)
+        if rng.random() < 0.5 and m.spawnable(x, y):
+            m.add_robot(object(), x, y)
+        elif rng.random() < 0.1:
+            m.update_location(x, y, water=not m.water_at(x, y))
+        else:
+            m.set_robot(x, y, None)
+        spawnable = {(x, y) for x in range(-1, 7) for y in range(-1, 7) if m.spawnable(x, y)}
+        assert set(m.free_land) == spawnable
+        assert len(m.free_land) == len(spawnable)
+        assert all(m.free_land[i] == xy for xy, i in m.free_land_index.items())
+    xy = m.random_spawnable_location(rng)
+    assert xy is None or m.spawnable(*xy)
+
+
+def test_random_spawnable_location_exhausted():
+    m = square_map(2)
+    for x in range(2):
+        for y in range(2):
+            m.add_robot(object(), *m.random_spawnable_location(random))
+    assert m.random_spawnable_location(random) is None
+
+
+def test_only_stored_locations_are_serialized(tmp_path):
+    m = Map.from_list([{"x": 0, "y": 0, "elevation": 0, "water": False},
+                       {"x": 1, "y": 1, "elevation": 0, "water": False}])
+    key = lambda l: (l["x"], l["y"])
+    assert sorted(key(l) for l in m.serialize()) == [(0, 0), (1, 1)]
+    m.set_robot(1, 0, None)
+    assert sorted(key(l) for l in m.serialize()) == [(0, 0), (1, 0), (1, 1)]
+
+    m.to_binary_file(tmp_path / "map.mlthmap")
+    assert Map.from_file(tmp_path / "map.mlthmap").serialize() == m.serialize()
+
+
+def test_binary_map_roundtrip(tmp_path):
+    m = Map.from_file(GameConstants.STARTING_MAPFILE)
+    m.to_binary_file(tmp_path / "map.mlthmap")
+    contents = (tmp_path / "map.mlthmap").read_bytes()
+
+    b = Map.from_file(tmp_path / "map.mlthmap")
+    assert b.serialize() == m.serialize()
+    assert b.free_land == m.free_land
+
+    # writes never go back to the file
+    x, y = b.free_land[0]
+    b.update_location(x, y, elevation=1000, water=True)
+    assert b.elevation_at(x, y) == 1000 and b.water_at(x, y)
+    assert (tmp_path / "map.mlthmap").read_bytes() == contents
+
+
+def test_version_1_binary_map_is_loaded(tmp_path):
+    m = square_map(3)
+    m.to_binary_file(tmp_path / "map.mlthmap")
+    contents = (tmp_path / "map.mlthmap").read_bytes()
+    # version 1 is the same, without the stored flags at the end
+    (tmp_path / "v1.mlthmap").write_bytes(BINARY_MAGIC_V1 + contents[len(BINARY_MAGIC_V1):-9])
+
+    b = Map.from_file(tmp_path / "v1.mlthmap")
+    assert b.serialize() == m.serialize()
+    assert b.free_land == m.free_land
+
+
+def test_location_infos():
+    m = square_map(4)
+    m.set_robot(1, 2, object())
+    m.set_robot(6, 1, object())
+    offsets = disc_offsets(5)
+    assert len(offsets) == 81 and offsets[0] == (0, 0)
+    assert m.location_infos(2, 2, offsets) == [m.location_info(2 + dx, 2 + dy) for dx, dy in offsets]
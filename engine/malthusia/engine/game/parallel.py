@@ -0,0 +1,110 @@
+import multiprocessing
+import random
+from typing import Dict, List, Optional, Tuple
+
+
+class TurnPool:
+    """
+    TurnPool runs the robots of a game in worker processes, for simultaneous turns.
+
+    Every worker is a fork of the game and keeps a full replica of it in lockstep with the main process: all processes
+    spawn the same robots in the same places, and apply the same moves and deaths. The only difference is that each
+    robot's code only runs in the one worker that owns it (robot.worker). Robots spawned after the fork are only
+    compiled and animated in that worker; everywhere else they are replicas that just take up their place on the map
+    (see Game.create_robot).
+
+    A round goes as follows:
+    1. every worker applies the actions that are due (spawning robots), and runs the turns of the robots it owns
+       against its replica, which is the map as it was at the start of the round. Moves are not applied, but recorded
+       as intents (see Game.record_move), as are deaths.
+    2. the main process collects the intents of all workers, sorts them by queue order, and every process applies them
+       to its replica (Game.apply_intents). When two robots want to move to the same location, the first one in the
+       queue gets it.
+    """
+
+    def __init__(self, game, workers):
+        if workers < 1:
+            raise ValueError(f"need at least one worker, got {workers}")
+        self.workers = workers
+        self.connections = []
+        self.processes = []
+
+        context = multiprocessing.get_context("fork")
+        random_state = random.getstate()
+        for index in range(workers):
+            parent_connection, child_connection = context.Pipe()
+            process = context.Process(target=run_worker, args=(game, index, child_connection, random_state),
+                                      daemon=True)
+            process.start()
+            child_connection.close()
+            self.connections.append(parent_connection)
+            self.processes.append(process)
+
+    def run_round(self, actions) -> Tuple[List[Tuple], Optional[List[Dict]]]:
+        """
+        Runs the turns of all robots in the workers.
+        :param actions: the actions that are due this round, which the workers apply before the turns
+        :return: the intents of all robots, in queue order, and their telemetry if the game collects it
+        """
+        for connection in self.connections:
+            connection.send(("turn", actions))
+        intents = []
+        telemetry = None
+        for connection in self.connections:
+            worker_intents, worker_telemetry = receive(connection)
+            intents.extend(worker_intents)
+            if worker_telemetry is not None:
+                telemetry = (telemetry or []) + worker_telemetry
+        # sort by queue position; within one robot, keep the order in which they were recorded
+        intents.sort(key=lambda intent: intent[1])
+        if telemetry is not None:
+            telemetry.sort(key=lambda robot: robot["position"])
+        return intents, telemetry
+
+    def apply(self, intents):
+        for connection in self.connections:
+            connection.send(("apply", intents))
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send(("stop", None))
+            except (BrokenPipeError, OSError):
+                pass
+            connection.close()
+        for process in self.processes:
+            process.join()
+        self.connections = []
+        self.processes = []
+
+
+class WorkerError(Exception):
+    """Raised in the main process when a worker failed"""
+    pass
+
+
+def receive(connection):
+    message, value = connection.recv()
+    if message == "error":
+        raise WorkerError(value)
+    return value
+
+
+def run_worker(game, index, connection, random_state):
+    # multiprocessing reseeds the random module in the child; all replicas need the same random numbers
+    random.setstate(random_state)
+    game.become_worker(index)
+    while True:
+        command, value = connection.recv()
+        if command == "stop":
+            break
+        try:
+            if command == "turn":
+                connection.send(("intents", game.run_worker_round(value)))
+            elif command == "apply":
+                game.apply_intents(value)
+                game.end_round()
+        except Exception as e:
+            connection.send(("error", f"worker {index}: {e!r}"))
+            raise
+    connection.close()
@@ -20,29 +20,47 @@ class Robot:
         self.runner = None
         self.debug = False
         self.alive = False
+        # with simultaneous turns: whether the robot runs in another process, and only takes up its place here
+        self.replica = False
+        # the worker process that runs this robot, with simultaneous turns
+        self.worker = None
+        # telemetry of the last turn; api_calls is only counted when the game collects telemetry
+        self.last_bytecode_used = 0
+        self.last_memory_check_seconds = 0.0
+        self.api_calls = 0
 
         self.check_rep()
 
     def check_rep(self):
         if not DEBUG:
             return
-        assert (self.alive and self.runner is not None) or (not self.alive and self.runner is None)
+        assert (self.alive and (self.runner is not None or self.replica)) or (not self.alive and self.runner is None)
 
     def animate(self, code, methods, debug=False):
         config = RobotRunnerConfig(starting_bytecode=0, bytecode_per_turn=GameConstants.BYTECODE_PER_TURN,
                                    max_bytecode=GameConstants.MAX_BYTECODE, chess_clock_mechanism=True,
-                                   memory_limit=GameConstants.MEMORY_LIMIT)
+                                   memory_limit=GameConstants.MEMORY_LIMIT, metering=code.metering)
         self.runner = RobotRunner(code, methods, self.log, self.error, config, debug=debug)
         self.debug = debug
         self.alive = True
 
         self.check_rep()
 
+    def animate_replica(self):
+        """
+        Brings the robot to life without any code, for a process that only keeps track of where it is.
+        """
+        self.replica = True
+        self.alive = True
+
+        self.check_rep()
+
     def kill(self, reason=None):
         self.status(f"Died :(. {reason if reason is not None else ''}")
 
-        self.runner.kill()
-        del self.runner
+        if self.runner is not None:
+            self.runner.kill()
+        self.runner = None
         self.alive = False
 
         self.kill_robot_callback(self)
@@ -82,6 +100,20 @@ class Robot:
         print(f'\u001b[31m[Robot {self.id} FATAL ERROR]\u001b[0m', msg)
 
     def turn(self):
+        error = self.run_turn()
+        if isinstance(error, RobotDied):
+            self.kill(reason=str(error))
+        elif error is not None:
+            self.fatal_error(str(error))
+            self.kill()
+
+        self.check_rep()
+
+    def run_turn(self):
+        """
+        Runs the code of the robot for one turn, without killing it.
+        :return: the RobotRunnerError or RobotDied that should kill the robot, or None
+        """
         if not self.alive:
             raise RuntimeError("Cannot call turn() on unanimated or dead robot.")
 
@@ -89,13 +121,12 @@ class Robot:
 
         try:
             self.runner.run()
-        except RobotRunnerError as e:
-            self.fatal_error(str(e))
-            self.kill()
-        except RobotDied as e:
-            self.kill(reason=str(e))
-
-        self.check_rep()
+        except (RobotRunnerError, RobotDied) as e:
+            return e
+        finally:
+            self.last_bytecode_used = self.runner.last_bytecode_used
+            self.last_memory_check_seconds = self.runner.last_memory_check_seconds
+        return None
 
     def __str__(self):
         t = str(self.type)[0]
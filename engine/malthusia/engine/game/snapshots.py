@@ -0,0 +1,185 @@
+import os
+import random
+import sys
+import time
+from typing import List, Optional
+
+
+class Snapshot:
+    """
+    A forked copy of the game process, frozen right after a round.
+    """
+
+    def __init__(self, round, pid, command_fd, ack_fd):
+        self.round = round
+        self.pid = pid
+        # write end of the pipe the snapshot process waits on
+        self.command_fd = command_fd
+        # read end of the pipe the snapshot process confirms that it has resumed on
+        self.ack_fd = ack_fd
+
+    def send(self, command) -> bool:
+        """
+        :return: whether the snapshot process got the command; it may have been discarded by another process since
+        """
+        try:
+            os.write(self.command_fd, (command + "\n").encode("utf-8"))
+            return True
+        except BrokenPipeError:
+            return False
+        finally:
+            os.close(self.command_fd)
+
+    def resumed(self) -> bool:
+        """
+        Waits for the snapshot process to confirm that it has resumed.
+        :return: whether it did, rather than exiting first
+        """
+        ack = b""
+        while not ack.endswith(b"\n"):
+            data = os.read(self.ack_fd, 64)
+            if len(data) == 0:
+                break
+            ack += data
+        self.close()
+        return ack == b"resumed\n"
+
+    def close(self):
+        if self.ack_fd is not None:
+            os.close(self.ack_fd)
+            self.ack_fd = None
+
+
+class SnapshotManager:
+    """
+    SnapshotManager keeps copy-on-write snapshots of the whole game process, by forking it every few rounds.
+
+    A snapshot process does nothing but wait for a command from the live process. Thanks to copy-on-write, it only
+    costs the memory pages the live process has changed since. When an action arrives for a round that has already been
+    simulated, the live process resumes the latest snapshot from before that round (rollback), which simulates the
+    rounds again with the action included. The live process hands the game over and exits, so that however many
+    rollbacks there are, only one process runs the game. The resumed snapshot inherits its stdin and stdout, and
+    becomes the live process.
+
+    A snapshot exits when it is told to, or when no process is left that could resume it (its command pipe is
+    closed), but not when the process that forked it exits: after a rollback, the resumed snapshot can still resume the
+    snapshots older than itself.
+
+    Usage, right after a round:
+
+        head = snapshots.take(game.round)
+        if head is not None:
+            # we are a snapshot that has just been resumed, see rollback()
+    """
+
+    def __init__(self, max_snapshots=3):
+        self.max_snapshots = max_snapshots
+        # oldest first
+        self.snapshots: List[Snapshot] = []
+
+    def take(self, round) -> Optional[int]:
+        """
+        Forks a snapshot of the process as it is now.
+        :return: None in the live process. In the snapshot process, this only returns once the snapshot is resumed,
+                 and then returns the head round passed to rollback().
+        """
+        # whatever is buffered would otherwise be written by both processes
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        # make room first, so that the new snapshot does not hold on to one we are about to discard
+        while len(self.snapshots) >= self.max_snapshots:
+            self.discard(self.snapshots.pop(0))
+
+        read_fd, write_fd = os.pipe()
+        ack_read_fd, ack_write_fd = os.pipe()
+        # the random module reseeds itself in a forked child, but the game must stay deterministic
+        random_state = random.getstate()
+        pid = os.fork()
+        if pid == 0:
+            random.setstate(random_state)
+            os.close(write_fd)
+            os.close(ack_read_fd)
+            return self.wait_for_command(read_fd, ack_write_fd)
+
+        os.close(read_fd)
+        os.close(ack_write_fd)
+        self.snapshots.append(Snapshot(round, pid, write_fd, ack_read_fd))
+        return None
+
+    def wait_for_command(self, read_fd, ack_fd) -> int:
+        command = b""
+        while not command.endswith(b"\n"):
+            data = os.read(read_fd, 64)
+            if len(data) == 0:
+                # everyone who could have resumed us is gone
+                os._exit(0)
+            command += data
+        os.close(read_fd)
+
+        words = command.decode("utf-8").split()
+        if words[0] != "resume":
+            os._exit(0)
+        # the live process exits once it has read this, and we take over
+        os.write(ack_fd, b"resumed\n")
+        os.close(ack_fd)
+        return int(words[1])
+
+    def rollback(self, round, head) -> bool:
+        """
+        Resumes the latest snapshot taken before round started, and waits until it has taken over the game.
+        Snapshots taken after it are discarded. If this returns True, the caller must exit right away (with os._exit,
+        so that nothing is written on the way out), since the resumed snapshot now runs the game.
+        :param round: the round that has to be simulated again
+        :param head: the round the resumed snapshot should catch up to
+        :return: whether a snapshot took over; False if there is no snapshot old enough
+        """
+        sys.stdout.flush()
+        sys.stderr.flush()
+        while len(self.snapshots) > 0:
+            snapshot = self.snapshots.pop()
+            if snapshot.round >= round:
+                self.discard(snapshot)
+            elif snapshot.send(f"resume {head}") and snapshot.resumed():
+                # the resumed snapshot takes over the older snapshots; it has its own copy of their pipes
+                for older in self.snapshots:
+                    os.close(older.command_fd)
+                    older.close()
+                self.snapshots = []
+                return True
+            else:
+                snapshot.close()
+        return False
+
+    def discard(self, snapshot):
+        snapshot.send("exit")
+        snapshot.close()
+        self.wait(snapshot.pid)
+
+    def wait(self, pid) -> int:
+        """
+        Waits for a process to exit. It may not be our child (snapshots resumed by a resumed snapshot are its
+        siblings), so we cannot always use waitpid.
+        """
+        while True:
+            # reap any of our children that have exited, e.g. discarded snapshots
+            try:
+                while True:
+                    child, status = os.waitpid(-1, os.WNOHANG)
+                    if child == 0:
+                        break
+                    if child == pid:
+                        return os.waitstatus_to_exitcode(status)
+            except ChildProcessError:
+                pass
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                # not our child, so we cannot know how it exited
+                return 0
+            time.sleep(0.05)
+
+    def close(self):
+        for snapshot in self.snapshots:
+            self.discard(snapshot)
+        self.snapshots = []
@@ -0,0 +1,66 @@
+import os
+import random
+import time
+
+from .snapshots import SnapshotManager
+
+
+def test_rollback_resumes_latest_snapshot_before_round(tmp_path):
+    snapshots = SnapshotManager(max_snapshots=2)
+    random.seed(0)
+    state = {"round": 0}
+    for round in range(1, 7):
+        state["round"] = round
+        random.random()
+        head = snapshots.take(round)
+        if head is not None:
+            # resumed snapshot: report what we see, then leave pytest alone
+            with open(tmp_path / "resumed.txt", "w") as f:
+                f.write(f"{state['round']} {head} {random.random()}")
+            os._exit(7)
+    # only the last two snapshots (rounds 5 and 6) are kept
+    assert [s.round for s in snapshots.snapshots] == [5, 6]
+    resumed_pid = snapshots.snapshots[0].pid
+
+    random.seed(0)
+    expected = [random.random() for _ in range(6)]
+
+    # the snapshot of round 6 is discarded, since it was taken after round 6 started
+    assert snapshots.rollback(6, head=10)
+    assert snapshots.snapshots == []
+    _, status = os.waitpid(resumed_pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 7
+    round, head, r = (tmp_path / "resumed.txt").read_text().split()
+    assert (int(round), int(head)) == (5, 10)
+    # the snapshot continues with the random state it was forked with
+    assert float(r) == expected[5]
+
+
+def test_rollback_without_old_enough_snapshot():
+    snapshots = SnapshotManager()
+    if snapshots.take(4) is not None:
+        os._exit(1)
+    assert not snapshots.rollback(3, head=5)
+    assert snapshots.snapshots == []
+
+
+def test_resumed_snapshot_can_roll_back_after_the_live_process_exits(tmp_path):
+    if os.fork() == 0:
+        # the live game process: it hands over to the snapshot of round 5 and exits, leaving the snapshot of round 4
+        # without the process that forked it
+        snapshots = SnapshotManager()
+        for round in range(4, 7):
+            head = snapshots.take(round)
+            if head is None:
+                continue
+            if round == 5:
+                os._exit(0 if snapshots.rollback(5, head) else 1)
+            (tmp_path / "resumed.txt").write_text(f"{round} {head} {os.getppid()}")
+            os._exit(0)
+        os._exit(0 if snapshots.rollback(6, head=8) else 1)
+
+    deadline = time.time() + 10
+    while not (tmp_path / "resumed.txt").exists() and time.time() < deadline:
+        time.sleep(0.05)
+    round, head, _ = (tmp_path / "resumed.txt").read_text().split()
+    assert (int(round), int(head)) == (4, 8)
@@ -0,0 +1,115 @@
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, NamedTuple
+
+from .constants import GameConstants
+from .game import Game
+
+
+class Match(NamedTuple):
+    """
+    One game of a tournament: every bot gets robots_per_bot robots in round 1, and the game is played for rounds rounds.
+    """
+    map_file: str
+    seed: int
+    rounds: int
+    robots_per_bot: int = 1
+
+
+def play_match(bots: Dict[str, str], match: Match) -> Dict:
+    """
+    Plays a single game without any output.
+    :param bots: bot name -> flattened bot (dirfile)
+    :return: the statistics of the game
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        action_file = os.path.join(tmp, "actions.jsonl")
+        with open(action_file, "w") as f:
+            for name, dirfile in bots.items():
+                for i in range(match.robots_per_bot):
+                    action = {
+                        "type": "new_robot",
+                        "round": 1,
+                        "robot_type": 0,
+                        "creator": name,
+                        "uid": f"{name}-{i}",
+                        "code": dirfile,
+                    }
+                    f.write(json.dumps(action) + "\n")
+
+        stats = {name: {"robots": 0, "survivors": 0, "turns": 0, "bytecode_used": 0} for name in bots}
+
+        def record(telemetry):
+            for robot in telemetry["robots"]:
+                bot = stats[robot["creator"]]
+                bot["turns"] += 1
+                bot["bytecode_used"] += robot["bytecode_used"]
+
+        game = Game(action_file, map_file=match.map_file, seed=match.seed, debug=False, telemetry_callback=record)
+        round_times = []
+        try:
+            for _ in range(match.rounds):
+                start = time.perf_counter()
+                game.turn()
+                round_times.append(time.perf_counter() - start)
+        finally:
+            game.close()
+
+    for robot in game.queue:
+        stats[robot.creator]["robots"] += 1
+        stats[robot.creator]["survivors"] += 1
+    for grave in game.graveyard:
+        stats[grave.creator]["robots"] += 1
+    for bot in stats.values():
+        bot["bytecode_per_turn"] = bot["bytecode_used"] / bot["turns"] if bot["turns"] > 0 else 0
+
+    return {
+        "map_file": str(match.map_file),
+        "seed": match.seed,
+        "rounds": match.rounds,
+        "bots": stats,
+        "round_seconds": {
+            "mean": sum(round_times) / len(round_times) if round_times else 0,
+            "max": max(round_times, default=0),
+            "total": sum(round_times),
+        },
+    }
+
+
+def summarize(games: List[Dict]) -> Dict:
+    """
+    Aggregates the statistics of many games per bot.
+    """
+    summary = {}
+    for game in games:
+        for name, stats in game["bots"].items():
+            bot = summary.setdefault(name, {"games": 0, "robots": 0, "survivors": 0, "turns": 0, "bytecode_used": 0})
+            bot["games"] += 1
+            for key in ["robots", "survivors", "turns", "bytecode_used"]:
+                bot[key] += stats[key]
+    for bot in summary.values():
+        bot["survival_rate"] = bot["survivors"] / bot["robots"] if bot["robots"] > 0 else 0
+        bot["bytecode_per_turn"] = bot["bytecode_used"] / bot["turns"] if bot["turns"] > 0 else 0
+    return summary
+
+
+def run_tournament(bots: Dict[str, str], maps: List[str] = None, seeds: List[int] = None, rounds: int = 100,
+                   robots_per_bot: int = 1, max_workers: int = None) -> Dict:
+    """
+    Plays every bot against each other on every combination of map and seed, in a pool of processes.
+    :param bots: bot name -> flattened bot (dirfile)
+    :return: {"games": [statistics of every game, see play_match], "summary": statistics per bot, see summarize}
+    """
+    if not maps:
+        maps = [GameConstants.STARTING_MAPFILE]
+    if not seeds:
+        seeds = [GameConstants.DEFAULT_SEED]
+    matches = [Match(map_file, seed, rounds, robots_per_bot) for map_file in maps for seed in seeds]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        games = list(executor.map(play_match, [bots] * len(matches), matches))
+
+    return {"games": games, "summary": summarize(games)}
@@ -0,0 +1,25 @@
+from .tournament import Match, play_match, run_tournament
+from .constants import GameConstants
+from ..container.code_container import CodeContainer
+
+IDLE_BOT = CodeContainer.directory_dict_to_dirfile({"bot.py": "def turn():\n    x = 1\n"})
+BROKEN_BOT = CodeContainer.directory_dict_to_dirfile({"bot.py": "x = 1\n"})
+
+
+def test_play_match():
+    stats = play_match({"idle": IDLE_BOT, "broken": BROKEN_BOT}, Match(GameConstants.STARTING_MAPFILE, 1, 3, 2))
+    assert stats["seed"] == 1 and stats["rounds"] == 3
+    assert stats["bots"]["idle"]["robots"] == 2
+    assert stats["bots"]["idle"]["survivors"] == 2
+    assert stats["bots"]["idle"]["turns"] == 6
+    assert stats["bots"]["idle"]["bytecode_used"] > 0
+    # no turn() function: the robots die in their first turn
+    assert stats["bots"]["broken"]["survivors"] == 0
+    assert stats["bots"]["broken"]["turns"] == 2
+
+
+def test_run_tournament():
+    results = run_tournament({"idle": IDLE_BOT}, seeds=[1, 2, 3], rounds=2, max_workers=2)
+    assert [game["seed"] for game in results["games"]] == [1, 2, 3]
+    assert results["summary"]["idle"]["games"] == 3
+    assert results["summary"]["idle"]["survival_rate"] == 1
@@ -61,17 +61,17 @@ class BasicViewer:
         for x in range(self.view_box.l, self.view_box.r+1):
             view_map[x] = {}
             for y in range(self.view_box.b, self.view_box.t+1):
-                view_map[x][y] = (GameConstants.DEFAULT_ELEVATION, None, [])
+                view_map[x][y] = (GameConstants.DEFAULT_ELEVATION, None)
 
         for loc in map:
             x, y = loc['x'], loc['y']
             if x in view_map and y in view_map[x]:
-                view_map[x][y] = (loc['elevation'], loc['robot'], loc['dead_robots'])
+                view_map[x][y] = (loc['elevation'], loc['robot'])
 
         new_board = ''
         for y in range(self.view_box.t, self.view_box.b-1, -1):
             for x in range(self.view_box.l, self.view_box.r+1):
-                elevation, robot, dead_robots = view_map[x][y]
+                elevation, robot = view_map[x][y]
                 if robot is not None:
                     new_board += '['
                     new_board += str(robot)
@@ -1,6 +1,8 @@
 import logging
+from typing import List
 
-from .location import InternalLocation, LocationInfo
+from .location import LocationInfo
+from .map import disc_offsets
 from .direction import Direction
 from .robot import RobotError
 from .robottype import RobotType
@@ -9,6 +11,11 @@ from ..container.runner import RobotDied
 
 logger = logging.getLogger(__name__)
 
+DROWNED = "Walked into water... robots cant swim :("
+
+# robot type -> (dx, dy) of every location it can see, nearest first
+VISION_OFFSETS = {robot_type: disc_offsets(radius) for robot_type, radius in GameConstants.VISION_RADIUS.items()}
+
 
 class Wanderer:
     """
@@ -22,11 +29,19 @@ class Wanderer:
     def check_location(self, x, y) -> LocationInfo:
         if (x-self.robot.x)**2 + (y-self.robot.y)**2 > GameConstants.VISION_RADIUS[RobotType.WANDERER]**2:
             raise RobotError(f"Out of vision radius: attempted to check location {(x, y)}, which is a distance {((x-self.robot.x)**2 + (y-self.robot.y)**2)**.5} away from the robot's location of {(self.robot.x, self.robot.y)}. The robot's vision radius is {GameConstants.VISION_RADIUS[RobotType.WANDERER]}.")
-        return self.game.map.get_location(x, y).to_location_info()
+        return self.game.map.location_info(x, y)
+
+    def sense_locations(self) -> List[LocationInfo]:
+        """
+        Returns every location within the vision radius, nearest first. Costs a fixed amount of bytecode,
+        GameConstants.SENSE_LOCATIONS_BYTECODE, which is much cheaper than calling check_location in a loop.
+        """
+        self.robot.runner.multinstrument_call(GameConstants.SENSE_LOCATIONS_BYTECODE)
+        return self.game.map.location_infos(self.robot.x, self.robot.y, VISION_OFFSETS[RobotType.WANDERER])
 
     def get_location(self) -> (int, int):
         x, y = self.robot.x, self.robot.y
-        if self.game.map.get_location(x, y).robot != self.robot:
+        if self.game.map.robot_at(x, y) != self.robot:
             raise RobotError("Something went wrong; please contact the devs!")
         return x, y
 
@@ -34,28 +49,29 @@ class Wanderer:
         if self.robot.has_moved:
             raise RobotError("Already moved: this unit has already moved this turn, and robots can only move once per turn.")
 
+        map = self.game.map
         x, y = self.robot.x, self.robot.y
-        old_loc: InternalLocation = self.game.map.get_location(x, y)
 
-        if old_loc.robot != self.robot:
+        if map.robot_at(x, y) != self.robot:
             raise RobotError("Something went wrong; please contact the devs!")
 
-        new_x, new_y = [v1 + v2 for v1, v2 in zip((x, y), direction.value)]
-        new_loc: InternalLocation = self.game.map.get_location(new_x, new_y)
+        dx, dy = direction.value
+        new_x, new_y = x + dx, y + dy
 
-        if new_loc.robot is not None:
-            raise RobotError(f"Occupied space: attempted to move to {(new_loc.x, new_loc.y)}, which is occupied.")
+        if map.robot_at(new_x, new_y) is not None:
+            raise RobotError(f"Occupied space: attempted to move to {(new_x, new_y)}, which is occupied.")
 
-        if new_loc.elevation - old_loc.elevation > GameConstants.MOVE_ELEVATION_THRESHOLD:
-            raise RobotError(f"Current location {(old_loc.x, old_loc.y)} is below new location {(new_loc.x, new_loc.y)} by more than the allowed threshold of {GameConstants.MOVE_ELEVATION_THRESHOLD}.")
+        if map.elevation_at(new_x, new_y) - map.elevation_at(x, y) > GameConstants.MOVE_ELEVATION_THRESHOLD:
+            raise RobotError(f"Current location {(x, y)} is below new location {(new_x, new_y)} by more than the allowed threshold of {GameConstants.MOVE_ELEVATION_THRESHOLD}.")
 
-        self.robot.x = new_x
-        self.robot.y = new_y
+        self.robot.has_moved = True
 
-        self.game.map.update_location(new_loc.x, new_loc.y, robot=self.robot)
-        self.game.map.update_location(old_loc.x, old_loc.y, robot=None)
+        if self.game.intents is not None:
+            # simultaneous turns: the move happens at the end of the round, in queue order (see TurnPool)
+            self.game.record_move(self.robot, new_x, new_y)
+            return
 
-        self.robot.has_moved = True
+        self.game.move_robot(self.robot, new_x, new_y)
 
-        if new_loc.water:
-            raise RobotDied("Walked into water... robots cant swim :(")
\ No newline at end of file
+        if map.water_at(new_x, new_y):
+            raise RobotDied(DROWNED)
\ No newline at end of file
@@ -0,0 +1,4 @@
+from .format import ROUND_PADDING, encode_round, write_round, decode_rounds, read_rounds
+from .delta import DeltaEncoder, ReplayDecoder, reconstruct_round
+from .writer import ReplayWriter
+from .container import CompressedReplayWriter, read_index, read_compressed_rounds, convert_replay
@@ -0,0 +1,137 @@
+import bisect
+import gzip
+import struct
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+from .delta import is_keyframe
+from .format import encode_round, decode_rounds, read_rounds
+
+INDEX_MAGIC = b"MLTHIDX1"
+# first round, offset and length of a block
+INDEX_ENTRY = struct.Struct("<iQI")
+
+
+def index_filename(filename) -> str:
+    return f"{filename}.idx"
+
+
+class Block(NamedTuple):
+    """
+    An index entry. In a compressed replay, a block is a gzip member; in a replay written by ReplayWriter, it is the
+    frame of a single keyframe, and the rounds up to the next block are deltas.
+    """
+    round: int
+    offset: int
+    length: int
+
+
+class CompressedReplayWriter:
+    """
+    Writes a compressed replay: a sequence of blocks, each of which is a gzip member containing a few consecutive
+    rounds in the usual ROUND_PADDING framing. Every block starts with a keyframe, so a block can be decoded without
+    any of the blocks before it. Since gzip members can be concatenated, the whole file also decompresses to an
+    ordinary replay.
+
+    Next to the replay, an index file (index_filename) lists the first round, byte offset and length of every block,
+    see read_index.
+    """
+
+    def __init__(self, filename, rounds_per_block=10, compresslevel=6):
+        """
+        :param rounds_per_block: a new block is started at the first keyframe after this many rounds. In delta-encoded
+                                 replays, blocks can therefore be as long as the keyframe interval.
+        """
+        self.rounds_per_block = rounds_per_block
+        self.compresslevel = compresslevel
+        self.file = open(filename, "wb")
+        self.index = open(index_filename(filename), "wb")
+        self.index.write(INDEX_MAGIC)
+        self.offset = 0
+        self.block: List[str] = []
+        self.block_round = None
+
+    def write(self, record: Dict):
+        if len(self.block) >= self.rounds_per_block and is_keyframe(record):
+            self.write_block()
+        if len(self.block) == 0:
+            if not is_keyframe(record):
+                raise ValueError(f"The first round of a block must be a keyframe, but round {record['round']} is not.")
+            self.block_round = record["round"]
+        self.block.append(encode_round(record))
+
+    def write_block(self):
+        if len(self.block) == 0:
+            return
+        # mtime=0, so that the same replay always compresses to the same bytes
+        data = gzip.compress("".join(self.block).encode("utf-8"), compresslevel=self.compresslevel, mtime=0)
+        self.file.write(data)
+        self.file.flush()
+        # the index entry goes last: a reader never finds an index entry for a block that has not been written
+        self.index.write(INDEX_ENTRY.pack(self.block_round, self.offset, len(data)))
+        self.index.flush()
+        self.offset += len(data)
+        self.block = []
+
+    def close(self):
+        self.write_block()
+        self.file.close()
+        self.index.close()
+
+
+def read_index(filename) -> List[Block]:
+    """
+    :return: every block of a replay, in order
+    """
+    with open(index_filename(filename), "rb") as f:
+        data = f.read()
+    if data[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+        raise ValueError(f"{index_filename(filename)} is not a replay index.")
+    entries = data[len(INDEX_MAGIC):]
+    # a block being written right now can leave an incomplete entry behind
+    entries = entries[:len(entries) - len(entries) % INDEX_ENTRY.size]
+    return [Block(*entry) for entry in INDEX_ENTRY.iter_unpack(entries)]
+
+
+def find_block(blocks: List[Block], round_num) -> Optional[int]:
+    """
+    :return: the position in blocks of the block that contains round_num, or None if it is before the first block
+    """
+    i = bisect.bisect_right([block.round for block in blocks], round_num) - 1
+    return i if i >= 0 else None
+
+
+def read_block(f, block: Block) -> Iterator[Dict]:
+    f.seek(block.offset)
+    yield from decode_rounds(gzip.decompress(f.read(block.length)).decode("utf-8"))
+
+
+def read_compressed_rounds(filename, from_round: Optional[int] = None) -> Iterator[Dict]:
+    """
+    Yields the rounds of a compressed replay, in order.
+    :param from_round: if set, only the blocks from the one that contains from_round onwards are decompressed. The
+                       rounds start at the beginning of that block, with a keyframe, so that they can be decoded (see
+                       ReplayDecoder); skip the ones before from_round if you do not need them.
+    """
+    blocks = read_index(filename)
+    start = 0
+    if from_round is not None:
+        start = find_block(blocks, from_round) or 0
+    with open(filename, "rb") as f:
+        for block in blocks[start:]:
+            yield from read_block(f, block)
+
+
+def convert_replay(input_file, output_file, rounds_per_block=10, compresslevel=6) -> int:
+    """
+    Converts a replay in the ROUND_PADDING format into a compressed replay.
+    :return: the number of rounds
+    """
+    writer = CompressedReplayWriter(output_file, rounds_per_block=rounds_per_block, compresslevel=compresslevel)
+    rounds = 0
+    try:
+        for record in read_rounds(input_file):
+            writer.write(record)
+            rounds += 1
+    finally:
+        writer.close()
+    return rounds
@@ -0,0 +1,34 @@
+import gzip
+
+from .container import CompressedReplayWriter, read_index, read_compressed_rounds, convert_replay
+from .format import write_round, decode_rounds
+
+
+def records(n, keyframe_interval):
+    return [{"round": r, "keyframe": (r - 1) % keyframe_interval == 0, "data": "x" * r} for r in range(1, n + 1)]
+
+
+def test_blocks_start_at_keyframes(tmp_path):
+    path = tmp_path / "replay.gz"
+    writer = CompressedReplayWriter(path, rounds_per_block=2)
+    for record in records(20, keyframe_interval=5):
+        writer.write(record)
+    writer.close()
+
+    blocks = read_index(path)
+    assert [block.round for block in blocks] == [1, 6, 11, 16]
+    assert blocks[-1].offset + blocks[-1].length == path.stat().st_size
+    # the blocks together are one multi-member gzip file of an ordinary replay
+    assert list(decode_rounds(gzip.decompress(path.read_bytes()).decode("utf-8"))) == records(20, 5)
+
+    assert [r["round"] for r in read_compressed_rounds(path, from_round=13)] == list(range(11, 21))
+    assert [r["round"] for r in read_compressed_rounds(path, from_round=0)] == list(range(1, 21))
+
+
+def test_convert_replay(tmp_path):
+    with open(tmp_path / "replay.txt", "w") as f:
+        for record in records(7, keyframe_interval=1):
+            write_round(f, record)
+    assert convert_replay(tmp_path / "replay.txt", tmp_path / "replay.gz", rounds_per_block=3) == 7
+    assert [block.round for block in read_index(tmp_path / "replay.gz")] == [1, 4, 7]
+    assert list(read_compressed_rounds(tmp_path / "replay.gz")) == records(7, 1)
@@ -0,0 +1,105 @@
+from typing import Dict, Iterable, List, Tuple
+
+
+def location_key(loc: Dict) -> Tuple[int, int]:
+    return loc["x"], loc["y"]
+
+
+def is_keyframe(record: Dict) -> bool:
+    # full-map replays (the original format) have no keyframe attribute; every round is a keyframe
+    return record.get("keyframe", True)
+
+
+class DeltaEncoder:
+    """
+    DeltaEncoder turns the state of the map after every round into replay records. Every keyframe_interval rounds
+    (and for the very first round it sees) it emits a keyframe containing the whole map; all other rounds only
+    contain the locations that changed during the round, as recorded by the map's change journal.
+
+    Keyframe: {"round": 10, "keyframe": true, "map": [...all locations...]}
+    Delta:    {"round": 11, "keyframe": false, "changes": [...changed locations...]}
+    """
+
+    def __init__(self, keyframe_interval: int):
+        if keyframe_interval < 1:
+            raise ValueError(f"keyframe_interval must be positive, got {keyframe_interval}")
+        self.keyframe_interval = keyframe_interval
+        self.started = False
+
+    def encode(self, round_num: int, map, changes: Iterable[Tuple[int, int]]) -> Dict:
+        """
+        :param map: the Map after the round
+        :param changes: the (x, y) coordinates of every location that changed during the round
+        """
+        if not self.started or round_num % self.keyframe_interval == 0:
+            self.started = True
+            return {
+                "round": round_num,
+                "keyframe": True,
+                "map": map.serialize(),
+            }
+        return {
+            "round": round_num,
+            "keyframe": False,
+            "changes": map.serialize_locations(sorted(changes)),
+        }
+
+
+class ReplayDecoder:
+    """
+    ReplayDecoder reconstructs the full map from a sequence of replay records, in order.
+    It accepts both delta-encoded replays and full-map replays.
+    """
+
+    def __init__(self):
+        self.round = None
+        self.locations: Dict[Tuple[int, int], Dict] = {}
+        self.started = False
+
+    def apply(self, record: Dict):
+        if is_keyframe(record):
+            self.locations = {location_key(loc): loc for loc in record["map"]}
+            self.started = True
+        else:
+            if not self.started:
+                raise ValueError(f"Cannot apply delta for round {record['round']} before having seen a keyframe.")
+            for loc in record["changes"]:
+                self.locations[location_key(loc)] = loc
+        self.round = record["round"]
+
+    def serialize_map(self) -> List[Dict]:
+        return list(self.locations.values())
+
+    def keyframe(self) -> Dict:
+        """
+        The current state as a keyframe record, which can be decoded without any preceding rounds.
+        """
+        return {
+            "round": self.round,
+            "keyframe": True,
+            "map": self.serialize_map(),
+        }
+
+
+def reconstruct_round(records: List[Dict], round_num: int) -> List[Dict]:
+    """
+    Returns the full serialized map at the given round, starting from the closest preceding keyframe.
+    :param records: replay records in round order
+    """
+    records = list(records)
+    end = None
+    for i, record in enumerate(records):
+        if record["round"] == round_num:
+            end = i
+            break
+    if end is None:
+        raise KeyError(f"Round {round_num} is not in the replay.")
+    start = end
+    while not is_keyframe(records[start]):
+        start -= 1
+        if start < 0:
+            raise ValueError(f"No keyframe found before round {round_num}.")
+    decoder = ReplayDecoder()
+    for record in records[start:end + 1]:
+        decoder.apply(record)
+    return decoder.serialize_map()
@@ -0,0 +1,66 @@
+import pytest
+
+from .delta import DeltaEncoder, ReplayDecoder, reconstruct_round
+from .format import encode_round, decode_rounds
+from ..game.map import Map
+
+
+def loc(x, y, elevation=0, robot=None):
+    return {"x": x, "y": y, "elevation": elevation, "water": False, "robot": robot}
+
+
+class FakeRobot:
+    def __init__(self, id):
+        self.id = id
+
+    def serialize(self):
+        return self.id
+
+
+def test_delta_roundtrip():
+    m = Map.from_list([{"x": 0, "y": 0, "elevation": 0, "water": False},
+                       {"x": 1, "y": 0, "elevation": 0, "water": False},
+                       {"x": 0, "y": 1, "elevation": 3, "water": False}])
+    a, b = FakeRobot("a"), FakeRobot("b")
+    steps = [
+        lambda: None,
+        lambda: m.update_location(0, 0, robot=a),
+        lambda: (m.update_location(0, 0, robot=None), m.update_location(1, 0, robot=a)),
+        lambda: m.update_location(5, 5, elevation=2),
+        lambda: (m.update_location(1, 0, robot=None), m.update_location(0, 1, robot=b)),
+    ]
+    encoder = DeltaEncoder(keyframe_interval=3)
+    records, maps = [], []
+    for i, step in enumerate(steps):
+        step()
+        records.append(encoder.encode(i + 1, m, m.drain_changes()))
+        maps.append(m.serialize())
+
+    assert [r["keyframe"] for r in records] == [True, False, True, False, False]
+    key = lambda l: (l["x"], l["y"])
+    assert [key(l) for l in records[1]["changes"]] == [(0, 0)]
+    assert sorted(key(l) for l in records[2]["map"]) == [(0, 0), (0, 1), (1, 0)]
+    assert [key(l) for l in records[3]["changes"]] == [(5, 5)]
+    assert [key(l) for l in records[4]["changes"]] == [(0, 1), (1, 0)]
+
+    for i, expected in enumerate(maps):
+        assert sorted(reconstruct_round(records, i + 1), key=key) == sorted(expected, key=key)
+
+
+def test_decoder_requires_keyframe():
+    decoder = ReplayDecoder()
+    with pytest.raises(ValueError):
+        decoder.apply({"round": 2, "keyframe": False, "changes": []})
+
+
+def test_full_map_records_are_keyframes():
+    records = [{"round": 1, "map": [loc(0, 0)]}, {"round": 2, "map": [loc(0, 0, robot="a")]}]
+    assert reconstruct_round(records, 2) == [loc(0, 0, robot="a")]
+
+
+def test_framing():
+    records = [{"round": 1, "map": [loc(0, 0)]}, {"round": 2, "keyframe": False, "changes": []}]
+    text = "".join(encode_round(r) for r in records)
+    assert list(decode_rounds(text)) == records
+    # an incomplete trailing round is ignored
+    assert list(decode_rounds(text + encode_round(records[0])[:-3])) == records
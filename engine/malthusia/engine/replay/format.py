@@ -0,0 +1,56 @@
+import json
+
+# the round delimiter is a string that can never appear inside a valid JSON file.
+# each round will start and end with this string
+ROUND_PADDING = '""""'
+
+
+def encode_round(record) -> str:
+    """
+    Frames a single replay record, so that it can be appended to a replay file.
+    """
+    return ROUND_PADDING + json.dumps(record) + ROUND_PADDING
+
+
+def write_round(f, record):
+    f.write(encode_round(record))
+
+
+def frame_spans(data):
+    """
+    Yields the (start, end) of every complete round in an encoded replay, padding included. A trailing incomplete round
+    is ignored.
+    :param data: the replay as str or bytes
+    """
+    padding = ROUND_PADDING if isinstance(data, str) else ROUND_PADDING.encode("utf-8")
+    start = data.find(padding)
+    while start != -1:
+        end = data.find(padding, start + len(padding))
+        if end == -1:
+            return
+        end += len(padding)
+        yield start, end
+        start = data.find(padding, end)
+
+
+def decode_rounds(text: str):
+    """
+    Yields every complete replay record in the given text. A trailing incomplete round is ignored.
+    """
+    for start, end in frame_spans(text):
+        yield json.loads(text[start + len(ROUND_PADDING):end - len(ROUND_PADDING)])
+
+
+def complete_length(data: bytes) -> int:
+    """
+    :return: the length of the longest prefix of an encoded replay that only contains complete rounds
+    """
+    length = 0
+    for _, end in frame_spans(data):
+        length = end
+    return length
+
+
+def read_rounds(filename):
+    with open(filename, "r") as f:
+        yield from decode_rounds(f.read())
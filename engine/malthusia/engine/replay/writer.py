@@ -0,0 +1,266 @@
+import json
+import os
+import queue
+import threading
+import time
+from typing import Dict, Optional
+
+from .container import INDEX_MAGIC, INDEX_ENTRY, index_filename, read_index
+from .delta import is_keyframe
+from .format import ROUND_PADDING, encode_round, frame_spans, complete_length
+
+
+def repair(filename) -> int:
+    """
+    Cuts off an incomplete round at the end of a replay file, e.g. from a crash in the middle of a write, and brings
+    its index up to date (see ReplayWriter). Only the rounds from the last keyframe in the index on are read, so that
+    opening a long replay does not take longer than opening a short one; a replay without an index is read in full.
+    :return: the size of the file afterwards
+    """
+    size = os.path.getsize(filename)
+    try:
+        blocks = [block for block in read_index(filename) if block.offset + block.length <= size]
+    except (FileNotFoundError, ValueError):
+        # replays from before the index existed: index them now
+        blocks = []
+    start = blocks[-1].offset if len(blocks) > 0 else 0
+    with open(filename, "rb") as f:
+        f.seek(start)
+        data = f.read()
+        if start > 0 and not data.startswith(ROUND_PADDING.encode("utf-8")):
+            # the index does not match the replay
+            start, blocks = 0, []
+            f.seek(0)
+            data = f.read()
+    length = start + complete_length(data)
+    if length < size:
+        os.truncate(filename, length)
+    # the last keyframe in the index is read again, along with the ones written after it that did not make it in
+    blocks = blocks[:-1] + [(round, start + offset, block_length)
+                            for round, offset, block_length in index_rounds(data[:length - start])]
+    with open(index_filename(filename), "wb") as f:
+        f.write(INDEX_MAGIC + b"".join(INDEX_ENTRY.pack(*block) for block in blocks))
+    return length
+
+
+def generation_filename(filename) -> str:
+    return f"{filename}.gen"
+
+
+def new_generation(filename):
+    """
+    Gives the replay a new generation: a random token in a file next to it that changes every time the replay is
+    opened or truncated, so that a follower can tell that bytes it has read before may have been replaced, even when
+    the file has grown past where it was since (see read_generation).
+    """
+    path = generation_filename(filename)
+    with open(path + ".tmp", "w") as f:
+        f.write(os.urandom(8).hex())
+    os.replace(path + ".tmp", path)
+
+
+def read_generation(filename) -> Optional[str]:
+    """
+    :return: the generation of the replay, or None if it has none (a replay written before generations existed)
+    """
+    try:
+        with open(generation_filename(filename)) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def index_rounds(data: bytes):
+    """
+    Yields the index entry of every keyframe in an encoded replay.
+    """
+    padding = len(ROUND_PADDING)
+    for start, end in frame_spans(data):
+        record = json.loads(data[start + padding:end - padding])
+        if is_keyframe(record):
+            yield record["round"], start, end - start
+
+
+class ReplayWriter:
+    """
+    ReplayWriter appends rounds to a replay file on a background thread, so that the game does not wait for the disk.
+
+    Rounds go through a bounded queue. The writer thread takes every round that is queued at once, encodes them and
+    appends them with a single write (group commit), and fsyncs the file at most every fsync_seconds. When the disk
+    cannot keep up, the queue fills up and write() blocks until there is room again (backpressure); how often and for
+    how long that happened is in stats().
+
+    Rounds are written whole or not at all: a crash in the middle of a write leaves an incomplete round at the end of
+    the file, which is cut off the next time the file is opened.
+
+    Next to the replay, the writer keeps an index (see read_index) of the first round, offset and length of every
+    keyframe, so that readers can start reading at any round: seek to the latest keyframe at or before it. It also
+    keeps a generation (see new_generation), which changes whenever rounds that may have been read are dropped.
+    """
+
+    def __init__(self, filename, max_pending=64, fsync_seconds=1.0):
+        """
+        :param filename: the replay file; rounds are appended to it if it exists
+        :param max_pending: the max number of rounds queued for writing before write() blocks
+        """
+        self.filename = filename
+        self.max_pending = max_pending
+        self.fsync_seconds = fsync_seconds
+
+        self.fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o666)
+        # the size of the file after all rounds written so far; only up to date right after flush()
+        self.size = repair(filename)
+        self.index_fd = os.open(index_filename(filename), os.O_WRONLY | os.O_APPEND)
+        new_generation(filename)
+        # set by the writer thread if writing fails, and raised in the game thread
+        self.error = None
+        self.closed = False
+
+        self.rounds_written = 0
+        self.bytes_written = 0
+        self.commits = 0
+        self.fsyncs = 0
+        self.stalls = 0
+        self.stall_seconds = 0.0
+
+        self.start()
+
+    def start(self):
+        self.queue = queue.Queue(maxsize=self.max_pending)
+        self.thread = threading.Thread(target=self.run, name="replay-writer", daemon=True)
+        self.thread.start()
+
+    def after_fork(self):
+        """
+        Call in a forked child process before using the writer: only the forking thread survives a fork, so the child
+        needs a writer thread of its own. flush() before forking, so that nothing is left in the queue.
+        """
+        self.start()
+
+    def write(self, record):
+        """
+        Queues a round for writing. Blocks while the queue is full.
+        """
+        self.check()
+        try:
+            self.queue.put_nowait(("round", record))
+        except queue.Full:
+            start = time.perf_counter()
+            self.queue.put(("round", record))
+            self.stalls += 1
+            self.stall_seconds += time.perf_counter() - start
+
+    def flush(self):
+        """
+        Blocks until every queued round has been written and fsynced. Afterwards, size is up to date.
+        """
+        self.check()
+        done = threading.Event()
+        self.queue.put(("flush", done))
+        done.wait()
+        self.check()
+
+    def truncate(self, size):
+        """
+        Drops everything after the first size bytes of the replay, e.g. the rounds after a checkpoint.
+        """
+        self.flush()
+        os.ftruncate(self.fd, size)
+        blocks = [block for block in read_index(self.filename) if block.offset < size]
+        os.ftruncate(self.index_fd, len(INDEX_MAGIC) + len(blocks) * INDEX_ENTRY.size)
+        # after truncating and before writing anything new, so that a follower that sees the old generation after
+        # reading has not read any of the new rounds
+        new_generation(self.filename)
+        self.size = size
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        done = threading.Event()
+        self.queue.put(("stop", done))
+        done.wait()
+        self.thread.join()
+        os.close(self.fd)
+        os.close(self.index_fd)
+        self.check()
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def stats(self) -> Dict:
+        return {
+            "rounds_written": self.rounds_written,
+            "bytes_written": self.bytes_written,
+            "commits": self.commits,
+            "fsyncs": self.fsyncs,
+            "pending": self.queue.qsize(),
+            "stalls": self.stalls,
+            "stall_seconds": self.stall_seconds,
+        }
+
+    def run(self):
+        last_fsync = time.monotonic()
+        dirty = False
+        while True:
+            try:
+                # with unsynced data, wake up in time for the next periodic fsync
+                timeout = max(0.0, last_fsync + self.fsync_seconds - time.monotonic()) if dirty else None
+                items = [self.queue.get(timeout=timeout)]
+            except queue.Empty:
+                items = []
+            # group commit: everything that has been queued by now goes out in one write
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            records = [value for command, value in items if command == "round"]
+            waiters = [value for command, value in items if command != "round"]
+            stop = any(command == "stop" for command, _ in items)
+
+            if self.error is None:
+                try:
+                    if len(records) > 0:
+                        self.append(records)
+                        self.rounds_written += len(records)
+                        dirty = True
+                    if dirty and (len(waiters) > 0 or time.monotonic() - last_fsync >= self.fsync_seconds):
+                        os.fsync(self.fd)
+                        os.fsync(self.index_fd)
+                        self.fsyncs += 1
+                        last_fsync = time.monotonic()
+                        dirty = False
+                except Exception as e:
+                    # keep draining the queue, so that the game thread does not block; it raises the error instead
+                    self.error = e
+
+            for done in waiters:
+                done.set()
+            if stop:
+                return
+
+    def append(self, records):
+        frames = [encode_round(record).encode("utf-8") for record in records]
+        index = []
+        offset = self.size
+        for record, frame in zip(records, frames):
+            if is_keyframe(record):
+                index.append(INDEX_ENTRY.pack(record["round"], offset, len(frame)))
+            offset += len(frame)
+
+        data = b"".join(frames)
+        write_all(self.fd, data)
+        # the index goes last, so that it never points past the end of the replay
+        write_all(self.index_fd, b"".join(index))
+        self.size += len(data)
+        self.bytes_written += len(data)
+        self.commits += 1
+
+
+def write_all(fd, data: bytes):
+    written = 0
+    while written < len(data):
+        written += os.write(fd, data[written:])
@@ -0,0 +1,91 @@
+from .container import read_index
+from .format import encode_round, read_rounds
+from .writer import ReplayWriter
+
+
+def test_rounds_are_written_in_order(tmp_path):
+    path = tmp_path / "replay.txt"
+    writer = ReplayWriter(path, max_pending=2)
+    for i in range(50):
+        writer.write({"round": i})
+    writer.flush()
+    assert writer.size == path.stat().st_size
+    writer.write({"round": 50})
+    writer.close()
+    assert [r["round"] for r in read_rounds(path)] == list(range(51))
+    stats = writer.stats()
+    assert stats["rounds_written"] == 51
+    assert stats["bytes_written"] == path.stat().st_size
+    assert 1 <= stats["commits"] <= 51
+
+
+def test_incomplete_round_is_cut_off(tmp_path):
+    path = tmp_path / "replay.txt"
+    complete = encode_round({"round": 1})
+    path.write_text(complete + encode_round({"round": 2})[:-3])
+    writer = ReplayWriter(path)
+    assert writer.size == len(complete)
+    writer.write({"round": 2})
+    writer.close()
+    assert [r["round"] for r in read_rounds(path)] == [1, 2]
+
+
+def test_truncate(tmp_path):
+    path = tmp_path / "replay.txt"
+    writer = ReplayWriter(path)
+    writer.write({"round": 1})
+    writer.flush()
+    size = writer.size
+    writer.write({"round": 2})
+    writer.truncate(size)
+    writer.write({"round": 3})
+    writer.close()
+    assert [r["round"] for r in read_rounds(path)] == [1, 3]
+
+
+def test_index(tmp_path):
+    path = tmp_path / "replay.txt"
+    writer = ReplayWriter(path)
+    for r in range(1, 11):
+        writer.write({"round": r, "keyframe": r % 4 == 1})
+    writer.flush()
+    blocks = read_index(path)
+    assert [block.round for block in blocks] == [1, 5, 9]
+    data = path.read_bytes()
+    for block in blocks:
+        assert data[block.offset:block.offset + block.length] == encode_round({"round": block.round, "keyframe": True}).encode()
+
+    writer.truncate(blocks[1].offset + blocks[1].length)
+    assert [block.round for block in read_index(path)] == [1, 5]
+    writer.close()
+
+    # replays without an index are indexed when they are opened
+    (tmp_path / "replay.txt.idx").unlink()
+    ReplayWriter(path).close()
+    assert read_index(path) == blocks[:2]
+
+
+def test_reopening_reads_from_the_last_keyframe_in_the_index(tmp_path):
+    path = tmp_path / "replay.txt"
+    writer = ReplayWriter(path)
+    for r in range(1, 11):
+        writer.write({"round": r, "keyframe": r % 4 == 1})
+    writer.close()
+    assert [block.round for block in read_index(path)] == [1, 5, 9]
+
+    # a crash after writing rounds 11-13 but before indexing them, and in the middle of round 14
+    tail = "".join(encode_round({"round": r, "keyframe": r == 13}) for r in range(11, 14))
+    size = path.stat().st_size + len(tail)
+    with open(path, "a") as f:
+        f.write(tail + encode_round({"round": 14, "keyframe": False})[:-2])
+    # the rounds before the last keyframe in the index are not read again, so they may as well be garbage
+    data = path.read_bytes()
+    round_2 = encode_round({"round": 2, "keyframe": False}).encode()
+    start = data.index(round_2) + 4
+    path.write_bytes(data[:start] + b"x" * (len(round_2) - 8) + data[start + len(round_2) - 8:])
+
+    writer = ReplayWriter(path)
+    assert writer.size == size
+    writer.close()
+    assert path.stat().st_size == size
+    assert [block.round for block in read_index(path)] == [1, 5, 9, 13]
@@ -85,9 +85,11 @@ FORBIDDEN_FUNC_NAMES = frozenset([
 def copy_locations(new_node, old_node):
     assert 'lineno' in new_node._attributes
     new_node.lineno = old_node.lineno
+    new_node.end_lineno = old_node.end_lineno
 
     assert 'col_offset' in new_node._attributes
     new_node.col_offset = old_node.col_offset
+    new_node.end_col_offset = old_node.end_col_offset
 
     ast.fix_missing_locations(new_node)
 
@@ -490,8 +492,8 @@ class RestrictingNodeTransformer(ast.NodeTransformer):
                     keywords=[]))
 
             if isinstance(node, ast.Module):
-                _print.lineno = position
-                _print.col_offset = position
+                _print.lineno = _print.end_lineno = position
+                _print.col_offset = _print.end_col_offset = position
                 ast.fix_missing_locations(_print)
             else:
                 copy_locations(_print, node)
@@ -1175,8 +1177,7 @@ class RestrictingNodeTransformer(ast.NodeTransformer):
         manual_import_from = []
         tempname = f"_{node.module}_temp"
         imp = ast.Import(names=[ast.alias(name=node.module, asname=tempname)])
-        imp.lineno = node.lineno
-        imp.col_offset = node.col_offset
+        copy_locations(imp, node)
         manual_import_from.append(imp)
         for name in node.names:
             asname = name.asname if name.asname is not None else name.name
@@ -1188,9 +1189,7 @@ class RestrictingNodeTransformer(ast.NodeTransformer):
                     keywords=[]
                 )
             )
-            new_name.lineno = node.lineno
-            new_name.col_offset = node.col_offset
-            ast.fix_missing_locations(new_name)
+            copy_locations(new_name, node)
             manual_import_from.append(new_name)
         return manual_import_from
 
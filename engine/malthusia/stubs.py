@@ -56,4 +56,14 @@ def move(direction: Direction) -> None:
 
 
 def check_location(x: int, y: int) -> LocationInfo:
-    return check_location(x, y)
\ No newline at end of file
+    return check_location(x, y)
+
+
+def sense_locations() -> List[LocationInfo]:
+    """
+    Wanderer method.
+
+    Returns every location within the vision radius, nearest first, for a fixed bytecode cost of
+    `GameConstants.SENSE_LOCATIONS_BYTECODE`.
+    """
+    return sense_locations()
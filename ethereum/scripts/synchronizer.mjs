@@ -13,8 +13,9 @@ if (process.argv.length < 4) {
 const eth_url = process.argv[2];
 const init_block = process.argv[3];
 
-// always stay 10 rounds behind, to ensure we don't walk into the future
-const SAFETY_MARGIN = 10;
+// stay this many rounds behind, to ensure we don't walk into the future.
+// when the engine runs with --snapshot-interval it can roll back on late actions, so a smaller margin is fine.
+const SAFETY_MARGIN = parseInt(process.env.SAFETY_MARGIN ?? "10");
 
 async function main() {
   const web3 = createAlchemyWeb3(eth_url);
@@ -0,0 +1,326 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Set
+
+from malthusia.engine.replay import ROUND_PADDING, ReplayDecoder, encode_round
+from malthusia.engine.replay.container import Block, read_index
+from malthusia.engine.replay.delta import is_keyframe
+from malthusia.engine.replay.format import frame_spans
+from malthusia.engine.replay.writer import read_generation
+
+logger = logging.getLogger(__name__)
+
+
+class ReplayError(Exception):
+    """
+    The replay cannot be followed, e.g. because it is not a framed replay (see ROUND_PADDING).
+    """
+    pass
+
+
+class Subscriber:
+    def __init__(self, offset: int, max_chunks: int):
+        # the offset in the replay of the next byte the client needs
+        self.offset = offset
+        # (offset, chunk) pairs, and None once the subscriber has been disconnected
+        self.queue = asyncio.Queue(maxsize=max_chunks)
+
+
+def read_at(f, offset: int, size: int) -> bytes:
+    f.seek(offset)
+    return f.read(size)
+
+
+def stat_replay(filename: str):
+    """
+    :return: the generation of the replay and its os.stat, which is None if there is no replay
+    """
+    generation = read_generation(filename)
+    try:
+        return generation, os.stat(filename)
+    except FileNotFoundError:
+        return generation, None
+
+
+def open_replay(filename: str):
+    f = open(filename, "rb")
+    return f, os.fstat(f.fileno()).st_ino
+
+
+def read_keyframes(filename: str) -> List[Block]:
+    try:
+        return read_index(filename)
+    except (FileNotFoundError, ValueError):
+        # no index: decode from the start
+        return []
+
+
+class ReplayBroadcaster:
+    """
+    ReplayBroadcaster follows a replay file as the engine writes it, and fans the new bytes out to every client.
+
+    The file is read once, by a single task, no matter how many clients there are. The reads run in a thread, so that
+    the event loop never waits for the disk. Every client has a bounded queue of chunks. A client that is so slow that
+    its queue fills up is disconnected: skipping bytes would break its framing, and it can reconnect with ?from_round
+    to get back in sync. Clients are also disconnected when the replay is truncated (after a rollback) or replaced (a
+    new game), since the bytes they have seen no longer exist. The engine changes the generation of the replay every
+    time it does that (see new_generation), which catches a truncate even when the replay has grown past where it was
+    by the next poll.
+
+    The broadcaster also decodes the rounds it publishes, so that it always knows the current state of the world. A new
+    client can start with that as a keyframe instead of downloading the whole history (see stream_live). Decoding
+    starts at the latest keyframe in the index of the replay, so the broadcaster does not read the whole history either.
+
+    A file that is not a framed replay (e.g. a compressed one), or that has a round longer than max_round_bytes, stops
+    the broadcaster with a ReplayError, which every client gets.
+    """
+
+    def __init__(self, filename: str, chunk_size=100_000, poll_seconds=0.1, max_chunks=64,
+                 max_round_bytes=100_000_000):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.poll_seconds = poll_seconds
+        self.max_chunks = max_chunks
+        self.max_round_bytes = max_round_bytes
+
+        self.subscribers: Set[Subscriber] = set()
+        # how much of the file has been read and published, starting at the keyframe decoding started at
+        self.offset = 0
+        self.file = None
+        self.inode = None
+        # the generation of the replay that has been published
+        self.replay_generation = None
+        self.task: Optional[asyncio.Task] = None
+        # why the broadcaster stopped, if it did
+        self.error: Optional[ReplayError] = None
+
+        # the state after the last complete round published, which ends at decoded_offset
+        self.decoder = ReplayDecoder()
+        self.decoded_offset = 0
+        # the published bytes after decoded_offset: the start of a round that is still being written
+        self.pending = b""
+        # the current state encoded as a keyframe, once a client has asked for it
+        self.encoded_keyframe: Optional[bytes] = None
+
+        # metrics
+        self.generation = 0
+        self.bytes_published = 0
+        self.slow_disconnects = 0
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        try:
+            while True:
+                chunk = await self.poll()
+                if len(chunk) > 0:
+                    self.publish(chunk)
+                    # let the clients take the chunk before publishing the next one
+                    await asyncio.sleep(0)
+                else:
+                    await asyncio.sleep(self.poll_seconds)
+        except ReplayError as e:
+            logger.error(f"Stopped following {self.filename}: {e}")
+            self.error = e
+            for subscriber in list(self.subscribers):
+                self.disconnect(subscriber)
+
+    async def poll(self) -> bytes:
+        """
+        :return: the next chunk of new bytes in the file, or b"" if there are none
+        """
+        generation, stat = await asyncio.to_thread(stat_replay, self.filename)
+        if stat is None:
+            return b""
+        replaced = stat.st_ino != self.inode or stat.st_size < self.offset or generation != self.replay_generation
+        if self.file is None or replaced:
+            if self.file is not None:
+                self.reset()
+            self.file, self.inode = await asyncio.to_thread(open_replay, self.filename)
+            self.replay_generation = generation
+            self.seek_keyframe(await asyncio.to_thread(read_keyframes, self.filename), stat.st_size)
+        chunk = await asyncio.to_thread(read_at, self.file, self.offset, self.chunk_size)
+        if await asyncio.to_thread(read_generation, self.filename) != generation:
+            # truncated while we were reading, so the chunk may continue old rounds with new ones; the next poll resets
+            return b""
+        return chunk
+
+    def seek_keyframe(self, keyframes: List[Block], size: int):
+        """
+        Starts reading at the latest keyframe in the replay at or after the current offset, instead of decoding the
+        whole history to catch up. Clients still get the bytes before it, straight from the file (see stream).
+        """
+        keyframes = [block for block in keyframes if self.offset <= block.offset <= size]
+        if len(keyframes) > 0:
+            self.offset = self.decoded_offset = keyframes[-1].offset
+
+    def reset(self):
+        self.file.close()
+        self.file = None
+        self.offset = 0
+        self.decoder = ReplayDecoder()
+        self.decoded_offset = 0
+        self.pending = b""
+        self.encoded_keyframe = None
+        self.generation += 1
+        for subscriber in list(self.subscribers):
+            self.disconnect(subscriber)
+
+    def publish(self, chunk: bytes):
+        start = self.offset
+        self.offset += len(chunk)
+        self.bytes_published += len(chunk)
+        if not self.decode(chunk):
+            return
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber.queue.put_nowait((start, chunk))
+            except asyncio.QueueFull:
+                self.slow_disconnects += 1
+                self.disconnect(subscriber)
+
+    def disconnect(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+        # make room for the end of stream marker; the client will not get those chunks anyway
+        while not subscriber.queue.empty():
+            subscriber.queue.get_nowait()
+        subscriber.queue.put_nowait(None)
+
+    def decode(self, chunk: bytes) -> bool:
+        """
+        :return: False if the chunk has a corrupt round in it, in which case the broadcaster has been reset to start
+        over at the first keyframe after it
+        :raises: ReplayError if the replay is not framed, or has a round longer than max_round_bytes
+        """
+        self.pending += chunk
+        padding = ROUND_PADDING.encode("utf-8")
+        if not self.pending[:len(padding)] == padding[:len(self.pending)]:
+            raise ReplayError(f"no round starts at byte {self.decoded_offset}, so this is not a framed replay")
+        end = 0
+        for start, end in frame_spans(self.pending):
+            try:
+                record = json.loads(self.pending[start + len(padding):end - len(padding)])
+            except json.JSONDecodeError as e:
+                corrupt = self.decoded_offset + end
+                logger.error(f"Corrupt round at bytes {self.decoded_offset + start}-{corrupt} of {self.filename}, "
+                             f"skipping to the next keyframe: {e}")
+                self.reset()
+                self.offset = self.decoded_offset = corrupt
+                return False
+            # after a corrupt round, the deltas up to the next keyframe have nothing to be decoded against
+            if self.decoder.started or is_keyframe(record):
+                self.decoder.apply(record)
+                self.encoded_keyframe = None
+        self.decoded_offset += end
+        self.pending = self.pending[end:]
+        if len(self.pending) > self.max_round_bytes:
+            raise ReplayError(f"the round at byte {self.decoded_offset} is longer than {self.max_round_bytes} bytes")
+        return True
+
+    def keyframe(self) -> bytes:
+        if self.encoded_keyframe is None:
+            self.encoded_keyframe = encode_round(self.decoder.keyframe()).encode("utf-8")
+        return self.encoded_keyframe
+
+    async def wait_for_keyframe(self, timeout: float) -> bool:
+        """
+        Waits until there is a current state to start stream_live with.
+        :return: False if there is none after timeout seconds
+        :raises: ReplayError if the broadcaster has stopped
+        """
+        self.start()
+        deadline = asyncio.get_running_loop().time() + timeout
+        while not self.decoder.started:
+            if self.error is not None:
+                raise self.error
+            if asyncio.get_running_loop().time() >= deadline:
+                return False
+            await asyncio.sleep(self.poll_seconds)
+        return True
+
+    async def stream_live(self, timeout: float = 10):
+        """
+        Yields the current state of the world as a keyframe, and then every round after it, until the client is
+        disconnected. Unlike stream(0), the time to the first complete round does not depend on the length of the game.
+        :param timeout: how long to wait for a keyframe to start with, if there is none yet; the stream ends without a
+        single byte if there still is none by then
+        :raises: ReplayError if the broadcaster has stopped
+        """
+        if not await self.wait_for_keyframe(timeout):
+            return
+        generation = self.generation
+        offset = self.decoded_offset
+        yield self.keyframe()
+        async for chunk in self.stream(offset, generation):
+            yield chunk
+
+    async def stream(self, offset: int = 0, generation: Optional[int] = None):
+        """
+        Yields the replay from byte offset on, and then everything that is appended to it, until the client is
+        disconnected.
+        :param generation: if set, the generation of the replay the offset refers to; stops if it has been replaced
+        :raises: ReplayError if the broadcaster has stopped
+        """
+        self.start()
+        while self.file is None:
+            if self.error is not None:
+                raise self.error
+            # the replay has not been opened yet, so we do not know where publishing will start
+            await asyncio.sleep(self.poll_seconds)
+        if generation is None:
+            generation = self.generation
+        # catch up on what has been published before the client came, straight from the file
+        if offset < self.offset:
+            f = await asyncio.to_thread(open, self.filename, "rb")
+            try:
+                while offset < self.offset:
+                    chunk = await asyncio.to_thread(read_at, f, offset, min(self.chunk_size, self.offset - offset))
+                    if len(chunk) == 0 or self.generation != generation:
+                        return
+                    offset += len(chunk)
+                    yield chunk
+            finally:
+                f.close()
+        if self.generation != generation:
+            return
+        if self.error is not None:
+            raise self.error
+
+        subscriber = Subscriber(offset, self.max_chunks)
+        self.subscribers.add(subscriber)
+        try:
+            while True:
+                item = await subscriber.queue.get()
+                if item is None:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                start, chunk = item
+                # the client may have asked for an offset that had not been published yet
+                chunk = chunk[max(0, subscriber.offset - start):]
+                if len(chunk) > 0:
+                    subscriber.offset += len(chunk)
+                    yield chunk
+        finally:
+            self.subscribers.discard(subscriber)
+
+    def metrics(self) -> Dict:
+        lags = [max(0, self.offset - subscriber.offset) for subscriber in self.subscribers]
+        return {
+            "offset": self.offset,
+            "bytes_published": self.bytes_published,
+            "subscribers": len(self.subscribers),
+            "lag_bytes": {
+                "max": max(lags, default=0),
+                "mean": sum(lags) / len(lags) if lags else 0,
+            },
+            "queued_chunks": sum(subscriber.queue.qsize() for subscriber in self.subscribers),
+            "slow_disconnects": self.slow_disconnects,
+            "resets": self.generation,
+            "round": self.decoder.round,
+            "error": str(self.error) if self.error is not None else None,
+        }
@@ -0,0 +1,227 @@
+import asyncio
+import json
+import logging
+
+import pytest
+
+from broadcaster import ReplayBroadcaster, ReplayError
+from malthusia.engine.replay import CompressedReplayWriter, ReplayWriter, encode_round, read_index, read_rounds
+
+
+def write_rounds(writer, rounds, content="a"):
+    for round in rounds:
+        locations = [{"x": 0, "y": 0, "label": content * 50}]
+        if round % 3 == 1:
+            writer.write({"round": round, "keyframe": True, "map": locations})
+        else:
+            writer.write({"round": round, "keyframe": False, "changes": locations})
+    writer.flush()
+
+
+async def settle():
+    # enough for the broadcaster to poll a few times
+    await asyncio.sleep(0.2)
+
+
+async def collect(stream, received):
+    async for chunk in stream:
+        received.append(chunk)
+
+
+def test_slow_client_is_disconnected(tmp_path):
+    path = tmp_path / "replay.txt"
+    writer = ReplayWriter(path)
+
+    async def run():
+        broadcaster = ReplayBroadcaster(str(path), chunk_size=20, poll_seconds=0.01, max_chunks=4)
+        fast = []
+        fast_task = asyncio.create_task(collect(broadcaster.stream(0), fast))
+        slow = broadcaster.stream(0)
+        # the slow client gets one chunk, and then does not read anymore
+        first_task = asyncio.create_task(slow.__anext__())
+        await settle()
+
+        write_rounds(writer, range(1, 6))
+        await settle()
+        first = first_task.result()
+        assert broadcaster.metrics()["slow_disconnects"] == 1
+        assert broadcaster.metrics()["subscribers"] == 1
+        # the disconnected client gets no more bytes, so its framing never breaks
+        rest = [chunk async for chunk in slow]
+        assert (first + b"".join(rest)) == path.read_bytes()[:len(first) + len(b"".join(rest))]
+        assert b"".join(fast) == path.read_bytes()
+        fast_task.cancel()
+        broadcaster.task.cancel()
+
+    asyncio.run(run())
+    writer.close()
+
+
+def test_truncate_disconnects_clients(tmp_path):
+    path = tmp_path / "replay.txt"
+    writer = ReplayWriter(path)
+    write_rounds(writer, range(1, 3))
+    size = writer.size
+    write_rounds(writer, range(3, 6))
+
+    async def run():
+        broadcaster = ReplayBroadcaster(str(path), poll_seconds=0.01)
+        received = []
+        task = asyncio.create_task(collect(broadcaster.stream(0), received))
+        await settle()
+        assert b"".join(received) == path.read_bytes()
+
+        writer.truncate(size)
+        await settle()
+        assert task.done()
+        assert broadcaster.metrics()["resets"] == 1
+        assert broadcaster.offset == size
+        broadcaster.task.cancel()
+
+    asyncio.run(run())
+    writer.close()
+
+
+def test_truncate_then_regrow_disconnects_clients(tmp_path):
+    path = tmp_path / "replay.txt"
+    writer = ReplayWriter(path)
+    write_rounds(writer, range(1, 3))
+    size = writer.size
+    write_rounds(writer, range(3, 6))
+    old = path.read_bytes()
+
+    async def run():
+        broadcaster = ReplayBroadcaster(str(path), poll_seconds=0.01)
+        received = []
+        task = asyncio.create_task(collect(broadcaster.stream(0), received))
+        await settle()
+
+        # a rollback: the replay is cut back and grows past where it was before the broadcaster polls again
+        writer.truncate(size)
+        write_rounds(writer, range(3, 10), content="b")
+        assert writer.size > len(old)
+        await settle()
+
+        # the client only ever got the old rounds, never old ones continued with new ones
+        assert task.done()
+        assert b"".join(received) == old
+        assert broadcaster.metrics()["resets"] == 1
+
+        # new clients get the new replay
+        received = []
+        task = asyncio.create_task(collect(broadcaster.stream(0), received))
+        await settle()
+        assert [r["round"] for r in read_rounds(path)] == list(range(1, 10))
+        assert b"".join(received) == path.read_bytes()
+        task.cancel()
+        broadcaster.task.cancel()
+
+    asyncio.run(run())
+    writer.close()
+
+
+def test_decoding_starts_at_the_latest_keyframe(tmp_path):
+    path = tmp_path / "replay.txt"
+    writer = ReplayWriter(path)
+    write_rounds(writer, range(1, 9))
+    writer.close()
+    keyframe = read_index(path)[-1]
+    assert keyframe.round == 7
+
+    broadcaster = ReplayBroadcaster(str(path))
+    chunk = asyncio.run(broadcaster.poll())
+    assert chunk == path.read_bytes()[keyframe.offset:]
+    broadcaster.publish(chunk)
+    assert broadcaster.decoder.round == 8
+    assert broadcaster.decoded_offset == path.stat().st_size
+
+
+def test_live_stream_waits_for_a_keyframe(tmp_path):
+    path = tmp_path / "replay.txt"
+    writer = ReplayWriter(path)
+
+    async def run():
+        broadcaster = ReplayBroadcaster(str(path), poll_seconds=0.01)
+        received = []
+        task = asyncio.create_task(collect(broadcaster.stream_live(), received))
+        await settle()
+        assert received == []
+
+        write_rounds(writer, range(1, 3))
+        await settle()
+        # the first thing the client gets is a keyframe of the current state, and not the replay from the start
+        first = json.loads(received[0][4:-4])
+        assert (first["round"], first["keyframe"]) == (2, True)
+        task.cancel()
+        broadcaster.task.cancel()
+
+    asyncio.run(run())
+    writer.close()
+
+
+def test_corrupt_round_skips_to_the_next_keyframe(tmp_path, caplog):
+    path = tmp_path / "replay.txt"
+    locations = [{"x": 0, "y": 0}]
+    with open(path, "w") as f:
+        f.write(encode_round({"round": 1, "keyframe": True, "map": locations}))
+        f.write('""""{"round": 2, "keyfr""""')
+        f.write(encode_round({"round": 3, "keyframe": False, "changes": locations}))
+        f.write(encode_round({"round": 4, "keyframe": True, "map": locations}))
+        f.write(encode_round({"round": 5, "keyframe": False, "changes": locations}))
+
+    broadcaster = ReplayBroadcaster(str(path), chunk_size=1000)
+    with caplog.at_level(logging.ERROR):
+        broadcaster.publish(asyncio.run(broadcaster.poll()))
+    assert "Corrupt round" in caplog.text
+    assert broadcaster.metrics()["resets"] == 1
+    assert broadcaster.decoder.round is None
+
+    broadcaster.publish(asyncio.run(broadcaster.poll()))
+    assert broadcaster.decoder.round == 5
+    assert broadcaster.offset == path.stat().st_size
+
+
+def test_unframed_replay_stops_the_broadcaster(tmp_path):
+    path = tmp_path / "replay.txt.gz"
+    writer = CompressedReplayWriter(path)
+    writer.write({"round": 1, "keyframe": True, "map": []})
+    writer.close()
+
+    async def run():
+        broadcaster = ReplayBroadcaster(str(path), poll_seconds=0.01)
+        with pytest.raises(ReplayError, match="not a framed replay"):
+            async for _ in broadcaster.stream(0):
+                pass
+        with pytest.raises(ReplayError):
+            await broadcaster.wait_for_keyframe(1)
+        assert broadcaster.task.done()
+        assert "not a framed replay" in broadcaster.metrics()["error"]
+
+    asyncio.run(run())
+
+
+def test_round_longer_than_the_limit_stops_the_broadcaster(tmp_path):
+    path = tmp_path / "replay.txt"
+    # a round that is never finished
+    path.write_text(encode_round({"round": 1, "map": []})[:-4] + " " * 1000)
+
+    async def run():
+        broadcaster = ReplayBroadcaster(str(path), poll_seconds=0.01, max_round_bytes=500)
+        with pytest.raises(ReplayError, match="longer than 500 bytes"):
+            await collect(broadcaster.stream(0), [])
+
+    asyncio.run(run())
+
+
+def test_live_stream_gives_up_without_a_keyframe(tmp_path):
+    path = tmp_path / "replay.txt"
+    writer = ReplayWriter(path)
+
+    async def run():
+        broadcaster = ReplayBroadcaster(str(path), poll_seconds=0.01)
+        assert not await broadcaster.wait_for_keyframe(0.1)
+        assert [chunk async for chunk in broadcaster.stream_live(timeout=0.1)] == []
+        broadcaster.task.cancel()
+
+    asyncio.run(run())
+    writer.close()
@@ -1,5 +1,6 @@
 #!/usr/bin/env bash
 source .env
 
-node ../ethereum/scripts/synchronizer.mjs "$ETH_URL" "$INIT_BLOCK" | \
-../engine/bin/mlth.py run --action-file "$ACTIONS_FILE" --output-file "$REPLAY_FILE" --stdin-turn
+SAFETY_MARGIN="${SAFETY_MARGIN:-10}" node ../ethereum/scripts/synchronizer.mjs "$ETH_URL" "$INIT_BLOCK" | \
+../engine/bin/mlth.py run --action-file "$ACTIONS_FILE" --output-file "$REPLAY_FILE" --stdin-turn \
+  ${SNAPSHOT_INTERVAL:+--snapshot-interval "$SNAPSHOT_INTERVAL"}
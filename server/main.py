@@ -1,16 +1,24 @@
 import os
+from typing import Optional
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 from fastapi.responses import StreamingResponse
-import asyncio
+
+from malthusia.engine.replay.container import read_index, find_block
+from broadcaster import ReplayBroadcaster, ReplayError
 
 load_dotenv()
 
 app = FastAPI()
 
 REPLAY_FILE = os.environ.get("REPLAY_FILE")
+# how long a new client waits for the first keyframe of a game before it is told to come back later
+KEYFRAME_TIMEOUT_SECONDS = 10
+
+# one follower of the replay file for all clients
+broadcaster = ReplayBroadcaster(REPLAY_FILE)
 
 origins = ["http://localhost", "http://localhost:3000", "https://malthusia.art"]
 
@@ -20,31 +28,76 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Replay-Offset"],
 )
 
 
-# TODO: start from a specific offset
-async def followfile(fname: str):
-    proc = await asyncio.create_subprocess_exec(
-        "tail", "-c", "+0", "-F", fname, stdout=asyncio.subprocess.PIPE
-    )
-    N = 100_000
-    wait_timeout = 60
-    while True:
-        try:
-            bs = await asyncio.wait_for(proc.stdout.read(n=N), wait_timeout)
-        except asyncio.exceptions.TimeoutError:
-            bs = b""
-        if len(bs) == 0:
-            break
-        else:
-            yield bs
+def round_offset(fname: str, round_num: int) -> int:
+    """
+    The byte offset of the latest keyframe at or before round_num, according to the index the engine writes next to
+    the replay. Streaming from there, a client can decode round_num and everything after it.
+    """
+    try:
+        blocks = read_index(fname)
+    except (FileNotFoundError, ValueError):
+        return 0
+    i = find_block(blocks, round_num)
+    return blocks[i].offset if i is not None else 0
+
+
+def replay_size(fname: str) -> int:
+    try:
+        return os.path.getsize(fname)
+    except FileNotFoundError:
+        return 0
+
 
-    proc.terminate()
+# every response is a different part of a replay that keeps growing, so none of them may be cached
+NO_STORE = {"Cache-Control": "no-store"}
 
 
 @app.get("/replay")
-async def replay():
-    # we cannot simply set Content-Encoding: gzip, because our replay file format is several gzips concatenated together
-    # while this is okay by the original gzip standard, it is not okay by most browsers...
-    return StreamingResponse(followfile(REPLAY_FILE), media_type="application/replay")#, headers={"Content-Encoding": "gzip"})
\ No newline at end of file
+async def replay(from_round: Optional[int] = None, offset: Optional[int] = Query(None, ge=0)):
+    """
+    Streams the replay as it is written. By default, it starts with the current state of the world as a keyframe,
+    followed by the rounds after it. To get (part of) the history instead:
+    - ?from_round=N starts at the latest keyframe at or before round N (0 for the whole replay), or
+    - ?offset=N starts at byte N, e.g. to resume exactly where a dropped connection stopped.
+    The X-Replay-Offset header says where in the replay the response starts.
+
+    The start is a query parameter rather than a Range header, because a range of a file that is still growing has no
+    last byte to put in the Content-Range of a 206.
+
+    Before the first keyframe of a game has been written, there is no current state to start with, so the default
+    stream answers with a 503 after KEYFRAME_TIMEOUT_SECONDS.
+    """
+    # the replay is streamed as the engine writes it: framed rounds, uncompressed (see ReplayWriter), so there is no
+    # Content-Encoding. compressed replays (see CompressedReplayWriter) are not served
+    if from_round is not None and offset is not None:
+        raise HTTPException(status_code=400, detail="give either from_round or offset, not both")
+    if broadcaster.error is not None:
+        raise HTTPException(status_code=500, detail=f"the replay cannot be streamed: {broadcaster.error}")
+    if from_round is None and offset is None:
+        try:
+            ready = await broadcaster.wait_for_keyframe(KEYFRAME_TIMEOUT_SECONDS)
+        except ReplayError as e:
+            raise HTTPException(status_code=500, detail=f"the replay cannot be streamed: {e}")
+        if not ready:
+            raise HTTPException(status_code=503, detail="the game has not started yet", headers={"Retry-After": "1"})
+        return StreamingResponse(broadcaster.stream_live(), media_type="application/replay", headers=NO_STORE)
+    if from_round is not None:
+        offset = round_offset(REPLAY_FILE, from_round)
+    else:
+        size = replay_size(REPLAY_FILE)
+        if offset > size:
+            raise HTTPException(status_code=400, detail=f"offset {offset} is past the end of the replay ({size} bytes)")
+    return StreamingResponse(broadcaster.stream(offset), media_type="application/replay",
+                             headers={"X-Replay-Offset": str(offset), **NO_STORE})
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Subscriber count, lag and disconnects of the replay stream.
+    """
+    return broadcaster.metrics()
@@ -0,0 +1,100 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from broadcaster import ReplayError
+from malthusia.engine.replay import ReplayWriter
+
+
+class FiniteBroadcaster:
+    """
+    Serves what is in the replay file right now, and then stops instead of following the file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.error = None
+        self.keyframe_ready = True
+
+    async def wait_for_keyframe(self, timeout):
+        if self.error is not None:
+            raise self.error
+        return self.keyframe_ready
+
+    async def stream(self, offset=0, generation=None):
+        with open(self.filename, "rb") as f:
+            f.seek(offset)
+            yield f.read()
+
+
+@pytest.fixture
+def replay(tmp_path, monkeypatch):
+    path = tmp_path / "replay.txt"
+    writer = ReplayWriter(path)
+    for round in range(1, 8):
+        writer.write({"round": round, "keyframe": round % 3 == 1, "map": []})
+    writer.close()
+    monkeypatch.setattr(main, "REPLAY_FILE", str(path))
+    monkeypatch.setattr(main, "broadcaster", FiniteBroadcaster(path))
+    return path
+
+
+def test_from_round_starts_at_the_keyframe_before_it(replay):
+    blocks = main.read_index(replay)
+    assert [block.round for block in blocks] == [1, 4, 7]
+
+    response = TestClient(main.app).get("/replay", params={"from_round": 5})
+    assert response.status_code == 200
+    assert response.headers["X-Replay-Offset"] == str(blocks[1].offset)
+    assert response.content == replay.read_bytes()[blocks[1].offset:]
+
+    response = TestClient(main.app).get("/replay", params={"from_round": 0})
+    assert response.headers["X-Replay-Offset"] == "0"
+    assert response.content == replay.read_bytes()
+
+
+def test_offset_starts_at_the_byte(replay):
+    size = replay.stat().st_size
+    client = TestClient(main.app)
+
+    response = client.get("/replay", params={"offset": 10})
+    assert response.status_code == 200
+    assert response.headers["X-Replay-Offset"] == "10"
+    assert response.content == replay.read_bytes()[10:]
+
+    response = client.get("/replay", params={"offset": size})
+    assert response.status_code == 200
+    assert response.content == b""
+
+    assert client.get("/replay", params={"offset": size + 1}).status_code == 400
+    assert client.get("/replay", params={"offset": -1}).status_code == 422
+    assert client.get("/replay", params={"offset": 10, "from_round": 5}).status_code == 400
+
+
+def test_range_is_not_a_partial_response(replay):
+    # a 200 with part of the replay would be cached as the whole of it, so ranges are not supported
+    response = TestClient(main.app).get("/replay", params={"from_round": 0}, headers={"Range": "bytes=10-"})
+    assert response.status_code == 200
+    assert response.content == replay.read_bytes()
+
+
+def test_replay_is_not_cached(replay):
+    client = TestClient(main.app)
+    for params in [{"from_round": 5}, {"offset": 10}]:
+        assert client.get("/replay", params=params).headers["Cache-Control"] == "no-store"
+
+
+def test_live_stream_before_the_game_has_started(replay):
+    main.broadcaster.keyframe_ready = False
+    response = TestClient(main.app).get("/replay")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+
+def test_replay_that_cannot_be_streamed(replay):
+    main.broadcaster.error = ReplayError("no round starts at byte 0, so this is not a framed replay")
+    client = TestClient(main.app)
+    for params in [{}, {"from_round": 0}, {"offset": 0}]:
+        response = client.get("/replay", params=params)
+        assert response.status_code == 500
+        assert "not a framed replay" in response.json()["detail"]
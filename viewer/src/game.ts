@@ -19,6 +19,7 @@ const DIRT_COLORS: Map<number, Array<number>> = new Map<number, Array<number>>([
 const MAX_SPRITES_PER_TYPE = 1000;
 const N_TYPES = 1;
 const AUTOPLAY_DELAY = 100;
+const RECONNECT_DELAY = 1000;
 const TYPE_NAME = ["WANDERER"];
 
 type Game = {
@@ -33,7 +34,6 @@ type Location = {
   elevation: number;
   water: boolean;
   robot: Robot | null;
-  dead_robots: Robot[];
 };
 type Robot = {
   id: number;
@@ -468,12 +468,30 @@ export function draw_grid(viewer: Viewer) {
   }
 }
 
-// load replay
-// TODO: add FROM index here!! so that we can get state of the world from a particular round on.
+// load replay, and keep following it: when the stream ends, reconnect and continue after the last round we got.
+// the server starts at the keyframe at or before that round, so some rounds may be processed twice
 export async function load_replay(round_processer) {
   console.log("loading_replay");
-  // const resp = await fetch('/replay')
-  const url = process.env.REACT_APP_API_URL + "/replay";
+  let last_round: number | null = null;
+  const processer = (round_json) => {
+    last_round = round_json.round;
+    round_processer(round_json);
+  };
+  while (true) {
+    // const resp = await fetch('/replay')
+    let url = process.env.REACT_APP_API_URL + "/replay";
+    if (last_round !== null) {
+      url += `?from_round=${last_round + 1}`;
+    }
+    if (!(await stream_replay(url, processer))) {
+      return;
+    }
+    await wait(RECONNECT_DELAY);
+  }
+}
+
+// returns false if there is no replay to stream
+async function stream_replay(url: string, round_processer): Promise<boolean> {
   const resp = await fetch(url);
   if (resp.ok) {
     console.log("resp ok");
@@ -486,7 +504,7 @@ export async function load_replay(round_processer) {
       const red = await reader?.read();
       if (!red || red.done) {
         console.log("DONE");
-        return;
+        return true;
       }
       let start_i = 0;
       for (let i = 0; i < red.value.length; i++) {
@@ -525,6 +543,7 @@ export async function load_replay(round_processer) {
     }
   } else {
     console.error("no replay file");
+    return false;
   }
 }
 
@@ -549,10 +568,23 @@ export function process_rounds(viewer: Viewer) {
     queue.enqueue(round_dict);
   };
 
+  // the world state, indexed by "x,y". delta-encoded rounds only contain the changed locations
+  const locations: Map<string, Location> = new Map<string, Location>();
+
   const round_displayer = async () => {
     while (true) {
       const next_round = await queue.dequeue();
-      viewer.game!.map_states = [next_round.map];
+      if (next_round.keyframe === false) {
+        for (const location of next_round.changes) {
+          locations.set(`${location.x},${location.y}`, location);
+        }
+      } else {
+        locations.clear();
+        for (const location of next_round.map) {
+          locations.set(`${location.x},${location.y}`, location);
+        }
+      }
+      viewer.game!.map_states = [Array.from(locations.values())];
       viewer.game!.current_round = next_round.round;
       viewer.game!.max_rounds = 1;
       viewer.game!.round_offset = next_round.round;